@@ -0,0 +1,236 @@
+"""
+Feature Extraction
+==================
+
+Per-battery feature tensors for the Cluster RUL models.
+
+A battery's features combine, cycle by cycle,
+
+    - the VIT block: measured discharge curves from RetiredBatteryData_all,
+    - the simulation block: internal states of the fitted electrochemical
+      model from SimulationData_RetiredBattery, smoothed over the cycle axis
+      with a trailing moving average, and
+    - the delta block: both of the above minus their values in the first cycle.
+
+All channels of a block are read into one (cycles, channels, samples) array
+and smoothed at once, and the output is filled in place, so the features are
+built without per-cycle or per-channel Python loops. The values are identical
+to the inline ``extract_feature`` the notebooks used to define.
+
+Cluster 1 uses a compact channel set laid out as [VIT, simulation, delta VIT,
+delta simulation] in one array; clusters 2 and 3 use the full channel set
+split into a VIT array and a simulation array, each followed by its deltas.
+
+The dataset arguments are handles from ``battery_dataset.open_dataset`` (in
+``Code for Simulation``), for the .mat archives or a columnar store.
+"""
+
+from typing import NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+# Calibrated cycle life, indexed by (batch number - 1, battery)
+CALIBRATED_CYCLE_LIFE = np.array([
+    [1217, 1247, 1234, 1223, 843, 1085, 1135, 687, 616, 862, 197, 297, 398, 385, 602, 197, 303, 107, 66, 49, 119],
+    [1183, 1650, 1846, 1515, 854, 1224, 652, 816, 966, 798, 256, 189, 568, 509, 493, 119, 317, 64, 154, 59, 130],
+    [1291, 887, 1244, 1124, 551, 1524, 934, 572, 521, 616, 253, 234, 343, 479, 523, 198, 465, 115, 89, 47, 116],
+    [1648, 841, 1616, 1332, 667, 1221, 605, 719, 526, 704, 456, 364, 314, 425, 517, 104, 247, 252, 65, 111, 127],
+]).T
+
+# Window of the moving average over cycles
+DEFAULT_WINDOW = 3
+
+# Output layouts
+JOINT_LAYOUT = 'joint'
+SPLIT_LAYOUT = 'split'
+
+
+class FeatureSet(NamedTuple):
+    """Channels of the VIT and simulation blocks and the output layout."""
+    name: str
+    measured: Tuple[str, ...]
+    simulated: Tuple[str, ...]
+    layout: str
+
+
+# Feature set of each cluster model
+CLUSTER_FEATURES = {
+    1: FeatureSet('compact',
+                  ('discharge_V', 'discharge_Q', 'discharge_t_s'),
+                  ('Vo', 'Vsn', 'qnB', 'Ro'),
+                  JOINT_LAYOUT),
+    2: FeatureSet('full',
+                  ('discharge_V', 'discharge_Q', 'discharge_E', 'discharge_T', 'discharge_dQdV',
+                   'discharge_t_s'),
+                  ('Vo', 'Vsn', 'Vsp', 'qnS', 'qnB', 'qpB', 'qpS', 'Ro', 'D'),
+                  SPLIT_LAYOUT),
+}
+CLUSTER_FEATURES[3] = CLUSTER_FEATURES[2]
+
+
+def moving_average(data: np.ndarray, n: int = DEFAULT_WINDOW) -> np.ndarray:
+    """
+    Smooth along the first axis with a trailing moving average.
+
+    Sample i (for i >= n) is replaced by the mean of samples i - n to i - 1;
+    the first n samples are kept. The box kernel is applied as n shifted
+    whole-array additions, in the summation order of the original per-sample
+    loop, and every other axis is smoothed at once.
+
+    Args:
+        data: Array of shape (cycles, ...)
+        n: Window size
+
+    Returns:
+        Smoothed copy of data
+    """
+    data_output = np.copy(data)
+    stop = len(data) - n
+    if stop > 0:
+        window_sum = np.copy(data[:stop])
+        for shift in range(1, n):
+            window_sum += data[shift:stop + shift]
+        data_output[n:] = window_sum / n
+    return data_output
+
+
+def cycle_life(batch_name: str, battery_number: int, data_simulation,
+               calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE) -> int:
+    """
+    Number of cycles used for a battery's features.
+
+    Args:
+        batch_name: Batch name, e.g. 'batch01'
+        battery_number: Zero-based battery index
+        data_simulation: Simulation dataset handle
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        The smaller of the recorded and the calibrated cycle life
+    """
+    return int(min(data_simulation.cycle_life(batch_name, battery_number),
+                   calibrated_life[int(batch_name[-2:]) - 1, battery_number]))
+
+
+def read_channels(batch_name: str, battery_number: int, data_simulation, data_CM,
+                  features: FeatureSet = CLUSTER_FEATURES[1],
+                  calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the source channels of one battery's features.
+
+    Args:
+        batch_name: Batch name, e.g. 'batch01'
+        battery_number: Zero-based battery index
+        data_simulation: Simulation dataset handle
+        data_CM: Measured dataset handle
+        features: Channels and layout, e.g. CLUSTER_FEATURES[cluster]
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        Tuple of (measured, simulated) arrays of shape (cycles, channels, samples),
+        cut to the cycle life
+    """
+    life = cycle_life(batch_name, battery_number, data_simulation, calibrated_life)
+    return (data_CM.channels(batch_name, battery_number, features.measured, life),
+            data_simulation.channels(batch_name, battery_number, features.simulated, life))
+
+
+def build_feature(measured: np.ndarray, simulated: np.ndarray,
+                  features: FeatureSet = CLUSTER_FEATURES[1], window: int = DEFAULT_WINDOW
+                  ) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Build the feature tensors and RUL labels from the source channels.
+
+    Features start at the second cycle, where the delta block is defined.
+
+    Args:
+        measured: Measured channels from read_channels
+        simulated: Simulated channels from read_channels (not yet smoothed)
+        features: Channels and layout the channels were read with
+        window: Window of the moving average over cycles
+
+    Returns:
+        For the joint layout, (features, RUL) with features of shape
+        (cycles - 1, 2 * (measured + simulated channels), samples); for the
+        split layout, (VIT features, simulation features, RUL) with
+        2 * measured and 2 * simulated channels. RUL has shape (cycles - 1, 1).
+
+    Raises:
+        ValueError: If the layout is unknown
+    """
+    if features.layout not in (JOINT_LAYOUT, SPLIT_LAYOUT):
+        raise ValueError(f"Unknown feature layout: {features.layout}")
+
+    life = len(measured)
+    # The trailing average of the first cycles only needs those cycles
+    simulated = moving_average(simulated, n=window)
+    RUL = np.arange(life - 1, 0, -1, dtype=float).reshape(-1, 1)
+
+    blocks = [measured, simulated]
+    if features.layout == JOINT_LAYOUT:
+        outputs = [blocks + blocks]
+    else:
+        outputs = [[block, block] for block in blocks]
+
+    results = []
+    for output_blocks in outputs:
+        channels = sum(block.shape[1] for block in output_blocks)
+        samples = output_blocks[0].shape[2]
+        output = np.empty((life - 1, channels, samples), dtype=np.result_type(*output_blocks))
+
+        # Values in the first half of the blocks, deltas from the first cycle in the second half
+        start = 0
+        half = len(output_blocks) // 2
+        for i, block in enumerate(output_blocks):
+            stop = start + block.shape[1]
+            if i < half:
+                output[:, start:stop] = block[1:life]
+            else:
+                np.subtract(block[1:life], block[0], out=output[:, start:stop])
+            start = stop
+        results.append(output)
+
+    return (*results, RUL)
+
+
+def extract_feature(batch_name: str, battery_number: int, data_simulation, data_CM,
+                    features: FeatureSet = CLUSTER_FEATURES[1], window: int = DEFAULT_WINDOW,
+                    calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE
+                    ) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Build the feature tensors and RUL labels of one battery.
+
+    Args:
+        batch_name: Batch name, e.g. 'batch01'
+        battery_number: Zero-based battery index
+        data_simulation: Simulation dataset handle
+        data_CM: Measured dataset handle
+        features: Channels and layout, e.g. CLUSTER_FEATURES[cluster]
+        window: Window of the moving average over cycles
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        Feature arrays and RUL labels as returned by build_feature
+
+    Raises:
+        ValueError: If the layout is unknown
+    """
+    measured, simulated = read_channels(batch_name, battery_number, data_simulation, data_CM,
+                                        features, calibrated_life)
+    return build_feature(measured, simulated, features, window)
+
+
+def feature_channels(features: FeatureSet) -> Sequence[int]:
+    """
+    Number of channels of each output array of a feature set.
+
+    Args:
+        features: Channels and layout
+
+    Returns:
+        Channel counts, one per feature array returned by extract_feature
+    """
+    measured, simulated = 2 * len(features.measured), 2 * len(features.simulated)
+    if features.layout == JOINT_LAYOUT:
+        return (measured + simulated,)
+    return measured, simulated
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Feature Store
+=============
+
+Precomputed, memory-mapped feature tensors of every (batch, battery) pair.
+
+Building the features of a cluster used to parse both .mat archives and run
+``extract_feature`` for every battery on each notebook run, growing the
+training arrays with ``numpy.concatenate`` inside the loop. The store builds
+the features of all batteries once per feature set and keeps them on disk:
+
+    - one contiguous file per output array of ``extract_feature`` (the
+      feature arrays and the RUL labels), with the rows of all batteries
+      back to back, and
+    - a JSON index with the row offset and count of every (batch, battery)
+      and the digests the rows were built from.
+
+Every build writes its data files under new names carrying a generation
+token (``features0-<generation>.bin``), and replaces the index atomically
+as its last step. Until then the old index and its files are untouched, so
+an interrupted build leaves the previous store intact, and an index never
+refers to the files of another build. After publishing, a build removes
+only the files of the index it started from, never those of a build running
+at the same time (clusters 2 and 3 share a store); files of a build that
+never published, or was overtaken by a concurrent one, are not referenced by
+any index and may be deleted by hand. A store whose index refers to a
+missing file is rebuilt.
+
+Opening a store memory-maps the files, and ``assemble`` cuts any cluster's
+train or test split out of them with one copy, without touching the .mat
+archives or recomputing features.
+
+Entries are invalidated by digest. The settings digest covers the feature
+set, the smoothing window, the calibrated cycle life table and the store
+format; an entry's digest adds the bytes of the source channels it was built
+from, cut to the cycle life. As
+long as the source files are unchanged (same size and modification time)
+and the settings match, the store is used as is. Otherwise the sources are
+read and only entries whose digest changed are rebuilt; the rows of the
+other entries are copied from the old files.
+
+The datasets are opened with ``battery_dataset.open_dataset`` from
+``Code for Simulation``, which is added to the import path.
+
+Example:
+    python feature_store.py Features --simulation SimulationData_RetiredBattery.mat \
+        --measured RetiredBatteryData_all.mat --clusters 1 2
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import uuid
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from feature_extraction import (CALIBRATED_CYCLE_LIFE, CLUSTER_FEATURES, DEFAULT_WINDOW, SPLIT_LAYOUT,
+                                FeatureSet, build_feature, read_channels)
+
+# battery_dataset lives next to the simulation code
+SIMULATION_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                   'Code for Simulation')
+if SIMULATION_CODE_DIR not in sys.path:
+    sys.path.append(SIMULATION_CODE_DIR)
+
+from battery_dataset import open_dataset  # noqa: E402
+
+# Feature store layout
+FEATURE_STORE_FORMAT_VERSION = 1
+FEATURE_STORE_DTYPE = np.float64
+INDEX_FILE = 'index.json'
+
+
+def entry_key(batch_name: str, battery_number: int) -> str:
+    """Index key of a (batch, battery) pair."""
+    return f'{batch_name}/{battery_number}'
+
+
+def settings_digest(features: FeatureSet, window: int = DEFAULT_WINDOW,
+                    calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE) -> str:
+    """
+    Digest of everything besides the source data that the features depend on.
+
+    Args:
+        features: Channels and layout
+        window: Window of the moving average over cycles
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        Hex digest
+    """
+    settings = {'format': FEATURE_STORE_FORMAT_VERSION, 'dtype': np.dtype(FEATURE_STORE_DTYPE).name,
+                'features': features._asdict(), 'window': window,
+                'calibrated_life': np.asarray(calibrated_life).tolist()}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def source_digest(settings: str, arrays: Iterable[np.ndarray]) -> str:
+    """
+    Digest of an entry's settings and source channels.
+
+    Args:
+        settings: Settings digest
+        arrays: Source channel arrays
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.sha256(settings.encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype.str}{array.shape}'.encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path: str) -> List:
+    """
+    Cheap fingerprint of a source file or columnar store directory.
+
+    Args:
+        path: Source path
+
+    Returns:
+        List of [name, size, modification time in ns] per file
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        files = [path]
+    return [[os.path.basename(file), os.stat(file).st_size, os.stat(file).st_mtime_ns]
+            for file in files if os.path.isfile(file)]
+
+
+class FeatureStore:
+    """
+    Read-only view of the features of one feature set.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Open the index and memory-map the feature files.
+
+        Args:
+            store_dir: Directory written by build_feature_store
+
+        Raises:
+            FileNotFoundError: If the store does not exist
+            ValueError: If the store format is not supported
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+
+        if self.index.get('format') != FEATURE_STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported feature store format: {self.index.get('format')}")
+
+        rows = self.index['rows']
+        self.arrays = []
+        for spec in self.index['arrays']:
+            shape = (rows, *spec['shape'])
+            if rows:
+                self.arrays.append(np.memmap(os.path.join(store_dir, spec['file']),
+                                             dtype=self.index['dtype'], mode='r', shape=shape))
+            else:
+                self.arrays.append(np.empty(shape, dtype=self.index['dtype']))
+
+    @property
+    def entries(self) -> List[Tuple[str, int]]:
+        """(batch, battery) pairs in the store, in row order."""
+        pairs = []
+        for key in self.index['entries']:
+            batch_name, battery_number = key.split('/')
+            pairs.append((batch_name, int(battery_number)))
+        return pairs
+
+    def rows(self, batch_name: str, battery_number: int) -> slice:
+        """
+        Rows of a (batch, battery) pair.
+
+        Raises:
+            KeyError: If the pair is not in the store
+        """
+        entry = self.index['entries'][entry_key(batch_name, battery_number)]
+        return slice(entry['offset'], entry['offset'] + entry['rows'])
+
+    def get(self, batch_name: str, battery_number: int) -> Tuple[np.ndarray, ...]:
+        """
+        Features of one battery as zero-copy views.
+
+        Args:
+            batch_name: Batch name
+            battery_number: Zero-based battery index
+
+        Returns:
+            Feature arrays and RUL labels, as returned by extract_feature
+        """
+        rows = self.rows(batch_name, battery_number)
+        return tuple(array[rows] for array in self.arrays)
+
+    def assemble(self, pairs: Sequence[Tuple[str, int]]) -> Tuple[np.ndarray, ...]:
+        """
+        Concatenate the features of several batteries, e.g. a training split.
+
+        Every output array is allocated once and filled from the memory map.
+
+        Args:
+            pairs: (batch, battery) pairs in output order
+
+        Returns:
+            Feature arrays and RUL labels, as returned by extract_feature
+        """
+        slices = [self.rows(batch_name, battery_number) for batch_name, battery_number in pairs]
+        total = sum(rows.stop - rows.start for rows in slices)
+
+        outputs = []
+        for array in self.arrays:
+            output = np.empty((total, *array.shape[1:]), dtype=array.dtype)
+            start = 0
+            for rows in slices:
+                stop = start + rows.stop - rows.start
+                output[start:stop] = array[rows]
+                start = stop
+            outputs.append(output)
+        return tuple(outputs)
+
+    def offsets(self, pairs: Sequence[Tuple[str, int]]) -> List[int]:
+        """
+        Start row of every battery in an assembled split, followed by its length.
+
+        Args:
+            pairs: (batch, battery) pairs in output order
+
+        Returns:
+            List of len(pairs) + 1 row offsets, starting at 0
+        """
+        offsets = [0]
+        for batch_name, battery_number in pairs:
+            rows = self.rows(batch_name, battery_number)
+            offsets.append(offsets[-1] + rows.stop - rows.start)
+        return offsets
+
+
+def _load_index(store_dir: str) -> Optional[Dict]:
+    """Index of an existing store, or None if there is no readable one."""
+    try:
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('format') == FEATURE_STORE_FORMAT_VERSION else None
+
+
+def _files_present(store_dir: str, index: Dict) -> bool:
+    """Whether every data file an index refers to exists."""
+    return all(os.path.isfile(os.path.join(store_dir, spec['file'])) for spec in index['arrays'] or [])
+
+
+def _remove_stale_files(store_dir: str, old_index: Optional[Dict], files: Sequence[str]) -> None:
+    """
+    Remove the data files of the index a build replaced.
+
+    Only files of the index read when the build started are removed, so the
+    files of a concurrent build, which may have published in the meantime,
+    are kept. Files still mapped elsewhere (which Windows refuses to delete)
+    are left in place.
+
+    Args:
+        store_dir: Store directory
+        old_index: Index the build started from (None if there was none)
+        files: Data files of the new index
+    """
+    if old_index is None:
+        return
+    for spec in old_index['arrays'] or []:
+        if spec['file'] not in files:
+            try:
+                os.remove(os.path.join(store_dir, spec['file']))
+            except OSError:
+                pass
+
+
+def build_feature_store(store_dir: str, simulation_path: str, measured_path: str,
+                        features: FeatureSet, window: int = DEFAULT_WINDOW,
+                        calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE) -> FeatureStore:
+    """
+    Build or update the features of every (batch, battery) pair.
+
+    Entries whose digest is unchanged are copied from the existing store;
+    the others are computed. Batteries whose features cannot be built are
+    reported and left out.
+
+    Args:
+        store_dir: Output directory of this feature set
+        simulation_path: SimulationData_RetiredBattery.mat or a columnar store
+        measured_path: RetiredBatteryData_all.mat or a columnar store
+        features: Channels and layout
+        window: Window of the moving average over cycles
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        The updated store
+    """
+    data_simulation = open_dataset(simulation_path, 'simulation')
+    data_CM = open_dataset(measured_path)
+    settings = settings_digest(features, window, calibrated_life)
+
+    old_index = replaced_index = _load_index(store_dir)
+    if old_index is not None and not _files_present(store_dir, old_index):
+        # Nothing of an incomplete store is reused
+        old_index = None
+    old_store = FeatureStore(store_dir) if old_index is not None else None
+    old_entries = old_index['entries'] if old_index is not None else {}
+
+    os.makedirs(store_dir, exist_ok=True)
+    generation = uuid.uuid4().hex[:12]
+    files = [f'features{i}-{generation}.bin' for i in range(2 if features.layout == SPLIT_LAYOUT else 1)]
+    files.append(f'labels-{generation}.bin')
+    index = {'format': FEATURE_STORE_FORMAT_VERSION, 'dtype': np.dtype(FEATURE_STORE_DTYPE).name,
+             'generation': generation, 'settings': settings, 'features': features._asdict(), 'window': window,
+             'sources': {'simulation': source_fingerprint(simulation_path),
+                         'measured': source_fingerprint(measured_path)},
+             'arrays': None, 'rows': 0, 'entries': {}}
+
+    handles = [open(os.path.join(store_dir, file), 'wb') for file in files]
+    built = reused = 0
+    try:
+        for batch_name in data_simulation.batches:
+            for battery_number in range(data_simulation.num_batteries(batch_name)):
+                key = entry_key(batch_name, battery_number)
+                try:
+                    sources = read_channels(batch_name, battery_number, data_simulation, data_CM,
+                                            features, calibrated_life)
+                    digest = source_digest(settings, sources)
+                    if key in old_entries and old_entries[key]['digest'] == digest:
+                        arrays = old_store.get(batch_name, battery_number)
+                        reused += 1
+                    else:
+                        arrays = build_feature(*sources, features, window)
+                        built += 1
+                except (ValueError, IndexError, KeyError) as e:
+                    print(f"Error extracting features of {batch_name}, Battery {battery_number}: {e}")
+                    continue
+
+                shapes = [list(array.shape[1:]) for array in arrays]
+                if index['arrays'] is None:
+                    index['arrays'] = [{'file': file, 'shape': shape} for file, shape in zip(files, shapes)]
+                elif shapes != [spec['shape'] for spec in index['arrays']]:
+                    raise ValueError(f"Feature shapes {shapes} of {key} differ from "
+                                     f"{[spec['shape'] for spec in index['arrays']]}")
+
+                for handle, array in zip(handles, arrays):
+                    handle.write(np.ascontiguousarray(array, dtype=FEATURE_STORE_DTYPE).tobytes())
+                index['entries'][key] = {'offset': index['rows'], 'rows': len(arrays[0]), 'digest': digest}
+                index['rows'] += len(arrays[0])
+        for handle in handles:
+            handle.flush()
+            os.fsync(handle.fileno())
+    finally:
+        for handle in handles:
+            handle.close()
+
+    if index['arrays'] is None:
+        index['arrays'] = [{'file': file, 'shape': []} for file in files]
+    # Publish the new generation: the index is replaced last and in one step
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    with open(f'{index_path}.{generation}.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{index_path}.{generation}.tmp', index_path)
+
+    # Release the old memory maps before removing their files
+    del old_store
+    _remove_stale_files(store_dir, replaced_index, files)
+
+    print(f"Feature store {store_dir}: {built} batteries built, {reused} reused, {index['rows']} rows")
+    return FeatureStore(store_dir)
+
+
+def open_feature_store(store_root: str, features: FeatureSet, simulation_path: str,
+                       measured_path: str, window: int = DEFAULT_WINDOW,
+                       calibrated_life: np.ndarray = CALIBRATED_CYCLE_LIFE) -> FeatureStore:
+    """
+    Open the store of a feature set, building or updating it first if it is stale.
+
+    The sources are only parsed if the store is missing or incomplete, was
+    built with other settings, or a source file changed since it was built.
+
+    Args:
+        store_root: Root directory holding one store per feature set
+        features: Channels and layout, e.g. CLUSTER_FEATURES[cluster]
+        simulation_path: SimulationData_RetiredBattery.mat or a columnar store
+        measured_path: RetiredBatteryData_all.mat or a columnar store
+        window: Window of the moving average over cycles
+        calibrated_life: Calibrated cycle life table
+
+    Returns:
+        Up-to-date store
+    """
+    store_dir = os.path.join(store_root, features.name)
+    index = _load_index(store_dir)
+    if (index is not None and _files_present(store_dir, index)
+            and index['settings'] == settings_digest(features, window, calibrated_life)
+            and index['sources'] == {'simulation': source_fingerprint(simulation_path),
+                                     'measured': source_fingerprint(measured_path)}):
+        return FeatureStore(store_dir)
+    return build_feature_store(store_dir, simulation_path, measured_path, features, window,
+                               calibrated_life)
+
+
+def main():
+    """
+    Command-line entry point for building the feature stores
+    """
+    parser = argparse.ArgumentParser(description="Build the cached feature tensors of the Cluster models")
+    parser.add_argument('store', help="Root directory of the feature stores")
+    parser.add_argument('--simulation', default='SimulationData_RetiredBattery.mat',
+                        help="Simulation archive or columnar store directory")
+    parser.add_argument('--measured', default='RetiredBatteryData_all.mat',
+                        help="Measured archive or columnar store directory")
+    parser.add_argument('--clusters', type=int, nargs='+', default=sorted(CLUSTER_FEATURES),
+                        help="Clusters whose feature sets are built")
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help="Moving-average window")
+    args = parser.parse_args()
+
+    # Clusters 2 and 3 share a feature set
+    feature_sets = {CLUSTER_FEATURES[cluster].name: CLUSTER_FEATURES[cluster] for cluster in args.clusters}
+    for features in feature_sets.values():
+        store = open_feature_store(args.store, features, args.simulation, args.measured, args.window)
+        print(f"{features.name}: {len(store.entries)} batteries, "
+              f"arrays {[list(array.shape) for array in store.arrays]}")
+
+
+if __name__ == "__main__":
+    main()
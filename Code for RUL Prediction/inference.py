@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+"""
+Inference
+=========
+
+Batched, no-grad CPU inference with the trained Cluster RUL models.
+
+A battery's cluster follows from the working condition (Mid_SOC, DOD) of its
+batch, as in the study:
+
+    - cluster 1: deep cycling, DOD >= 0.5 around Mid_SOC >= 0.5
+    - cluster 3: shallow cycling at a high state of charge, Mid_SOC > 0.5
+    - cluster 2: all other conditions
+
+``RULPredictor`` loads the three cluster models once and predicts the RUL of
+many batteries from the feature stores: the batteries of each cluster are
+assembled into one array, scaled with the normalizers saved with the model,
+and run through the model in batches under ``torch.inference_mode`` into a
+preallocated output. Per-batch latencies and throughput are reported.
+
+Models are loaded from
+
+    - TorchScript archives written by ``export_model``, which carry their
+      normalizers and need no model class (the preferred serving format),
+    - ONNX files written by ``export_model`` with a JSON sidecar of the
+      normalizers, run with onnxruntime if it is installed, or
+    - .pth files written by ``normalization.save_model``, which need the
+      notebook's ``Net`` class to be importable. These can be traced to
+      TorchScript on their first batch.
+
+Example:
+    python inference.py ../../Features --model 1 Trained_model/Cluster1.pt \
+        --model 2 Trained_model/Cluster2.pt --model 3 Trained_model/Cluster3.pt --report report.json
+"""
+
+import argparse
+import json
+import os
+import time
+import zipfile
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from feature_extraction import CLUSTER_FEATURES
+from feature_store import FeatureStore
+from normalization import MinMaxNormalizer, load_model, scale_inputs
+from training import DEFAULT_BATCH_SIZE, configure_threads
+
+# Code for Simulation is on the import path once feature_store is imported
+from battery_dataset import working_condition  # noqa: E402
+
+# Working-condition boundaries of the usage clusters
+CLUSTER1_MIN_DOD = 0.5
+CLUSTER1_MIN_MID_SOC = 0.5
+CLUSTER3_MIN_MID_SOC = 0.5
+
+# Formats written by export_model
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+# Serving information stored with an exported model
+SERVING_INFO_FILE = 'serving.json'
+
+
+def cluster_of(mid_soc: float, dod: float) -> int:
+    """
+    Usage cluster of a working condition.
+
+    Args:
+        mid_soc: Mid state of charge of the cycling
+        dod: Depth of discharge of the cycling
+
+    Returns:
+        Cluster number (1, 2 or 3)
+    """
+    if dod >= CLUSTER1_MIN_DOD and mid_soc >= CLUSTER1_MIN_MID_SOC:
+        return 1
+    if mid_soc > CLUSTER3_MIN_MID_SOC:
+        return 3
+    return 2
+
+
+def batch_cluster(batch_name: str) -> int:
+    """
+    Usage cluster of a batch.
+
+    Raises:
+        ValueError: If the batch is unknown
+    """
+    return cluster_of(*working_condition(batch_name))
+
+
+def predict_batches(model: Callable, inputs: Sequence[np.ndarray],
+                    batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+    """
+    Run a model over inputs that are already scaled, batch by batch.
+
+    Args:
+        model: Model called as model(*batch_inputs)
+        inputs: Model inputs of shape (rows, 1, channels, samples), e.g. strided
+            views of the scaled features
+        batch_size: Rows per batch
+
+    Returns:
+        Predictions of shape (rows,)
+    """
+    rows = len(inputs[0])
+    predictions = np.empty(rows, dtype=np.float32)
+    if isinstance(model, torch.nn.Module):
+        model.eval()
+    with torch.inference_mode():
+        for start in range(0, rows, batch_size):
+            stop = min(start + batch_size, rows)
+            batch = [torch.from_numpy(np.ascontiguousarray(array[start:stop], dtype=np.float32))
+                     for array in inputs]
+            predictions[start:stop] = model(*batch).reshape(-1).numpy()
+    return predictions
+
+
+def _serving_info(normalizers: Sequence[MinMaxNormalizer], cluster: int, interval: int) -> Dict:
+    """JSON-serializable normalizers and metadata of an exported model."""
+    states = []
+    for normalizer in normalizers:
+        state = normalizer.state_dict()
+        state.update(minimum=state['minimum'].tolist(), maximum=state['maximum'].tolist())
+        states.append(state)
+    return {'cluster': cluster, 'interval': interval, 'normalizers': states}
+
+
+class _OnnxModule:
+    """Callable running an ONNX model with onnxruntime on CPU."""
+
+    def __init__(self, path: str, threads: Optional[int] = None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, *inputs: torch.Tensor) -> torch.Tensor:
+        feeds = {name: tensor.numpy() for name, tensor in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+def export_model(path: str, model: torch.nn.Module, normalizers: Sequence[MinMaxNormalizer],
+                 example_inputs: Sequence[torch.Tensor], cluster: int, interval: int,
+                 export_format: str = 'torchscript') -> None:
+    """
+    Export a trained model and its normalizers for serving.
+
+    TorchScript archives hold the normalizers as an extra file; ONNX models
+    get a JSON sidecar at path + '.json'. ONNX export needs the onnx package.
+
+    Args:
+        path: Output file
+        model: Trained model
+        normalizers: Normalizer of each model input, in input order
+        example_inputs: One batch of model inputs, used for tracing
+        cluster: Cluster of the model
+        interval: Stride over the samples axis the model was trained with
+        export_format: One of EXPORT_FORMATS
+
+    Raises:
+        ValueError: If the format is unknown
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}. Expected one of {EXPORT_FORMATS}")
+    info = json.dumps(_serving_info(normalizers, cluster, interval))
+    model = model.cpu().eval()
+    example_inputs = tuple(tensor.cpu() for tensor in example_inputs)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if export_format == 'onnx':
+        input_names = [f'input{i}' for i in range(len(example_inputs))]
+        torch.onnx.export(model, example_inputs, path, input_names=input_names, output_names=['rul'],
+                          dynamic_axes={name: {0: 'rows'} for name in input_names + ['rul']},
+                          dynamo=False)
+        with open(f'{path}.json', 'w') as f:
+            f.write(info)
+    else:
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(model, example_inputs))
+        torch.jit.save(traced, path, _extra_files={SERVING_INFO_FILE: info})
+
+
+def is_torchscript(path: str) -> bool:
+    """Whether a file is a TorchScript archive rather than a pickled model."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('/constants.pkl') for name in archive.namelist())
+
+
+class ClusterModel:
+    """
+    A trained cluster model with its input scaling.
+    """
+
+    def __init__(self, module: Callable, normalizers: Sequence[MinMaxNormalizer], cluster: int,
+                 interval: int, backend: str = 'eager', trace: bool = False):
+        """
+        Args:
+            module: Model called as module(*inputs)
+            normalizers: Normalizer of each model input
+            cluster: Cluster of the model
+            interval: Stride over the samples axis
+            backend: 'eager', 'torchscript' or 'onnx', for reporting
+            trace: Whether to trace an eager module to TorchScript on its first batch
+        """
+        self.module = module
+        self.normalizers = list(normalizers)
+        self.cluster = cluster
+        self.interval = interval
+        self.backend = backend
+        self.trace = trace
+
+    def _compile(self, inputs: Sequence[torch.Tensor]) -> None:
+        """Replace an eager module by its frozen TorchScript trace."""
+        self.module = torch.jit.freeze(torch.jit.trace(self.module.eval(), tuple(inputs)))
+        self.backend = 'torchscript'
+        self.trace = False
+
+    def predict(self, features: Sequence[np.ndarray], batch_size: int = DEFAULT_BATCH_SIZE,
+                latencies: Optional[List[float]] = None) -> np.ndarray:
+        """
+        Predict the RUL of every row of the (unscaled) feature arrays.
+
+        Args:
+            features: Feature arrays of shape (rows, channels, samples), one per model input
+            batch_size: Rows per batch
+            latencies: List the wall time of every batch (s) is appended to
+
+        Returns:
+            Predictions of shape (rows,)
+        """
+        rows = len(features[0])
+        predictions = np.empty(rows, dtype=np.float32)
+        with torch.inference_mode():
+            for start in range(0, rows, batch_size):
+                stop = min(start + batch_size, rows)
+                begin = time.perf_counter()
+                inputs = scale_inputs(features, self.normalizers, slice(start, stop), self.interval, clip=True)
+                if self.trace:
+                    self._compile(inputs)
+                predictions[start:stop] = self.module(*inputs).reshape(-1).numpy()
+                if latencies is not None:
+                    latencies.append(time.perf_counter() - begin)
+        return predictions
+
+
+def load_cluster_model(path: str, cluster: Optional[int] = None, trace: bool = False,
+                       threads: Optional[int] = None) -> ClusterModel:
+    """
+    Load a model for inference.
+
+    Args:
+        path: TorchScript archive or ONNX file from export_model, or .pth file
+            from normalization.save_model
+        cluster: Cluster of the model, if not stored in the file
+        trace: Whether to trace a .pth model to TorchScript on its first batch
+        threads: Intra-op threads of an ONNX session
+
+    Returns:
+        Model ready for predict
+
+    Raises:
+        ValueError: If the file has no normalizers or no cluster, or is a pickled
+            model whose class cannot be imported
+        ImportError: If an ONNX model is given but onnxruntime is not installed
+    """
+    if path.endswith('.onnx'):
+        with open(f'{path}.json', 'r') as f:
+            info = json.load(f)
+        module, backend = _OnnxModule(path, threads), 'onnx'
+    elif is_torchscript(path):
+        extra_files = {SERVING_INFO_FILE: ''}
+        module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        info, backend = json.loads(extra_files[SERVING_INFO_FILE]), 'torchscript'
+    else:
+        try:
+            module, normalizers, metadata = load_model(path, map_location='cpu')
+        except AttributeError as e:
+            raise ValueError(f"{path} is a pickled model whose class cannot be imported ({e}); "
+                             f"export it with export_model") from e
+        module.eval()
+        info = {'cluster': metadata.get('cluster'), 'interval': metadata.get('interval', 1),
+                'normalizers': [normalizer.state_dict() for normalizer in normalizers]}
+        backend = 'eager'
+
+    normalizers = [MinMaxNormalizer.from_state_dict(state) for state in info['normalizers']]
+    if not normalizers:
+        raise ValueError(f"{path} holds no input normalizers; save the model with save_model")
+    cluster = info.get('cluster') or cluster
+    if cluster is None:
+        raise ValueError(f"{path} does not record its cluster")
+    return ClusterModel(module, normalizers, int(cluster), int(info.get('interval', 1)), backend,
+                        trace=trace and backend == 'eager')
+
+
+def latency_report(latencies: Sequence[float], rows: int, seconds: float) -> Dict:
+    """
+    Throughput and batch latency statistics.
+
+    Args:
+        latencies: Wall time of every batch (s)
+        rows: Rows predicted
+        seconds: Total wall time (s)
+
+    Returns:
+        Dictionary with rows, batches, seconds, rows_per_second and latency_ms
+        (mean, p50, p95, max)
+    """
+    latency = np.asarray(latencies) * 1e3
+    return {
+        'rows': rows,
+        'batches': len(latencies),
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else None,
+        'latency_ms': {
+            'mean': float(latency.mean()) if len(latency) else None,
+            'p50': float(np.percentile(latency, 50)) if len(latency) else None,
+            'p95': float(np.percentile(latency, 95)) if len(latency) else None,
+            'max': float(latency.max()) if len(latency) else None,
+        },
+    }
+
+
+class RULPredictor:
+    """
+    The cluster models, loaded once, serving RUL predictions by batch.
+    """
+
+    def __init__(self, models: Dict[int, ClusterModel]):
+        """
+        Args:
+            models: Model of each cluster
+        """
+        self.models = models
+        self._stores: Dict[str, FeatureStore] = {}
+
+    @classmethod
+    def load(cls, paths: Dict[int, str], trace: bool = False,
+             threads: Optional[int] = None) -> 'RULPredictor':
+        """
+        Load the models of several clusters.
+
+        Args:
+            paths: Model file of each cluster
+            trace: Whether to trace .pth models to TorchScript
+            threads: Intra-op threads of ONNX sessions
+
+        Returns:
+            Predictor
+
+        Raises:
+            ValueError: If a file records a different cluster than it is given for
+        """
+        models = {}
+        for cluster, path in paths.items():
+            model = load_cluster_model(path, cluster, trace, threads)
+            if model.cluster != cluster:
+                raise ValueError(f"{path} holds the model of cluster {model.cluster}, not {cluster}")
+            models[cluster] = model
+        return cls(models)
+
+    def model_for(self, batch_name: str) -> ClusterModel:
+        """
+        Model of a batch's cluster.
+
+        Raises:
+            ValueError: If the batch is unknown or its cluster's model is not loaded
+        """
+        cluster = batch_cluster(batch_name)
+        if cluster not in self.models:
+            raise ValueError(f"No model loaded for cluster {cluster} of {batch_name}")
+        return self.models[cluster]
+
+    def predict(self, batch_name: str, features: Sequence[np.ndarray],
+                batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+        """
+        Predict the RUL of one battery's (unscaled) features.
+
+        Args:
+            batch_name: Batch of the battery, which selects the model
+            features: Feature arrays as returned by extract_feature, without the labels
+            batch_size: Rows per batch
+
+        Returns:
+            Predictions of shape (rows,)
+        """
+        return self.model_for(batch_name).predict(features, batch_size)
+
+    def feature_store(self, store_root: str, cluster: int) -> FeatureStore:
+        """Feature store of a cluster's feature set, opened once."""
+        store_dir = os.path.join(store_root, CLUSTER_FEATURES[cluster].name)
+        if store_dir not in self._stores:
+            self._stores[store_dir] = FeatureStore(store_dir)
+        return self._stores[store_dir]
+
+    def predict_store(self, store_root: str, pairs: Sequence[Tuple[str, int]],
+                      batch_size: int = DEFAULT_BATCH_SIZE
+                      ) -> Tuple[Dict[Tuple[str, int], np.ndarray], Dict]:
+        """
+        Predict the RUL of many batteries from the feature stores.
+
+        The batteries of each cluster are assembled and predicted together.
+
+        Args:
+            store_root: Root directory of the feature stores
+            pairs: (batch, battery) pairs
+            batch_size: Rows per batch
+
+        Returns:
+            Tuple of ({(batch, battery): predictions}, report) where the report
+            holds the latency_report of each cluster and of the whole run
+        """
+        groups: Dict[int, List[Tuple[str, int]]] = {}
+        for batch_name, battery_number in pairs:
+            groups.setdefault(self.model_for(batch_name).cluster, []).append((batch_name, battery_number))
+
+        predictions, report = {}, {'batch_size': batch_size, 'clusters': {}}
+        all_latencies, total_rows = [], 0
+        start = time.perf_counter()
+        for cluster, group in sorted(groups.items()):
+            model, store = self.models[cluster], self.feature_store(store_root, cluster)
+            latencies = []
+            cluster_start = time.perf_counter()
+            *features, _ = store.assemble(group)
+            rows = model.predict(features, batch_size, latencies)
+            seconds = time.perf_counter() - cluster_start
+
+            offsets = store.offsets(group)
+            for pair, begin, end in zip(group, offsets[:-1], offsets[1:]):
+                predictions[pair] = rows[begin:end]
+            report['clusters'][str(cluster)] = dict(latency_report(latencies, len(rows), seconds),
+                                                    batteries=len(group), backend=model.backend)
+            all_latencies += latencies
+            total_rows += len(rows)
+        report['total'] = latency_report(all_latencies, total_rows, time.perf_counter() - start)
+        return predictions, report
+
+
+def main():
+    """
+    Command-line entry point for batch inference
+    """
+    parser = argparse.ArgumentParser(description="Predict battery RUL with the trained Cluster models")
+    parser.add_argument('store', help="Root directory of the feature stores")
+    parser.add_argument('--model', nargs=2, action='append', metavar=('CLUSTER', 'PATH'), required=True,
+                        help="Model file of a cluster (repeat for each cluster)")
+    parser.add_argument('--batches', nargs='+', help="Batches to predict (all in the stores if omitted)")
+    parser.add_argument('--batteries', type=int, nargs='+', help="Battery indexes to predict (all if omitted)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Rows per batch")
+    parser.add_argument('--trace', action='store_true', help="Trace .pth models to TorchScript")
+    parser.add_argument('--threads', type=int, help="Torch intra-op threads (all available cores if omitted)")
+    parser.add_argument('--output', help="Write the predictions to this .npz file")
+    parser.add_argument('--report', help="Write the throughput and latency report to this JSON file")
+    args = parser.parse_args()
+
+    threads, _ = configure_threads(args.threads)
+    predictor = RULPredictor.load({int(cluster): path for cluster, path in args.model}, args.trace, threads)
+
+    pairs = []
+    for cluster in sorted(predictor.models):
+        for batch_name, battery_number in predictor.feature_store(args.store, cluster).entries:
+            if (batch_cluster(batch_name) == cluster
+                    and (args.batches is None or batch_name in args.batches)
+                    and (args.batteries is None or battery_number in args.batteries)):
+                pairs.append((batch_name, battery_number))
+
+    predictions, report = predictor.predict_store(args.store, pairs, args.batch_size)
+    report['threads'] = threads
+
+    for cluster, stats in report['clusters'].items():
+        print(f"Cluster {cluster} ({stats['backend']}): {stats['batteries']} batteries, {stats['rows']} rows, "
+              f"{stats['rows_per_second']:.0f} rows/s, latency p50 {stats['latency_ms']['p50']:.2f} ms, "
+              f"p95 {stats['latency_ms']['p95']:.2f} ms")
+    total = report['total']
+    if total['rows']:
+        print(f"Total: {total['rows']} rows in {total['seconds']:.3f} s ({total['rows_per_second']:.0f} rows/s)")
+
+    if args.output:
+        np.savez(args.output, **{f'{batch_name}_{battery_number}': rows
+                                 for (batch_name, battery_number), rows in predictions.items()})
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Normalization
+=============
+
+Per-channel min-max scaling of the feature tensors for the Cluster RUL models.
+
+The statistics are the minimum and maximum of every channel over all rows and
+samples of the training split, and features are scaled to [-1, 1] as
+
+    2 * (x - min) / (max - min) - 1
+
+which gives the same values as the ``max_discharge_feature`` and
+``min_discharge_feature`` arrays the notebooks used to compute. Test
+features are clipped to [-1, 1] afterwards.
+
+``MinMaxNormalizer`` is fitted incrementally with ``partial_fit``, e.g. over
+the batteries of a feature store, so the statistics never need the training
+split in memory. ``transform`` scales in place when given ``out``; the
+``NormalizedFeatureDataset`` scales rows on the fly as a DataLoader fetches
+them, so no scaled copy of a split is kept.
+
+The statistics are saved in the same file as the trained model with
+``save_model`` and restored with ``load_model``, so inference uses exactly
+the scaling the model was trained with.
+"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# Scaled feature range
+DEFAULT_RANGE = (-1.0, 1.0)
+
+# Rows per chunk when fitting a whole array
+DEFAULT_CHUNK_ROWS = 1024
+
+# Format of the files written by save_model
+MODEL_FORMAT_VERSION = 1
+
+
+class MinMaxNormalizer:
+    """
+    Per-channel min-max scaler for arrays of shape (rows, channels, samples).
+    """
+
+    def __init__(self, low: float = DEFAULT_RANGE[0], high: float = DEFAULT_RANGE[1]):
+        """
+        Initialize an unfitted normalizer.
+
+        Args:
+            low: Scaled value of the channel minimum
+            high: Scaled value of the channel maximum
+        """
+        self.low = low
+        self.high = high
+        self.minimum: Optional[np.ndarray] = None
+        self.maximum: Optional[np.ndarray] = None
+
+    @property
+    def fitted(self) -> bool:
+        """Whether statistics have been fitted or loaded."""
+        return self.minimum is not None
+
+    def partial_fit(self, chunk: np.ndarray) -> 'MinMaxNormalizer':
+        """
+        Update the statistics with a chunk of rows.
+
+        Args:
+            chunk: Array of shape (rows, channels, ...), e.g. a memory-mapped slice
+
+        Returns:
+            self
+
+        Raises:
+            ValueError: If the number of channels differs from earlier chunks
+        """
+        if len(chunk) == 0:
+            return self
+        axes = (0, *range(2, chunk.ndim))
+        minimum, maximum = np.min(chunk, axis=axes), np.max(chunk, axis=axes)
+
+        if self.minimum is None:
+            self.minimum, self.maximum = minimum, maximum
+        elif minimum.shape != self.minimum.shape:
+            raise ValueError(f"Chunk has {minimum.shape[0]} channels, expected {self.minimum.shape[0]}")
+        else:
+            np.minimum(self.minimum, minimum, out=self.minimum)
+            np.maximum(self.maximum, maximum, out=self.maximum)
+        return self
+
+    def fit_chunks(self, chunks: Iterable[np.ndarray]) -> 'MinMaxNormalizer':
+        """
+        Fit the statistics over a stream of chunks.
+
+        Args:
+            chunks: Arrays of shape (rows, channels, ...), e.g. the batteries of a split
+
+        Returns:
+            self
+        """
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def fit(self, data: np.ndarray, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> 'MinMaxNormalizer':
+        """
+        Fit the statistics of a whole array, chunk_rows rows at a time.
+
+        Args:
+            data: Array of shape (rows, channels, ...)
+            chunk_rows: Rows per chunk
+
+        Returns:
+            self
+        """
+        return self.fit_chunks(data[start:start + chunk_rows] for start in range(0, len(data), chunk_rows))
+
+    def _statistics(self, ndim: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Minimum and range, shaped to broadcast against an array with ndim axes."""
+        if not self.fitted:
+            raise RuntimeError("MinMaxNormalizer is not fitted")
+        shape = (-1,) + (1,) * (ndim - 2)
+        return self.minimum.reshape(shape), (self.maximum - self.minimum).reshape(shape)
+
+    def transform(self, data: np.ndarray, out: Optional[np.ndarray] = None, clip: bool = False) -> np.ndarray:
+        """
+        Scale features channel by channel.
+
+        Args:
+            data: Array of shape (rows, channels, ...)
+            out: Output array, which may be data itself to scale in place
+            clip: Whether to clip the result to the scaled range, as for test features
+
+        Returns:
+            Scaled array (out if given)
+
+        Raises:
+            RuntimeError: If the normalizer is not fitted
+        """
+        minimum, span = self._statistics(data.ndim)
+        out = np.subtract(data, minimum, out=out)
+        out *= self.high - self.low
+        out /= span
+        out += self.low
+        if clip:
+            np.clip(out, self.low, self.high, out=out)
+        return out
+
+    def state_dict(self) -> Dict:
+        """
+        Statistics and range as plain values for serialization.
+
+        Returns:
+            Dictionary accepted by from_state_dict
+        """
+        return {'low': self.low, 'high': self.high, 'minimum': self.minimum, 'maximum': self.maximum}
+
+    @classmethod
+    def from_state_dict(cls, state: Dict) -> 'MinMaxNormalizer':
+        """
+        Restore a normalizer saved with state_dict.
+
+        Args:
+            state: Dictionary from state_dict
+
+        Returns:
+            Normalizer with the saved statistics
+        """
+        normalizer = cls(state['low'], state['high'])
+        if state['minimum'] is not None:
+            normalizer.minimum = np.asarray(state['minimum'], dtype=float)
+            normalizer.maximum = np.asarray(state['maximum'], dtype=float)
+        return normalizer
+
+
+def scale_inputs(features: Sequence[np.ndarray], normalizers: Sequence[Optional[MinMaxNormalizer]], rows,
+                 interval: int = 1, clip: bool = False) -> List[torch.Tensor]:
+    """
+    Scale some rows of the feature arrays into model inputs.
+
+    Args:
+        features: Feature arrays of shape (rows, channels, samples), one per model input
+        normalizers: Fitted normalizer of each feature array, or None for arrays
+            that are already scaled
+        rows: Rows to read (slice, index list or array)
+        interval: Stride over the samples axis
+        clip: Whether to clip the scaled inputs, as for test features
+
+    Returns:
+        Float32 inputs of shape (rows, 1, channels, samples / interval)
+    """
+    inputs = []
+    for array, normalizer in zip(features, normalizers):
+        data = array[rows][:, :, ::interval]
+        if normalizer is not None:
+            data = np.array(data, dtype=float)
+            normalizer.transform(data, out=data, clip=clip)
+        inputs.append(torch.from_numpy(data.astype(np.float32))[:, None])
+    return inputs
+
+
+class NormalizedFeatureDataset(Dataset):
+    """
+    Model inputs scaled on the fly from (possibly memory-mapped) feature arrays.
+
+    Each item is (input_1, ..., input_k, label) with inputs of shape
+    (1, channels, samples / interval) as float32, like the tensors the
+    notebooks built from the scaled split. Batched fetches scale all rows of
+    the batch at once. Without normalizers, the arrays are taken as already
+    scaled and only converted.
+    """
+
+    def __init__(self, features: Sequence[np.ndarray], labels: np.ndarray,
+                 normalizers: Optional[Sequence[MinMaxNormalizer]] = None, interval: int = 1,
+                 clip: bool = False):
+        """
+        Args:
+            features: Feature arrays of shape (rows, channels, samples), one per model input
+            labels: RUL labels of shape (rows, 1)
+            normalizers: Fitted normalizer of each feature array (None if the
+                arrays are already scaled)
+            interval: Stride over the samples axis
+            clip: Whether to clip the scaled inputs, as for test features
+
+        Raises:
+            ValueError: If the arrays and normalizers do not match
+        """
+        if normalizers is None:
+            normalizers = [None] * len(features)
+        if len(features) != len(normalizers):
+            raise ValueError(f"{len(features)} feature arrays but {len(normalizers)} normalizers")
+        if any(len(array) != len(labels) for array in features):
+            raise ValueError("Feature arrays and labels have different numbers of rows")
+        self.features = features
+        self.labels = labels
+        self.normalizers = normalizers
+        self.interval = interval
+        self.clip = clip
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, ...]:
+        inputs = scale_inputs(self.features, self.normalizers, [index], self.interval, self.clip)
+        label = torch.tensor(self.labels[index], dtype=torch.float32)
+        return (*(tensor[0] for tensor in inputs), label)
+
+    def __getitems__(self, indices: Sequence[int]) -> List[Tuple[torch.Tensor, ...]]:
+        """Fetch and scale a whole batch at once (used by DataLoader)."""
+        inputs = scale_inputs(self.features, self.normalizers, np.asarray(indices), self.interval,
+                              self.clip)
+        labels = torch.tensor(self.labels[np.asarray(indices)], dtype=torch.float32)
+        return list(zip(*inputs, labels))
+
+
+def save_model(path: str, model: torch.nn.Module, normalizers: Sequence[MinMaxNormalizer], **metadata) -> None:
+    """
+    Save a trained model together with its input normalizers.
+
+    Args:
+        path: Output .pth file
+        model: Trained model
+        normalizers: Normalizer of each model input, in input order
+        **metadata: Extra values to store, e.g. the cluster and the sample interval
+    """
+    torch.save({'format': MODEL_FORMAT_VERSION, 'model': model,
+                'normalizers': [normalizer.state_dict() for normalizer in normalizers],
+                'metadata': metadata}, path)
+
+
+def load_model(path: str, map_location='cpu') -> Tuple[torch.nn.Module, List[MinMaxNormalizer], Dict]:
+    """
+    Load a model saved with save_model.
+
+    Files holding only a pickled model, as saved by earlier notebook versions,
+    load with no normalizers. The model's class must be importable.
+
+    Args:
+        path: .pth file
+        map_location: Device to load the tensors to
+
+    Returns:
+        Tuple of (model, normalizers, metadata)
+    """
+    saved = torch.load(path, map_location=map_location, weights_only=False)
+    if isinstance(saved, torch.nn.Module):
+        return saved, [], {}
+    normalizers = [MinMaxNormalizer.from_state_dict(state) for state in saved['normalizers']]
+    return saved['model'], normalizers, saved.get('metadata', {})
@@ -0,0 +1,359 @@
+"""
+Training
+========
+
+Training engine for the Cluster RUL models on CPU-only hosts.
+
+``train_model`` replaces the notebooks' hand-written epoch loop. It
+
+    - trains with Adam on the MSE of the predicted RUL, reading shuffled
+      batches from a DataLoader with optional worker processes and pinned
+      memory (see ``make_loader``),
+    - evaluates a validation split after every epoch and stops when the
+      validation loss has not improved by more than ``min_delta`` for
+      ``patience`` epochs, restoring the best weights,
+    - writes a checkpoint every ``checkpoint_every`` epochs (and when it
+      stops), from which an interrupted run resumes with ``resume=True``.
+
+A checkpoint records a digest of the run: the model's parameter shapes, the
+optimizer and early-stopping settings, the loaders' batch sizes and row
+counts, and the caller's ``run_info`` (e.g. ``split_info`` of the train and
+validation batteries and their feature digests). A checkpoint of another
+run is refused rather than resumed. The epoch budget is not part of the
+digest, so a finished run can be resumed with more epochs.
+
+The model is called as ``model(*inputs)`` with the inputs of a batch in
+order, so it works with the one-input Net of cluster 1 and the two-input
+Net of clusters 2 and 3. Nothing is cleaned up between epochs: batches are
+released as the loop moves on, and there is no CUDA cache to empty on CPU.
+
+``configure_threads`` sizes torch's intra-op and inter-op thread pools to
+the cores available to the process; loader workers run single-threaded.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+from feature_store import FeatureStore, entry_key
+from normalization import MinMaxNormalizer, NormalizedFeatureDataset
+
+# Stop reasons
+STOP_MAX_EPOCHS = 'max_epochs'
+STOP_NO_IMPROVEMENT = 'no_improvement'
+
+# Format of the checkpoints written by train_model
+CHECKPOINT_FORMAT_VERSION = 1
+
+# Default training settings
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_LOG_EVERY = 10
+
+
+class TrainingResult(NamedTuple):
+    """Loss history and outcome of a training run."""
+    train_loss: List[float]
+    val_loss: List[float]
+    best_epoch: int
+    best_val_loss: float
+    epochs: int
+    stop_reason: str
+
+
+def available_cores() -> int:
+    """Number of CPU cores the process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_threads(num_threads: Optional[int] = None, interop_threads: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Size torch's CPU thread pools.
+
+    The inter-op pool can only be sized before torch runs its first parallel
+    operation; later calls keep its current size.
+
+    Args:
+        num_threads: Intra-op threads (all available cores if None)
+        interop_threads: Inter-op threads (unchanged if None)
+
+    Returns:
+        Tuple of (intra-op, inter-op) thread counts in effect
+    """
+    torch.set_num_threads(num_threads or available_cores())
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def _init_worker(worker_id: int) -> None:
+    """Keep DataLoader workers single-threaded so they do not oversubscribe the cores."""
+    torch.set_num_threads(1)
+
+
+def split_pairs(pairs: Sequence[Tuple[str, int]], validation_fraction: float,
+                seed: Optional[int] = 0) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """
+    Hold out whole batteries of a training split for validation.
+
+    Splitting by battery rather than by row keeps the cycles of a validation
+    battery out of training.
+
+    Args:
+        pairs: (batch, battery) pairs of the training split
+        validation_fraction: Fraction of the batteries to hold out (at least one if > 0)
+        seed: Seed of the random choice
+
+    Returns:
+        Tuple of (training pairs, validation pairs), each in the original order
+    """
+    count = int(round(len(pairs) * validation_fraction))
+    if validation_fraction > 0:
+        count = min(max(count, 1), len(pairs) - 1)
+    held_out = set(np.random.default_rng(seed).choice(len(pairs), count, replace=False).tolist())
+    return ([pair for i, pair in enumerate(pairs) if i not in held_out],
+            [pair for i, pair in enumerate(pairs) if i in held_out])
+
+
+def pair_rows(store: FeatureStore, pairs: Sequence[Tuple[str, int]],
+              subset: Sequence[Tuple[str, int]]) -> np.ndarray:
+    """
+    Rows of some batteries within a split assembled from a feature store.
+
+    Args:
+        store: Feature store the split was assembled from
+        pairs: (batch, battery) pairs the split was assembled from, in order
+        subset: Pairs whose rows are wanted, e.g. the training part of split_pairs
+
+    Returns:
+        Row indexes into the assembled split, in the order of pairs
+    """
+    offsets = store.offsets(pairs)
+    wanted = set(subset)
+    return np.concatenate([np.arange(begin, end, dtype=int)
+                           for pair, begin, end in zip(pairs, offsets[:-1], offsets[1:]) if pair in wanted]
+                          + [np.empty(0, dtype=int)])
+
+
+def make_loader(split: Sequence[np.ndarray], normalizers: Optional[Sequence[MinMaxNormalizer]] = None,
+                interval: int = 1, batch_size: int = DEFAULT_BATCH_SIZE, shuffle: bool = False,
+                clip: bool = False, rows: Optional[np.ndarray] = None, num_workers: int = 0,
+                pin_memory: bool = False, seed: Optional[int] = None) -> DataLoader:
+    """
+    DataLoader of scaled model inputs and labels from an assembled split.
+
+    The split's arrays are read in place; no copy of them is made.
+
+    Args:
+        split: Feature arrays and labels, as returned by FeatureStore.assemble
+        normalizers: Fitted normalizer of each feature array, or None if the
+            arrays are already scaled
+        interval: Stride over the samples axis
+        batch_size: Rows per batch
+        shuffle: Whether to reshuffle the rows every epoch
+        clip: Whether to clip the scaled inputs, as for test features
+        rows: Rows of the split to load, e.g. from pair_rows (all rows if None)
+        num_workers: Worker processes that fetch batches (0 fetches in the main process)
+        pin_memory: Whether to pin batches in page-locked memory; only used when
+            CUDA is available, as it only speeds up copies to a GPU
+        seed: Seed of the shuffling order
+
+    Returns:
+        DataLoader yielding (input_1, ..., input_k, label) batches
+    """
+    *features, labels = split
+    dataset = NormalizedFeatureDataset(features, labels, normalizers, interval, clip)
+    if rows is not None:
+        dataset = Subset(dataset, rows.tolist())
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, generator=generator,
+                      num_workers=num_workers, pin_memory=pin_memory and torch.cuda.is_available(),
+                      persistent_workers=num_workers > 0,
+                      worker_init_fn=_init_worker if num_workers > 0 else None)
+
+
+def evaluate_loss(model: nn.Module, loader: DataLoader, device='cpu') -> float:
+    """
+    Mean squared error of the model over a loader.
+
+    Args:
+        model: Model to evaluate
+        loader: DataLoader yielding (input_1, ..., input_k, label) batches
+        device: Device the model is on
+
+    Returns:
+        MSE per row
+    """
+    model.eval()
+    total, rows = 0.0, 0
+    with torch.no_grad():
+        for *inputs, labels in loader:
+            prediction = model(*(tensor.to(device) for tensor in inputs))
+            total += nn.functional.mse_loss(prediction, labels.to(device).reshape(-1, 1),
+                                            reduction='sum').item()
+            rows += len(labels)
+    return total / max(rows, 1)
+
+
+def split_info(store: FeatureStore, train_pairs: Sequence[Tuple[str, int]],
+               val_pairs: Sequence[Tuple[str, int]] = (), **settings) -> Dict:
+    """
+    Description of a run's data for the checkpoint digest of train_model.
+
+    Args:
+        store: Feature store the splits come from
+        train_pairs: (batch, battery) pairs trained on
+        val_pairs: (batch, battery) pairs validated on
+        **settings: Other settings the run depends on, e.g. the sample interval
+
+    Returns:
+        JSON-serializable dictionary of the pairs, the digests of their
+        features and the settings
+    """
+    def describe(pairs):
+        return [[batch_name, battery_number, store.index['entries'][entry_key(batch_name, battery_number)]['digest']]
+                for batch_name, battery_number in pairs]
+
+    return {'store': store.index['settings'], 'train': describe(train_pairs), 'val': describe(val_pairs),
+            'settings': settings}
+
+
+def _run_digest(model: nn.Module, train_loader: DataLoader, val_loader: Optional[DataLoader],
+                settings: Dict, run_info: Optional[Dict]) -> str:
+    """Digest identifying a training run, stored in and checked against its checkpoints."""
+    description = {
+        'model': type(model).__name__,
+        'parameters': [[name, list(parameter.shape)] for name, parameter in model.state_dict().items()],
+        'train': [train_loader.batch_size, len(train_loader.dataset)],
+        'val': [val_loader.batch_size, len(val_loader.dataset)] if val_loader is not None else None,
+        'settings': settings,
+        'run_info': run_info,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _save_checkpoint(path: str, state: Dict) -> None:
+    """Write a checkpoint atomically, so an interruption never leaves a partial file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(state, f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+
+
+def train_model(model: nn.Module, train_loader: DataLoader, val_loader: Optional[DataLoader] = None,
+                epochs: int = 5000, lr: float = 0.0005, patience: Optional[int] = None,
+                min_delta: float = 0.0, restore_best: bool = True,
+                checkpoint_path: Optional[str] = None, checkpoint_every: int = 50,
+                resume: bool = False, run_info: Optional[Dict] = None, device='cpu',
+                log_every: Optional[int] = DEFAULT_LOG_EVERY) -> TrainingResult:
+    """
+    Train a model with Adam on the MSE of the predicted RUL.
+
+    Args:
+        model: Model to train (updated in place)
+        train_loader: Training batches (input_1, ..., input_k, label)
+        val_loader: Validation batches; early stopping and best-weight restoring
+            need one
+        epochs: Maximum number of epochs
+        lr: Learning rate
+        patience: Epochs without a validation improvement before stopping
+            (never stops early if None)
+        min_delta: Minimum decrease of the validation loss that counts as an improvement
+        restore_best: Whether to load the weights of the best validation epoch at the end
+        checkpoint_path: Checkpoint file (no checkpoints if None)
+        checkpoint_every: Epochs between checkpoints
+        resume: Whether to continue from checkpoint_path if it exists
+        run_info: Description of the run's data and settings, e.g. from split_info;
+            a checkpoint is only resumed if it was written for the same run
+        device: Device to train on
+        log_every: Epochs between progress lines (silent if None)
+
+    Returns:
+        Loss history (MSE per row) and outcome
+
+    Raises:
+        ValueError: If a resumed checkpoint has an unsupported format or was
+            written by a different run
+    """
+    model.to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    loss_func = nn.MSELoss()
+
+    digest = _run_digest(model, train_loader, val_loader,
+                         {'lr': lr, 'patience': patience, 'min_delta': min_delta, 'restore_best': restore_best},
+                         run_info)
+    state = {'epoch': 0, 'train_loss': [], 'val_loss': [], 'best_epoch': 0,
+             'best_val_loss': float('inf'), 'best_model': None, 'since_improvement': 0}
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+        if checkpoint.get('format') != CHECKPOINT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported checkpoint format: {checkpoint.get('format')}")
+        if checkpoint.get('run_digest') != digest:
+            raise ValueError(f"{checkpoint_path} was written by a different run (model, settings or data "
+                             f"changed); remove it or train with resume=False")
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        torch.set_rng_state(checkpoint['rng_state'])
+        state.update(checkpoint['progress'])
+        print(f"Resuming from epoch {state['epoch']} of {checkpoint_path}")
+
+    def checkpoint():
+        if checkpoint_path is not None:
+            _save_checkpoint(checkpoint_path, {
+                'format': CHECKPOINT_FORMAT_VERSION, 'run_digest': digest, 'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(), 'rng_state': torch.get_rng_state(),
+                'progress': state})
+
+    stop_reason = STOP_MAX_EPOCHS
+    start = time.perf_counter()
+    while state['epoch'] < epochs:
+        model.train()
+        total, rows = 0.0, 0
+        for *inputs, labels in train_loader:
+            optimizer.zero_grad()
+            prediction = model(*(tensor.to(device, non_blocking=True) for tensor in inputs))
+            loss = loss_func(prediction, labels.to(device, non_blocking=True).reshape(-1, 1))
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(labels)
+            rows += len(labels)
+        state['epoch'] += 1
+        state['train_loss'].append(total / max(rows, 1))
+
+        if val_loader is not None:
+            val_loss = evaluate_loss(model, val_loader, device)
+            state['val_loss'].append(val_loss)
+            if val_loss < state['best_val_loss'] - min_delta:
+                state.update(best_epoch=state['epoch'], best_val_loss=val_loss, since_improvement=0,
+                             best_model=copy.deepcopy(model.state_dict()))
+            else:
+                state['since_improvement'] += 1
+
+        if log_every and state['epoch'] % log_every == 0:
+            message = f"{state['epoch']} train {state['train_loss'][-1]:.4f}"
+            if val_loader is not None:
+                message += f" val {state['val_loss'][-1]:.4f}"
+            print(f"{message} ({time.perf_counter() - start:.1f} s)")
+
+        if patience is not None and val_loader is not None and state['since_improvement'] >= patience:
+            stop_reason = STOP_NO_IMPROVEMENT
+            break
+        if state['epoch'] % checkpoint_every == 0:
+            checkpoint()
+    checkpoint()
+
+    if restore_best and state['best_model'] is not None:
+        model.load_state_dict(state['best_model'])
+    return TrainingResult(state['train_loss'], state['val_loss'], state['best_epoch'],
+                          state['best_val_loss'], state['epoch'], stop_reason)
@@ -0,0 +1,222 @@
+"""
+Batch Evaluation
+================
+
+Batched, parallel objective evaluation for the Bayesian optimization in
+``estimate_params``.
+
+``bo.maximize`` proposes and evaluates one point at a time. Here every round
+proposes ``batch_size`` points at once: after each proposal the GP is refit
+with a fantasy observation at the proposed point, so the next proposal moves
+elsewhere. The fantasy value is either
+
+    - ``constant_liar``: the worst target observed so far, or
+    - ``kriging_believer``: the GP posterior mean at the point.
+
+The points of a round are evaluated concurrently on an ``EvaluationPool`` and
+the real targets are registered with the optimizer together. The objective is
+pickled with every task, so each worker simulates on its own copy of the
+battery model.
+
+``maximize_batched`` also serves as the sequential loop (``batch_size=1``)
+when early-stopping criteria are enabled, since ``bo.maximize`` cannot be
+stopped between iterations.
+"""
+
+import copy
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from bayes_opt.util import acq_max
+
+from early_stopping import EarlyStopping
+import profiling
+
+# Fantasy-value strategies for batch proposals
+BATCH_STRATEGIES = ('constant_liar', 'kriging_believer')
+
+
+class EvaluationPool:
+    """
+    Process pool evaluating objective functions at many points concurrently.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        """
+        Initialize the pool; worker processes start on first use.
+
+        Args:
+            workers: Number of worker processes (number of CPUs if None)
+        """
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+
+    def evaluate(self, objective: Callable[[Dict[str, float]], float],
+                 points: Sequence[Dict[str, float]]) -> List[float]:
+        """
+        Evaluate a picklable objective at several points.
+
+        Args:
+            objective: Callable mapping a parameter dictionary to a target value
+            points: Parameter dictionaries to evaluate
+
+        Returns:
+            Target values in the order of the points
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return list(self._executor.map(objective, points))
+
+    def close(self) -> None:
+        """Shut down the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def fit_gp(bo) -> None:
+    """
+    Fit the optimizer's own GP on its real observations, as ``bo.suggest`` does.
+
+    Args:
+        bo: BayesianOptimization instance with at least one registered observation
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        bo._gp.fit(bo._space.params, bo._space.target)
+
+
+def suggest_batch(bo, acquisition_function, batch_size: int,
+                  strategy: str = 'constant_liar') -> Tuple[List[Dict[str, float]], float]:
+    """
+    Propose several points to evaluate in parallel.
+
+    Like ``bo.suggest``, the optimizer's GP is fitted on the real observations.
+    Fantasy observations only go into a copy of it, whose kernel
+    hyperparameters are kept fixed while fantasizing.
+
+    Args:
+        bo: BayesianOptimization instance with at least one registered observation
+        acquisition_function: UtilityFunction to maximize
+        batch_size: Number of points to propose
+        strategy: Fantasy-value strategy, one of BATCH_STRATEGIES
+
+    Returns:
+        Tuple of (list of parameter dictionaries, acquisition value of the first
+        point), the latter being the acquisition maximum given the real observations
+
+    Raises:
+        ValueError: If the strategy is unknown
+    """
+    if strategy not in BATCH_STRATEGIES:
+        raise ValueError(f"Unknown batch strategy: {strategy}. Expected one of {BATCH_STRATEGIES}")
+
+    space = bo._space
+    params = space.params.copy()
+    target = space.target.copy()
+
+    # Fit hyperparameters on real data only
+    fit_gp(bo)
+    gp = copy.deepcopy(bo._gp)
+    gp.set_params(kernel=gp.kernel_, optimizer=None)
+    points = []
+    for i in range(batch_size):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            gp.fit(params, target)
+
+        x = acq_max(ac=acquisition_function.utility, gp=gp, y_max=target.max(),
+                    bounds=space.bounds, random_state=bo._random_state,
+                    y_max_params=params[target.argmax()])
+        if i == 0:
+            acquisition_max = float(acquisition_function.utility(x.reshape(1, -1), gp, target.max())[0])
+
+        # Never propose a point twice
+        if x in space or any(np.array_equal(x, p) for p in points):
+            x = space.random_sample()
+
+        if strategy == 'constant_liar':
+            lie = target.min()
+        else:
+            lie = gp.predict(x.reshape(1, -1))[0]
+
+        points.append(x)
+        params = np.vstack([params, x])
+        target = np.append(target, lie)
+
+    return [space.array_to_params(x) for x in points], acquisition_max
+
+
+def maximize_batched(bo, evaluate: Callable[[List[Dict[str, float]]], List[float]],
+                     acquisition_function, init_points: int, n_iter: int, batch_size: int,
+                     strategy: str = 'constant_liar',
+                     initial_points: Sequence[Dict[str, float]] = (),
+                     on_observation: Optional[Callable[[Dict[str, float], float], None]] = None,
+                     early_stopping: Optional[EarlyStopping] = None) -> None:
+    """
+    Batched counterpart of ``bo.maximize``.
+
+    Evaluates the given initial points and ``init_points`` random points, then
+    ``n_iter`` acquisition-guided points, ``batch_size`` at a time. Afterwards
+    the optimizer's GP is fitted on all observations, so its kernel can be
+    reused like after ``bo.maximize`` (e.g. by WarmStart).
+
+    Args:
+        bo: BayesianOptimization instance
+        evaluate: Function returning the targets of a list of points
+        acquisition_function: UtilityFunction to maximize
+        init_points: Number of random initial points
+        n_iter: Number of acquisition-guided points
+        batch_size: Number of points evaluated per round
+        strategy: Fantasy-value strategy, one of BATCH_STRATEGIES
+        initial_points: Points to evaluate before the random ones (e.g. warm-start seeds)
+        on_observation: Callback receiving (params, target) after every evaluation
+        early_stopping: Stopping criteria, checked before every round (runs the full
+            budget if None)
+    """
+    def register(points: List[Dict[str, float]]) -> None:
+        for params, target in zip(points, evaluate(points)):
+            bo.register(params=params, target=target)
+            if on_observation is not None:
+                on_observation(params, target)
+            if early_stopping is not None:
+                early_stopping.observe(target)
+
+    def should_stop(acquisition_max: Optional[float] = None, guided: bool = True) -> bool:
+        return early_stopping is not None and early_stopping.check(acquisition_max, guided) is not None
+
+    start_points = list(initial_points)
+    start_points += [bo._space.array_to_params(bo._space.random_sample()) for _ in range(init_points)]
+    if not start_points and not len(bo._space) and n_iter:
+        # The GP needs at least one observation
+        start_points.append(bo._space.array_to_params(bo._space.random_sample()))
+        n_iter -= 1
+
+    for i in range(0, len(start_points), batch_size):
+        if should_stop(guided=False):
+            break
+        register(start_points[i:i + batch_size])
+    else:
+        remaining = n_iter
+        while remaining > 0 and not should_stop():
+            acquisition_function.update_params()
+            with profiling.stage('gp_suggest'):
+                points, acquisition_max = suggest_batch(bo, acquisition_function, min(batch_size, remaining),
+                                                        strategy)
+            if should_stop(acquisition_max):
+                break
+            register(points)
+            remaining -= len(points)
+
+    if len(bo._space):
+        with profiling.stage('gp_suggest'):
+            fit_gp(bo)
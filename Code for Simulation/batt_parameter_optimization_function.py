@@ -5,16 +5,17 @@ This module implements battery parameter estimation using Bayesian optimization
 for different battery working conditions and batches.
 """
 
+import copy
+import threading
 import warnings
 import os
-from collections import abc
+from collections import OrderedDict, abc
 from numbers import Number
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, Union, Callable, Sequence
 
 import numpy as np
-import scipy.io
-import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
+from matplotlib.figure import Figure
+from scipy.interpolate import interp1d, make_interp_spline
 
 # Third-party libraries
 from bayes_opt import BayesianOptimization, UtilityFunction
@@ -23,9 +24,35 @@ from progpy.loading import Piecewise
 from progpy.state_estimators import UnscentedKalmanFilter
 from progpy.utils.containers import InputContainer, OutputContainer
 
+from adaptive_discharge import DEFAULT_METHOD, DEFAULT_RTOL, simulate_adaptive
+from batch_evaluation import BATCH_STRATEGIES, EvaluationPool, maximize_batched
+from battery_dataset import (BATCH_WORKING_CONDITIONS, SIMULATION_CHANNELS, RetiredBatteryDataset, open_dataset,
+                             working_condition)
+from discharge_surrogate import DischargeSurrogate
+from early_stopping import EarlyStopping
+import profiling
+from reference_state_cache import ReferenceStateCache, dataset_fingerprint
+from result_sink import KEY_PARAMETER_HEADER, ResultSink
+from warm_start import WarmStart
+
 # Suppress warnings
 warnings.filterwarnings('ignore')
 
+# Process-wide cache of batch21 reference initial states
+DEFAULT_REFERENCE_CACHE = ReferenceStateCache()
+
+# Per-process caches backed by a shared cache directory, keyed by directory
+_DIRECTORY_REFERENCE_CACHES: Dict[str, ReferenceStateCache] = {}
+
+# Time stepping modes of DischargeSimulator
+STEPPING_MODES = ('fixed', 'adaptive')
+
+# Parameter models of a joint fit over several cycles
+JOINT_MODES = ('shared', 'linear')
+
+# Parameters fitted per cycle
+OPTIMIZATION_KEYS = ('qMax', 'Ro', 'wr')
+
 
 class BatteryParameterEstimator:
     """
@@ -33,29 +60,7 @@ class BatteryParameterEstimator:
     """
 
     # Battery working condition configurations
-    BATCH_CONFIGS = {
-        'batch01': {'Mid_SOC': 0.8, 'DOD': 0.2},
-        'batch02': {'Mid_SOC': 0.7, 'DOD': 0.2},
-        'batch03': {'Mid_SOC': 0.5, 'DOD': 0.2},
-        'batch04': {'Mid_SOC': 0.4, 'DOD': 0.2},
-        'batch05': {'Mid_SOC': 0.3, 'DOD': 0.2},
-        'batch06': {'Mid_SOC': 0.2, 'DOD': 0.2},
-        'batch07': {'Mid_SOC': 0.75, 'DOD': 0.3},
-        'batch08': {'Mid_SOC': 0.6, 'DOD': 0.3},
-        'batch09': {'Mid_SOC': 0.5, 'DOD': 0.3},
-        'batch10': {'Mid_SOC': 0.45, 'DOD': 0.3},
-        'batch11': {'Mid_SOC': 0.7, 'DOD': 0.4},
-        'batch12': {'Mid_SOC': 0.55, 'DOD': 0.4},
-        'batch13': {'Mid_SOC': 0.5, 'DOD': 0.4},
-        'batch14': {'Mid_SOC': 0.4, 'DOD': 0.4},
-        'batch15': {'Mid_SOC': 0.3, 'DOD': 0.4},
-        'batch16': {'Mid_SOC': 0.5, 'DOD': 0.5},
-        'batch17': {'Mid_SOC': 0.35, 'DOD': 0.5},
-        'batch18': {'Mid_SOC': 0.5, 'DOD': 0.6},
-        'batch19': {'Mid_SOC': 0.5, 'DOD': 0.7},
-        'batch20': {'Mid_SOC': 0.5, 'DOD': 0.8},
-        'batch21': {'Mid_SOC': 0.5, 'DOD': 1.0}
-    }
+    BATCH_CONFIGS = BATCH_WORKING_CONDITIONS
 
     # Default simulation parameters
     DEFAULT_VOLTAGE_BOUNDS = (2.7, 4.5)
@@ -63,6 +68,7 @@ class BatteryParameterEstimator:
     DEFAULT_TEMP_OFFSET = 274.15
     DEFAULT_VEOD = 2.75
     DEFAULT_SOC_SAMPLES = 100
+    DEFAULT_INIT_POINTS = 5
 
     @staticmethod
     def get_battery_working_condition(batch_name: str) -> Tuple[float, float]:
@@ -78,11 +84,7 @@ class BatteryParameterEstimator:
         Raises:
             ValueError: If batch_name is not found in configurations
         """
-        if batch_name not in BatteryParameterEstimator.BATCH_CONFIGS:
-            raise ValueError(f"Unknown batch name: {batch_name}")
-
-        config = BatteryParameterEstimator.BATCH_CONFIGS[batch_name]
-        return config['Mid_SOC'], config['DOD']
+        return working_condition(batch_name)
 
     @staticmethod
     def rescale_array(arr: np.ndarray, new_min: float = 0.7, new_max: float = 0.9) -> np.ndarray:
@@ -108,25 +110,34 @@ class BatteryParameterEstimator:
         os.makedirs(folder_path, exist_ok=True)
 
     @staticmethod
-    def write_excel_parameters(excel_path: str, qMax: float, R0: float, wr: float) -> None:
+    def write_excel_parameters(excel_path: str, qMax: float, R0: float, wr: float,
+                               evaluations: int = -1, stop_reason: str = '') -> None:
         """
         Write important parameters to Excel file.
 
+        Files written before the evaluations and stop_reason columns existed
+        get the missing header cells.
+
         Args:
             excel_path: Path to Excel file
             qMax: Maximum charge parameter
             R0: Internal resistance parameter
             wr: Aging parameter
+            evaluations: Number of objective evaluations of the optimization
+            stop_reason: Why the optimization stopped
         """
         if not os.path.exists(excel_path):
             workbook = Workbook()
             sheet = workbook.active
-            sheet.append(['qMax', 'R0', 'wr'])  # Header row
+            sheet.append(KEY_PARAMETER_HEADER)  # Header row
         else:
             workbook = load_workbook(excel_path)
             sheet = workbook.active
+            for column, name in enumerate(KEY_PARAMETER_HEADER, start=1):
+                if sheet.cell(row=1, column=column).value is None:
+                    sheet.cell(row=1, column=column, value=name)
 
-        sheet.append([qMax, R0, wr])
+        sheet.append([qMax, R0, wr, evaluations, stop_reason])
         workbook.save(excel_path)
 
     @staticmethod
@@ -151,6 +162,22 @@ class BatteryParameterEstimator:
         sheet.append(values)
         workbook.save(excel_path)
 
+    @staticmethod
+    def write_excel_history(excel_path: str, history: np.ndarray) -> None:
+        """
+        Write a full simulation history to a new Excel file in one pass.
+
+        Args:
+            excel_path: Path to Excel file (overwritten)
+            history: Array of shape (samples, 13) with columns SIMULATION_CHANNELS
+        """
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(list(SIMULATION_CHANNELS))
+        for row in history.tolist():
+            sheet.append(row)
+        workbook.save(excel_path)
+
 
 def validate_inputs(keys: List[str], batt, times, inputs, outputs) -> None:
     """
@@ -232,69 +259,402 @@ def prepare_bounds(bounds, keys: List[str], batt) -> List[Tuple[float, float]]:
     return bounds
 
 
-def simulate_battery_discharge(batt, runs, optimization_params: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+def resolve_dataset(dataset: Union[str, RetiredBatteryDataset]) -> RetiredBatteryDataset:
+    """
+    Get a dataset handle, opening the file once per process if given a path.
+
+    Args:
+        dataset: Dataset handle or path to battery data file
+
+    Returns:
+        Dataset handle
+    """
+    if isinstance(dataset, RetiredBatteryDataset):
+        return dataset
+    return open_dataset(dataset)
+
+
+def estimate_reference_state(batt, dataset: RetiredBatteryDataset) -> Dict[str, float]:
+    """
+    Run the unscented Kalman filter over the batch21 reference sample.
+
+    Args:
+        batt: Battery model object with parameters already set
+        dataset: Battery dataset handle
+
+    Returns:
+        Estimated mean state
+    """
+    ref_time, ref_voltage, ref_temp = dataset.reference_sample()
+
+    filt = UnscentedKalmanFilter(batt, batt.initialize())
+    filt.estimate(ref_time, {'i': BatteryParameterEstimator.DEFAULT_CURRENT},
+                  {'t': ref_temp, 'v': ref_voltage})
+    return filt.x.mean
+
+
+def container_array(sim_result, keys: Sequence[str]) -> np.ndarray:
+    """
+    Convert a progpy SimResult to a NumPy array in bulk.
+
+    Every container wraps a (keys, 1) matrix; the matrices are concatenated
+    once instead of reading the containers key by key.
+
+    Args:
+        sim_result: SimResult (or LazySimResult) of containers
+        keys: Keys to extract, in column order
+
+    Returns:
+        Array of shape (samples, len(keys))
+    """
+    data = sim_result.data
+    if not data:
+        return np.empty((0, len(keys)))
+
+    container_keys = list(data[0].keys())
+    matrix = np.concatenate([container.matrix for container in data], axis=1)
+    return matrix[[container_keys.index(key) for key in keys]].T.astype(float)
+
+
+def simulation_history(simulated_results) -> np.ndarray:
+    """
+    Collect the outputs and all internal states of a simulation.
+
+    Args:
+        simulated_results: Result of simulate_to_threshold
+
+    Returns:
+        Array of shape (samples, 13) with columns SIMULATION_CHANNELS: the
+        outputs t (temperature) and v followed by the model states
+    """
+    return np.hstack([container_array(simulated_results.outputs, SIMULATION_CHANNELS[:2]),
+                      container_array(simulated_results.states, SIMULATION_CHANNELS[2:])])
+
+
+class DischargeSimulator:
+    """
+    Stateless discharge simulation: a base model plus a parameter overlay.
+
+    The base model and initial state are never modified. Each (qMax, Ro, wr, tb)
+    overlay is applied to a private copy of the base model together with the
+    quantities derived from it (the rescaled initial charges and the batch21
+    reference state); configured copies are kept in a small LRU cache, so
+    repeated parameter sets skip the configuration work.
+
+    The aging part of BatteryElectroChem rewrites model parameters while it
+    simulates, so every simulation runs on its own copy of the configured
+    model. Cached models are never simulated, which keeps results independent
+    of call history and lets threads share one simulator.
+
+    With ``stepping='fixed'`` the discharge runs through
+    ``simulate_to_threshold`` with 2 s Euler steps and the in-window samples
+    are returned. With ``stepping='adaptive'`` it is integrated with error
+    control and exact threshold crossings (see adaptive_discharge.py) and the
+    window is returned at DEFAULT_SOC_SAMPLES evenly spaced times, which the
+    loss re-splines onto its SOC grid like a fixed-step trace.
+    """
+
+    def __init__(self, base_model, initial_state, dataset: Union[str, RetiredBatteryDataset],
+                 reference_cache: Optional[ReferenceStateCache] = None, maxsize: int = 16,
+                 stepping: str = 'fixed', method: str = DEFAULT_METHOD, rtol: float = DEFAULT_RTOL):
+        """
+        Initialize the simulator.
+
+        Args:
+            base_model: Battery model object used as the template
+            initial_state: Initial state of the battery (copied)
+            dataset: Battery dataset handle (or path) holding the batch21 reference
+            reference_cache: Cache of reference initial states (process-wide default if None)
+            maxsize: Maximum number of configured models kept in memory
+            stepping: Time stepping mode, one of STEPPING_MODES
+            method: solve_ivp method of the adaptive mode
+            rtol: Relative tolerance of the adaptive mode
+
+        Raises:
+            ValueError: If the stepping mode is unknown
+        """
+        if stepping not in STEPPING_MODES:
+            raise ValueError(f"Unknown stepping mode: {stepping}. Expected one of {STEPPING_MODES}")
+
+        self.base_model = base_model
+        self.initial_state = {key: float(initial_state[key]) for key in base_model.states}
+        self.dataset = dataset
+        self.reference_cache = reference_cache
+        self.reference = dataset_fingerprint(dataset if isinstance(dataset, str) else dataset.data_path)
+        self.maxsize = maxsize
+        self.stepping = stepping
+        self.method = method
+        self.rtol = rtol
+
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, optimization_params: Dict[str, float], initial_temperature: float):
+        """
+        Get the model configured for a parameter overlay.
+
+        Args:
+            optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+            initial_temperature: Initial battery temperature (K)
+
+        Returns:
+            Configured model; callers must not modify or simulate it directly
+        """
+        key = (float(optimization_params['qMax']), float(optimization_params['Ro']),
+               float(optimization_params['wr']), float(initial_temperature))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                profiling.count('model_cache_hits')
+                return self._models[key]
+
+        with profiling.stage('configure'):
+            model = self._build(optimization_params, initial_temperature)
+
+        with self._lock:
+            self._models[key] = model
+            while len(self._models) > self.maxsize:
+                self._models.popitem(last=False)
+        return model
+
+    def _build(self, optimization_params: Dict[str, float], initial_temperature: float):
+        """Configure a copy of the base model for a parameter overlay."""
+        reference_cache = self.reference_cache if self.reference_cache is not None else DEFAULT_REFERENCE_CACHE
+        model = copy.deepcopy(self.base_model)
+
+        # Set optimization parameters
+        model.parameters.data['wr'] = optimization_params['wr']
+        model.parameters['Ro'] = optimization_params['Ro']
+        model.parameters['qMax'] = optimization_params['qMax']
+        model.parameters['tb'] = initial_temperature
+        model.parameters['VEOD'] = BatteryParameterEstimator.DEFAULT_VEOD
+
+        # Disable noise for simulation
+        model.parameters['measurement_noise'] = 0
+        model.parameters['process_noise'] = 0
+
+        # Initial state with the overlay applied and charges rescaled to qMax
+        x0 = dict(self.initial_state)
+        x0['qMax'] = optimization_params['qMax']
+        x0['Ro'] = optimization_params['Ro']
+        x0['tb'] = initial_temperature
+        Q_transfer_parameter = optimization_params['qMax'] / (model.parameters['qMaxThreshold'] / 0.7)
+        for param in ['qnS', 'qnB', 'qpS', 'qpB']:
+            x0[param] *= Q_transfer_parameter
+        model.parameters['x0'] = model.StateContainer(x0)
+
+        # Perform state estimation (using batch21 data as reference), cached on the dataset and
+        # (qMax, Ro, wr, tb); the filter steps the model, so it runs on a throwaway copy
+        reference_params = {'qMax': optimization_params['qMax'], 'Ro': optimization_params['Ro'],
+                            'wr': optimization_params['wr'], 'tb': initial_temperature}
+        def estimate() -> Dict[str, float]:
+            with profiling.stage('ukf'):
+                return estimate_reference_state(copy.deepcopy(model), resolve_dataset(self.dataset))
+
+        reference_state = reference_cache.get_or_compute(reference_params, estimate, self.reference)
+        model.parameters['x0'] = model.StateContainer(reference_state)
+        return model
+
+    def simulate(self, optimization_params: Dict[str, float], initial_temperature: float,
+                 return_history: bool = False):
+        """
+        Simulate a constant-current discharge.
+
+        Args:
+            optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+            initial_temperature: Initial battery temperature (K)
+            return_history: Also return the full output and internal state history as one
+                2-D array (e.g. for feature building)
+
+        Returns:
+            Tuple of (simulated_voltage, simulated_temperature) arrays within
+            DEFAULT_VOLTAGE_BOUNDS, plus the (samples, 13) array from
+            simulation_history if return_history is True; in adaptive mode the
+            voltage and temperature hold DEFAULT_SOC_SAMPLES evenly spaced points
+        """
+        configured = self.configure(optimization_params, initial_temperature)
+        with profiling.stage('simulate'):
+            model = copy.deepcopy(configured)
+
+            if self.stepping == 'adaptive':
+                return simulate_adaptive(model, BatteryParameterEstimator.DEFAULT_CURRENT,
+                                         BatteryParameterEstimator.DEFAULT_VOLTAGE_BOUNDS,
+                                         BatteryParameterEstimator.DEFAULT_SOC_SAMPLES,
+                                         self.method, self.rtol, return_history=return_history)
+
+            # Simulate discharge
+            options = {'print': False, 'progress': False, 'dt': 2}
+            future_loading = Piecewise(model.InputContainer, [float('inf')],
+                                       {'i': [BatteryParameterEstimator.DEFAULT_CURRENT]})
+
+            simulated_results = model.simulate_to_threshold(future_loading, **options)
+
+            # Extract voltage and temperature data within valid range
+            v_min, v_max = BatteryParameterEstimator.DEFAULT_VOLTAGE_BOUNDS
+            if return_history:
+                history = simulation_history(simulated_results)
+                simulated_temperature, simulated_voltage = history[:, 0], history[:, 1]
+            else:
+                simulated_temperature, simulated_voltage = container_array(simulated_results.outputs, ('t', 'v')).T
+            in_range = (simulated_voltage > v_min) & (simulated_voltage < v_max)
+
+            if return_history:
+                return simulated_voltage[in_range], simulated_temperature[in_range], history
+            return simulated_voltage[in_range], simulated_temperature[in_range]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['dataset'] = resolve_dataset(self.dataset).data_path
+        state['reference_cache'] = getattr(self.reference_cache, 'cache_dir', None)
+        del state['_models'], state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.dataset = open_dataset(state['dataset'])
+        cache_dir = state['reference_cache']
+        if cache_dir is None:
+            self.reference_cache = None
+        else:
+            if cache_dir not in _DIRECTORY_REFERENCE_CACHES:
+                _DIRECTORY_REFERENCE_CACHES[cache_dir] = ReferenceStateCache(cache_dir=cache_dir)
+            self.reference_cache = _DIRECTORY_REFERENCE_CACHES[cache_dir]
+
+
+def simulate_battery_discharge(batt, runs, optimization_params: Dict[str, float],
+                               dataset: Union[str, RetiredBatteryDataset],
+                               reference_cache: Optional[ReferenceStateCache] = None,
+                               return_history: bool = False):
     """
     Simulate battery discharge with given parameters.
 
+    The model is not modified; its current x0 is used as the initial state.
+    Code simulating many parameter sets should keep a DischargeSimulator.
+
     Args:
         batt: Battery model object
         runs: Simulation run data
         optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+        dataset: Battery dataset handle (or path) holding the batch21 reference
+        reference_cache: Cache of reference initial states (process-wide default if None)
+        return_history: Also return the full output and internal state history as one
+            2-D array (e.g. for feature building)
 
     Returns:
-        Tuple of (simulated_voltage, simulated_temperature) arrays
-    """
-    # Set optimization parameters
-    batt.parameters.data['wr'] = optimization_params['wr']
-    batt.parameters['Ro'] = optimization_params['Ro']
-    batt.parameters['qMax'] = optimization_params['qMax']
-
-    # Update initial state parameters
-    batt.parameters['x0']['qMax'] = optimization_params['qMax']
-    batt.parameters['x0']['Ro'] = optimization_params['Ro']
-    batt.parameters['x0']['tb'] = runs[0][0][0] + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
-    batt.parameters['tb'] = runs[0][0][0] + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
-    batt.parameters['VEOD'] = BatteryParameterEstimator.DEFAULT_VEOD
-
-    # Disable noise for simulation
-    batt.parameters['measurement_noise'] = 0
-    batt.parameters['process_noise'] = 0
-
-    # Adjust charge parameters
-    Q_transfer_parameter = optimization_params['qMax'] / (batt.parameters['qMaxThreshold'] / 0.7)
-    charge_params = ['qnS', 'qnB', 'qpS', 'qpB']
-    for param in charge_params:
-        batt.parameters['x0'][param] *= Q_transfer_parameter
-
-    # Perform state estimation (using batch21 data as reference)
-    data_all = scipy.io.loadmat('')['RetiredBatteryData_all'][0, 0]  # Path needs to be provided
-    ref_time = data_all['batch21'][0, 1][0][0][0][13][0, 0]
-    ref_voltage = data_all['batch21'][0, 1][0][0][0][7][0, 0]
-    ref_temp = data_all['batch21'][0, 1][0][0][0][10][0, 0]
+        Tuple of (simulated_voltage, simulated_temperature) arrays within
+        DEFAULT_VOLTAGE_BOUNDS, plus the (samples, 13) array from
+        simulation_history if return_history is True
+    """
+    initial_temperature = runs[0][0][0] + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+    simulator = DischargeSimulator(batt, batt.parameters['x0'], dataset, reference_cache, maxsize=1)
+    return simulator.simulate(optimization_params, initial_temperature, return_history)
 
-    filt = UnscentedKalmanFilter(batt, batt.initialize())
-    filt.estimate(ref_time, {'i': BatteryParameterEstimator.DEFAULT_CURRENT},
-                  {'t': ref_temp, 'v': ref_voltage})
-    batt.parameters['x0'] = filt.x.mean
 
-    # Simulate discharge
-    options = {'print': False, 'progress': False, 'dt': 2}
-    future_loading = Piecewise(batt.InputContainer, [float('inf')],
-                               {'i': [BatteryParameterEstimator.DEFAULT_CURRENT]})
+class LossContext:
+    """
+    Per-cycle loss: SOC-aligned, weighted squared voltage error.
+
+    The SOC grid and the observed voltage on it are the same for every
+    evaluation of a cycle and are computed once. Simulated traces are
+    interpolated onto the grid with the same not-a-knot cubic spline that
+    ``interp1d(kind='cubic')`` uses; traces of equal length are interpolated
+    together as the columns of one spline.
+    """
+
+    def __init__(self, true_voltage: List[float], Mid_SOC: float, DOD: float):
+        """
+        Precompute the SOC grid and the observed voltage on it.
+
+        Args:
+            true_voltage: True voltage measurements
+            Mid_SOC: Middle state of charge
+            DOD: Depth of discharge
+        """
+        start_SOC = Mid_SOC + DOD / 2
+        end_SOC = Mid_SOC - DOD / 2
+
+        # Create SOC alignment using rescaling
+        sample_SOC = BatteryParameterEstimator.DEFAULT_SOC_SAMPLES
+        self.SOC_range = BatteryParameterEstimator.rescale_array(
+            np.arange(sample_SOC) / (sample_SOC - 1), new_min=end_SOC, new_max=start_SOC
+        )
+
+        # Interpolate observed voltage
+        observed_SOC_range = BatteryParameterEstimator.rescale_array(
+            np.arange(len(true_voltage)) / (len(true_voltage) - 1),
+            new_min=end_SOC, new_max=start_SOC
+        )
+        func_observed = interp1d(np.flipud(observed_SOC_range), true_voltage, kind='cubic')
+        self.observed_voltage_range = func_observed(self.SOC_range)
+
+    def align(self, simulated_voltages: np.ndarray) -> np.ndarray:
+        """
+        Interpolate equal-length simulated traces onto the SOC grid.
+
+        The k-th sample of an n-sample trace sits at SOC 1 - k / (n - 1).
+
+        Args:
+            simulated_voltages: Array of shape (samples,) or (traces, samples)
+
+        Returns:
+            Array of shape (SOC samples,) or (traces, SOC samples)
 
-    simulated_results = batt.simulate_to_threshold(future_loading, **options)
+        Raises:
+            ValueError: If a trace has fewer than 4 samples
+        """
+        n = simulated_voltages.shape[-1]
+        if n < 4:
+            raise ValueError(f"Cubic interpolation needs at least 4 samples, got {n}")
 
-    # Extract voltage and temperature data within valid range
-    simulated_voltage = []
-    simulated_temperature = []
+        # Ascending SOC axis: reverse the samples
+        spline = make_interp_spline(np.arange(n) / (n - 1), simulated_voltages[..., ::-1].T, k=3)
+        return spline(self.SOC_range).T
 
-    for output in simulated_results.outputs.data:
-        v_min, v_max = BatteryParameterEstimator.DEFAULT_VOLTAGE_BOUNDS
-        if v_min < output['v'] < v_max:
-            simulated_voltage.append(output['v'])
-            simulated_temperature.append(output['t'])
+    def score(self, simulated_voltage: np.ndarray) -> float:
+        """
+        Score one simulated trace.
 
-    return np.array(simulated_voltage), np.array(simulated_temperature)
+        Args:
+            simulated_voltage: Simulated voltage array
+
+        Returns:
+            Negative error value (for maximization)
+        """
+        with profiling.stage('loss'):
+            return float(self._score_aligned(self.align(np.asarray(simulated_voltage, dtype=float))))
+
+    def score_batch(self, simulated_voltages: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        Score several simulated traces, which may differ in length.
+
+        Args:
+            simulated_voltages: Simulated voltage arrays
+
+        Returns:
+            Array of negative error values
+        """
+        with profiling.stage('loss'):
+            traces = [np.asarray(v, dtype=float) for v in simulated_voltages]
+            scores = np.empty(len(traces))
+
+            by_length: Dict[int, List[int]] = {}
+            for i, trace in enumerate(traces):
+                by_length.setdefault(len(trace), []).append(i)
+            for indices in by_length.values():
+                aligned = self.align(np.stack([traces[i] for i in indices]))
+                scores[indices] = self._score_aligned(aligned)
+
+            return scores
+
+    def _score_aligned(self, simulated_voltage_range: np.ndarray) -> np.ndarray:
+        """Weighted error of traces already on the SOC grid."""
+        # Calculate weighted error (penalize positive errors more)
+        error_diff = simulated_voltage_range - self.observed_voltage_range
+        weighted_error = np.where(error_diff > 0, 2 * error_diff ** 2, error_diff ** 2)
+
+        return -np.sum(weighted_error, axis=-1)
 
 
 def calculate_optimization_error(simulated_voltage: np.ndarray, true_voltage: List[float],
@@ -302,6 +662,9 @@ def calculate_optimization_error(simulated_voltage: np.ndarray, true_voltage: Li
     """
     Calculate optimization error between simulated and true voltage data.
 
+    Builds a one-off LossContext; objectives that score many traces of one
+    cycle should keep a LossContext instead.
+
     Args:
         simulated_voltage: Simulated voltage array
         true_voltage: True voltage measurements
@@ -311,36 +674,271 @@ def calculate_optimization_error(simulated_voltage: np.ndarray, true_voltage: Li
     Returns:
         Negative error value (for maximization)
     """
-    start_SOC = Mid_SOC + DOD / 2
-    end_SOC = Mid_SOC - DOD / 2
+    return LossContext(true_voltage, Mid_SOC, DOD).score(simulated_voltage)
 
-    # Create SOC alignment using rescaling
-    sample_SOC = BatteryParameterEstimator.DEFAULT_SOC_SAMPLES
-    SOC_range = BatteryParameterEstimator.rescale_array(
-        np.arange(sample_SOC) / (sample_SOC - 1), new_min=end_SOC, new_max=start_SOC
-    )
 
-    # Interpolate observed voltage
-    observed_SOC_range = BatteryParameterEstimator.rescale_array(
-        np.arange(len(true_voltage)) / (len(true_voltage) - 1),
-        new_min=end_SOC, new_max=start_SOC
-    )
-    func_observed = interp1d(np.flipud(observed_SOC_range), true_voltage, kind='cubic')
-    observed_voltage_range = func_observed(SOC_range)
+class CycleObjective:
+    """
+    Objective function of one cycle's fit: simulate a discharge and score it.
+
+    The objective keeps the simulated voltage and full history of the best
+    evaluation it has seen, so the result can be saved without simulating again.
+
+    Simulations go through a DischargeSimulator, so the battery model passed in
+    is never modified. Instances are picklable so they can be evaluated in
+    worker processes. A pickled objective carries its own copy of the battery
+    model, reopens the dataset by path and uses a per-process reference cache
+    (backed by the same cache directory if the original cache has one). Worker
+    copies start without a best evaluation; results computed with ``evaluate``
+    are passed back to the original through ``keep``.
+    """
 
-    # Interpolate simulated voltage
-    simulated_SOC_range = BatteryParameterEstimator.rescale_array(
-        np.arange(len(simulated_voltage)) / (len(simulated_voltage) - 1),
-        new_min=0, new_max=1
-    )
-    func_simulated = interp1d(np.flipud(simulated_SOC_range), simulated_voltage, kind='cubic')
-    simulated_voltage_range = func_simulated(SOC_range)
+    def __init__(self, batt, battery_initial_state, runs, true_voltage: List[float],
+                 Mid_SOC: float, DOD: float, dataset: RetiredBatteryDataset,
+                 reference_cache: Optional[ReferenceStateCache] = None, stepping: str = 'fixed'):
+        """
+        Initialize the objective.
+
+        Args:
+            batt: Battery model object
+            battery_initial_state: Initial state of the battery
+            runs: Simulation run data
+            true_voltage: True voltage measurements
+            Mid_SOC: Middle state of charge
+            DOD: Depth of discharge
+            dataset: Battery dataset handle holding the batch21 reference
+            reference_cache: Cache of reference initial states (process-wide default if None)
+            stepping: Time stepping mode of the simulations, one of STEPPING_MODES
+        """
+        self.simulator = DischargeSimulator(batt, battery_initial_state, dataset, reference_cache,
+                                            stepping=stepping)
+        self.initial_temperature = runs[0][0][0] + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+        self.loss = LossContext(true_voltage, Mid_SOC, DOD)
+        self._clear_best()
+
+    def __call__(self, optimization_params: Dict[str, float]) -> float:
+        """
+        Evaluate the objective, keeping the result if it is the best so far.
+
+        Args:
+            optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+
+        Returns:
+            Negative error value (for maximization)
+        """
+        result = self.evaluate(optimization_params)
+        self.keep(optimization_params, result)
+        return result[0]
+
+    def evaluate(self, optimization_params: Dict[str, float]
+                 ) -> Tuple[float, Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Evaluate the objective without keeping the result.
+
+        Args:
+            optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+
+        Returns:
+            Tuple of (negative error value, simulated voltage, history); voltage and
+            history are None if the simulation failed
+        """
+        try:
+            # Simulate with current parameters
+            simulated_voltage, _, history = self.simulator.simulate(
+                optimization_params, self.initial_temperature, return_history=True
+            )
 
-    # Calculate weighted error (penalize positive errors more)
-    error_diff = simulated_voltage_range - observed_voltage_range
-    weighted_error = np.where(error_diff > 0, 2 * error_diff ** 2, error_diff ** 2)
+            # Calculate error
+            return self.loss.score(simulated_voltage), simulated_voltage, history
 
-    return -np.sum(weighted_error)
+        except Exception as e:
+            print(f"Error in optimization function: {e}")
+            return -1e6, None, None  # Large negative value for failed simulations
+
+    def keep(self, optimization_params: Dict[str, float],
+             result: Tuple[float, Optional[np.ndarray], Optional[np.ndarray]]) -> None:
+        """
+        Keep an evaluation result if it is the best one so far.
+
+        Args:
+            optimization_params: Evaluated parameters
+            result: Tuple returned by evaluate
+        """
+        target, simulated_voltage, history = result
+        if history is not None and target > self.best_target:
+            self.best_target = target
+            self.best_params = dict(optimization_params)
+            self.best_voltage = simulated_voltage
+            self.best_history = history
+
+    def _clear_best(self) -> None:
+        """Forget the best evaluation."""
+        self.best_target = -np.inf
+        self.best_params = None
+        self.best_voltage = None
+        self.best_history = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.update(best_target=-np.inf, best_params=None, best_voltage=None, best_history=None)
+        return state
+
+
+class JointObjective(CycleObjective):
+    """
+    Objective of a joint fit over a window of cycles, scoring every run.
+
+    In ``shared`` mode one (qMax, Ro, wr) set is fitted to all runs. In
+    ``linear`` mode each parameter moves linearly from its value at the first
+    run (``{key}_first``) to its value at the last run (``{key}_last``) over
+    the runs' positions in the window, e.g. their cycle numbers. The target is
+    the mean of the per-run scores, so it stays on the scale of a single
+    cycle's target. Runs that share a parameter set and initial temperature
+    share one simulation.
+
+    The best evaluation's voltages and histories are kept as lists, one entry
+    per run.
+    """
+
+    def __init__(self, batt, battery_initial_state, runs, true_voltages: List[List[float]],
+                 Mid_SOC: float, DOD: float, dataset: RetiredBatteryDataset,
+                 reference_cache: Optional[ReferenceStateCache] = None, stepping: str = 'fixed',
+                 mode: str = 'shared', positions: Optional[Sequence[float]] = None):
+        """
+        Initialize the objective.
+
+        Args:
+            batt: Battery model object
+            battery_initial_state: Initial state of the battery
+            runs: Simulation run data, one run per cycle
+            true_voltages: True voltage measurements of every run
+            Mid_SOC: Middle state of charge
+            DOD: Depth of discharge
+            dataset: Battery dataset handle holding the batch21 reference
+            reference_cache: Cache of reference initial states (process-wide default if None)
+            stepping: Time stepping mode of the simulations, one of STEPPING_MODES
+            mode: Parameter model, one of JOINT_MODES
+            positions: Position of every run in the window, e.g. its cycle number
+                (run index if None)
+
+        Raises:
+            ValueError: If the mode is unknown or the runs and voltages differ in number
+        """
+        if mode not in JOINT_MODES:
+            raise ValueError(f"Unknown joint mode: {mode}. Expected one of {JOINT_MODES}")
+        if len(runs) != len(true_voltages):
+            raise ValueError(f"Got {len(runs)} runs but {len(true_voltages)} voltage series")
+
+        super().__init__(batt, battery_initial_state, runs, true_voltages[0], Mid_SOC, DOD,
+                         dataset, reference_cache, stepping)
+        self.mode = mode
+        self.initial_temperatures = [run[0][0] + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+                                     for run in runs]
+        self.true_voltages = true_voltages
+        self.losses = [LossContext(true_voltage, Mid_SOC, DOD) for true_voltage in true_voltages]
+
+        positions = np.arange(len(runs), dtype=float) if positions is None else np.asarray(positions, float)
+        span = positions[-1] - positions[0]
+        self.fractions = (positions - positions[0]) / span if span else np.zeros(len(runs))
+
+    @property
+    def search_keys(self) -> List[str]:
+        """Parameters searched by the optimizer."""
+        if self.mode == 'shared':
+            return list(OPTIMIZATION_KEYS)
+        return [f'{key}_{end}' for key in OPTIMIZATION_KEYS for end in ('first', 'last')]
+
+    def search_bounds(self, bounds: Dict[str, Tuple[float, float]]) -> Dict[str, Tuple[float, float]]:
+        """
+        Expand per-cycle parameter bounds to the searched parameters.
+
+        Args:
+            bounds: Bounds of qMax, Ro and wr
+
+        Returns:
+            Bounds of every key in search_keys
+        """
+        return {key: bounds[key.split('_')[0]] for key in self.search_keys}
+
+    def search_point(self, optimization_params: Dict[str, float]) -> Dict[str, float]:
+        """
+        Expand one per-cycle parameter set to the searched parameters.
+
+        Args:
+            optimization_params: Dictionary of qMax, Ro and wr, used for every run
+
+        Returns:
+            Dictionary of every key in search_keys
+        """
+        return {key: optimization_params[key.split('_')[0]] for key in self.search_keys}
+
+    def cycle_params(self, search_params: Dict[str, float]) -> List[Dict[str, float]]:
+        """
+        Per-run parameter sets of a searched point.
+
+        Args:
+            search_params: Dictionary of every key in search_keys
+
+        Returns:
+            List of dictionaries of qMax, Ro and wr, one per run
+        """
+        if self.mode == 'shared':
+            return [{key: search_params[key] for key in OPTIMIZATION_KEYS} for _ in self.fractions]
+        return [{key: search_params[f'{key}_first']
+                 + fraction * (search_params[f'{key}_last'] - search_params[f'{key}_first'])
+                 for key in OPTIMIZATION_KEYS}
+                for fraction in self.fractions]
+
+    def evaluate(self, search_params: Dict[str, float]
+                 ) -> Tuple[float, Optional[List[np.ndarray]], Optional[List[np.ndarray]]]:
+        """
+        Evaluate the joint objective without keeping the result.
+
+        Args:
+            search_params: Dictionary of every key in search_keys
+
+        Returns:
+            Tuple of (mean negative error value, simulated voltages, histories); the
+            lists hold one entry per run and are None if a simulation failed
+        """
+        simulations = {}
+        scores, voltages, histories = [], [], []
+        try:
+            for params, initial_temperature, loss in zip(self.cycle_params(search_params),
+                                                         self.initial_temperatures, self.losses):
+                key = tuple(params[k] for k in OPTIMIZATION_KEYS) + (initial_temperature,)
+                if key not in simulations:
+                    simulated_voltage, _, history = self.simulator.simulate(
+                        params, initial_temperature, return_history=True
+                    )
+                    simulations[key] = (simulated_voltage, history)
+                simulated_voltage, history = simulations[key]
+                scores.append(loss.score(simulated_voltage))
+                voltages.append(simulated_voltage)
+                histories.append(history)
+
+            return float(np.mean(scores)), voltages, histories
+
+        except Exception as e:
+            print(f"Error in optimization function: {e}")
+            return -1e6, None, None  # Large negative value for failed simulations
+
+
+def run_true_voltage(batt, run_outputs) -> Union[np.ndarray, List[float]]:
+    """
+    Extract the measured voltage of one run.
+
+    Args:
+        batt: Battery model object
+        run_outputs: Output data of the run, a list of containers or dictionaries or
+            an array of shape (samples, outputs) in model output order
+
+    Returns:
+        True voltage measurements
+    """
+    if isinstance(run_outputs, np.ndarray):
+        return run_outputs[:, batt.outputs.index('v')]
+    return [x['v'] for x in run_outputs]
 
 
 def estimate_params(
@@ -351,7 +949,7 @@ def estimate_params(
         batch_name: str,
         battery_number: int,
         cycle_number: int,
-        battery_data_path: str,
+        dataset: Union[str, RetiredBatteryDataset],
         saving_file_path: str,
         optimization_iter: int = 100,
         runs: Optional[List[Tuple]] = None,
@@ -360,8 +958,23 @@ def estimate_params(
         inputs: Optional[List[InputContainer]] = None,
         outputs: Optional[List[OutputContainer]] = None,
         method: str = 'nelder-mead',
+        reference_cache: Optional[ReferenceStateCache] = None,
+        save_parameters: bool = True,
+        result_sink: Optional[ResultSink] = None,
+        initial_observations: Optional[List[Tuple[Dict[str, float], float]]] = None,
+        on_observation: Optional[Callable[[Dict[str, float], float], None]] = None,
+        warm_start: Optional[WarmStart] = None,
+        batch_size: int = 1,
+        batch_strategy: str = 'constant_liar',
+        evaluation_pool: Optional[EvaluationPool] = None,
+        early_stopping: Optional[EarlyStopping] = None,
+        plot: bool = False,
+        surrogate: Optional[DischargeSurrogate] = None,
+        verify_candidates: int = 3,
+        joint: Optional[str] = None,
+        cycle_numbers: Optional[Sequence[int]] = None,
         **kwargs
-) -> Tuple[float, float, float]:
+) -> Union[Tuple[float, float, float], List[Tuple[float, float, float]]]:
     """
     Estimate battery parameters using Bayesian optimization.
 
@@ -373,22 +986,68 @@ def estimate_params(
         batch_name: Name of the battery batch
         battery_number: Battery number identifier
         cycle_number: Cycle number identifier
-        battery_data_path: Path to battery data file
+        dataset: Battery dataset handle (or path to battery data file)
         saving_file_path: Path to save results
         optimization_iter: Number of optimization iterations
         runs: List of (times, inputs, outputs) tuples
         keys: List of parameter keys to optimize
         times: Time data
-        inputs: Input data
-        outputs: Output data
+        inputs: Input data (a list of dictionaries or a current array)
+        outputs: Output data (a list of dictionaries or an array of shape
+            (samples, outputs) with columns in model output order)
         method: Optimization method (legacy parameter)
-        **kwargs: Additional configuration options
+        reference_cache: Cache of reference initial states (process-wide default if None)
+        save_parameters: Append the optimal parameters to key_parameters.xlsx; disable
+            when a single writer collects results from several processes
+        result_sink: Key-parameter sink to buffer the optimal parameters in instead of
+            appending them to key_parameters.xlsx
+        initial_observations: (params, target) pairs from an interrupted run; they are
+            registered with the optimizer and count towards the evaluation budget
+        on_observation: Callback receiving (params, target) after every evaluation,
+            used to checkpoint the optimizer history
+        warm_start: Warm-start state shared by consecutive cycles of one battery (opt-in);
+            seeded from and updated with each cycle's optimum
+        batch_size: Number of points proposed and evaluated concurrently per round;
+            1 runs the sequential optimizer
+        batch_strategy: Fantasy-value strategy for batch proposals, 'constant_liar'
+            or 'kriging_believer'
+        evaluation_pool: Worker pool for batched evaluation, reused across calls (a pool
+            of batch_size workers is created for this call if None)
+        early_stopping: Stopping criteria; after the call its reason and evaluations
+            attributes describe the run (built from the tol, patience,
+            acquisition_threshold and time_budget options if None)
+        plot: Render the comparison plot right away; otherwise only its data is saved
+            and figures are rendered later with comparison_plots.py
+        surrogate: Discharge surrogate to run the optimization on instead of the full
+            model; the optimizer history is then not checkpointed (on_observation is
+            not called) and batch_size is ignored
+        verify_candidates: Number of best distinct surrogate candidates re-evaluated with
+            the full model; the best full-model result is the optimum
+        joint: Fit all runs jointly with one of JOINT_MODES: a shared parameter set or
+            a linear trajectory over the cycles (only runs[0] is fitted if None)
+        cycle_numbers: Cycle number of every run in joint mode, used for saving and as
+            the trajectory positions (consecutive from cycle_number if None)
+        **kwargs: Additional configuration options (e.g. stepping, the time stepping
+            mode of the simulations, one of STEPPING_MODES, or random_state, the seed
+            of the optimizer for reproducible runs)
 
     Returns:
-        Tuple of optimized (qMax, Ro, wr) parameters
+        Tuple of optimized (qMax, Ro, wr) parameters, or in joint mode a list of
+        such tuples, one per run
+
+    Raises:
+        ValueError: If batch_strategy or joint is unknown, or a surrogate is combined
+            with joint mode
     """
-    # Load battery data
-    data_all = scipy.io.loadmat(battery_data_path)['RetiredBatteryData_all'][0, 0]
+    if batch_strategy not in BATCH_STRATEGIES:
+        raise ValueError(f"Unknown batch strategy: {batch_strategy}. Expected one of {BATCH_STRATEGIES}")
+    if joint is not None and joint not in JOINT_MODES:
+        raise ValueError(f"Unknown joint mode: {joint}. Expected one of {JOINT_MODES}")
+    if joint is not None and surrogate is not None:
+        raise ValueError("A surrogate cannot be used for a joint fit")
+
+    # Open battery data once and share the handle with every simulation
+    dataset = resolve_dataset(dataset)
 
     # Set default keys if not provided
     if keys is None:
@@ -396,17 +1055,28 @@ def estimate_params(
                 if isinstance(batt.parameters[key], Number)]
 
     # Validate inputs
-    validate_inputs(keys, batt, times or [], inputs or [], outputs or [])
+    for run in runs if runs is not None else [(times, inputs, outputs)]:
+        validate_inputs(keys, batt, *(data if data is not None else [] for data in run))
 
     # Prepare configuration
     config = {
         'error_method': 'MSE',
         'bounds': tuple((-np.inf, np.inf) for _ in keys),
         'options': None,
-        'tol': 1e-6
+        'tol': 1e-6,
+        'patience': None,
+        'acquisition_threshold': None,
+        'time_budget': None,
+        'stepping': 'fixed',
+        'random_state': None
     }
     config.update(kwargs)
 
+    if early_stopping is None:
+        early_stopping = EarlyStopping(config['tol'], config['patience'],
+                                       config['acquisition_threshold'], config['time_budget'])
+    early_stopping.start()
+
     # Prepare data for optimization
     if runs is None and all(x is not None for x in [times, inputs, outputs]):
         # Convert to list format if needed
@@ -419,7 +1089,7 @@ def estimate_params(
             times = [times]
         if not isinstance(inputs[0], (abc.Sequence, np.ndarray)):
             inputs = [inputs]
-        if not isinstance(outputs[0], (abc.Sequence, np.ndarray)):
+        if not isinstance(outputs[0], (abc.Sequence, np.ndarray)) or np.ndim(outputs) == 2:
             outputs = [outputs]
 
         runs = list(zip(times, inputs, outputs))
@@ -430,84 +1100,179 @@ def estimate_params(
     # Prepare bounds
     bounds = prepare_bounds(config['bounds'], keys, batt)
 
-    # Convert container types if needed
+    # Convert container types if needed; NumPy runs (outputs of shape (samples, outputs)
+    # in model output order) are kept as arrays
     for i, (run_times, run_inputs, run_outputs) in enumerate(runs):
-        has_changed = False
-
-        if not isinstance(run_inputs[0], batt.InputContainer):
-            run_inputs = [batt.InputContainer(u) for u in run_inputs]
-            has_changed = True
-
-        if isinstance(run_outputs, np.ndarray):
-            run_outputs = [batt.OutputContainer(u) for u in run_outputs]
-            has_changed = True
-
-        if has_changed:
-            runs[i] = (run_times, run_inputs, run_outputs)
+        if not isinstance(run_inputs, np.ndarray) and not isinstance(run_inputs[0], batt.InputContainer):
+            runs[i] = (run_times, [batt.InputContainer(u) for u in run_inputs], run_outputs)
 
     # Extract true voltage data
-    true_voltage = [x['v'] for x in runs[0][2]]
-
-    def optimization_function(Ro: float, qMax: float, wr: float) -> float:
+    true_voltage = run_true_voltage(batt, runs[0][2])
+
+    if joint is None:
+        objective = CycleObjective(batt, battery_initial_state, runs, true_voltage, Mid_SOC, DOD,
+                                   dataset, reference_cache, config['stepping'])
+    else:
+        if cycle_numbers is None:
+            cycle_numbers = [cycle_number + i for i in range(len(runs))]
+        objective = JointObjective(batt, battery_initial_state, runs,
+                                   [run_true_voltage(batt, run[2]) for run in runs], Mid_SOC, DOD,
+                                   dataset, reference_cache, config['stepping'], joint, cycle_numbers)
+    search_objective = objective
+    if surrogate is not None:
+        surrogate_temperature = objective.initial_temperature - BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+
+        def search_objective(optimization_params: Dict[str, float]) -> float:
+            target = objective.loss.score(surrogate.predict(optimization_params, surrogate_temperature))
+            return target if np.isfinite(target) else -1e6
+
+        on_observation = None
+        batch_size = 1
+
+    def optimization_function(**optimization_params: float) -> float:
         """
         Objective function for Bayesian optimization.
 
         Args:
-            Ro: Internal resistance parameter
-            qMax: Maximum charge parameter
-            wr: Aging parameter
+            **optimization_params: Internal resistance Ro, maximum charge qMax and aging
+                parameter wr (the JointObjective search_keys in joint mode)
 
         Returns:
             Negative error value (for maximization)
         """
-        try:
-            # Set initial state
-            batt.parameters['x0'] = battery_initial_state
-
-            # Simulate with current parameters
-            optimization_params = {'Ro': Ro, 'qMax': qMax, 'wr': wr}
-            simulated_voltage, _ = simulate_battery_discharge(batt, runs, optimization_params)
-
-            # Calculate and return error
-            return calculate_optimization_error(simulated_voltage, true_voltage, Mid_SOC, DOD)
-
-        except Exception as e:
-            print(f"Error in optimization function: {e}")
-            return -1e6  # Return large negative value for failed simulations
+        target = search_objective(optimization_params)
+        early_stopping.observe(target)
+        if on_observation is not None:
+            on_observation(optimization_params, target)
+        return target
 
     # Setup Bayesian optimization
     param_bounds = {'qMax': bounds[0], 'Ro': bounds[1], 'wr': bounds[2]}
-    bo = BayesianOptimization(f=optimization_function, pbounds=param_bounds)
+    init_points = BatteryParameterEstimator.DEFAULT_INIT_POINTS
+    n_iter = optimization_iter
+    seed_points = []
+    if warm_start is not None and warm_start.is_warm:
+        # Search near the previous cycles' optima instead of random initial points
+        search_bounds = warm_start.narrow_bounds(param_bounds)
+        seed_points = warm_start.seed_points(param_bounds, search_bounds)
+        param_bounds = search_bounds
+        init_points = 0
+        if warm_start.iterations is not None:
+            n_iter = warm_start.iterations
+    if joint is not None:
+        param_bounds = objective.search_bounds(param_bounds)
+        seed_points = [objective.search_point(params) for params in seed_points]
+
+    bo = BayesianOptimization(f=optimization_function, pbounds=param_bounds,
+                              random_state=config['random_state'])
+    if profiling.is_enabled():
+        suggest = bo.suggest
+        bo.suggest = lambda *args, **kw: profiling.timed('gp_suggest', suggest, *args, **kw)
+    if warm_start is not None:
+        warm_start.configure(bo)
 
     # Configure acquisition function
     acquisition_function = UtilityFunction(kind="poi", xi=0.3e-4)
 
+    # Resume from earlier observations, counting them against the evaluation budget
+    for params, target in initial_observations or []:
+        bo.register(params=params, target=target)
+        early_stopping.observe(target)
+    if initial_observations:
+        n_done = len(initial_observations)
+        n_iter = max(0, n_iter - max(0, n_done - init_points - len(seed_points)))
+        init_points = max(0, init_points - n_done)
+        seed_points = []
+
     # Run optimization
-    bo.maximize(n_iter=optimization_iter, acquisition_function=acquisition_function)
+    if batch_size > 1:
+        pool = evaluation_pool if evaluation_pool is not None else EvaluationPool(batch_size)
+        try:
+            def evaluate_points(points: List[Dict[str, float]]) -> List[float]:
+                with profiling.stage('evaluate_batch'):
+                    results = pool.evaluate(objective.evaluate, points)
+                for params, result in zip(points, results):
+                    objective.keep(params, result)
+                return [result[0] for result in results]
+
+            maximize_batched(bo, evaluate_points,
+                             acquisition_function, init_points, n_iter, batch_size,
+                             batch_strategy, seed_points, on_observation, early_stopping)
+        finally:
+            if evaluation_pool is None:
+                pool.close()
+    elif early_stopping.active:
+        # bo.maximize cannot stop between iterations; run the same loop one point at a time
+        maximize_batched(bo, lambda points: [search_objective(params) for params in points],
+                         acquisition_function, init_points, n_iter, 1,
+                         batch_strategy, seed_points, on_observation, early_stopping)
+    elif init_points or n_iter or seed_points:
+        for params in seed_points:
+            bo.probe(params, lazy=True)
+        bo.maximize(init_points=init_points, n_iter=n_iter,
+                    acquisition_function=acquisition_function)
+
+    stop_reason = early_stopping.finish()
+    print(f"Optimization stopped after {early_stopping.evaluations} evaluations: {stop_reason}")
 
     # Extract optimal parameters
     optimal_params = bo.max['params']
-    qMax_opt = optimal_params['qMax']
-    Ro_opt = optimal_params['Ro']
-    wr_opt = optimal_params['wr']
+    if surrogate is not None:
+        # Check the best surrogate candidates with the full model
+        ranked = sorted(bo.res, key=lambda res: res['target'], reverse=True)
+        for res in ranked[:verify_candidates]:
+            objective(res['params'])
+        if objective.best_params is not None:
+            optimal_params = objective.best_params
+        print(f"Surrogate optimum verified with the full model: target {objective.best_target:.4f}")
+
+    # Reuse the best evaluation's simulation; simulate only if the optimum came
+    # from observations of an earlier, interrupted run
+    if objective.best_params is None or any(objective.best_params[key] != optimal_params[key]
+                                            for key in optimal_params):
+        if joint is None:
+            final_sim_voltage, _, history = objective.simulator.simulate(
+                optimal_params, objective.initial_temperature, return_history=True
+            )
+        else:
+            _, final_sim_voltage, history = objective.evaluate(optimal_params)
+    else:
+        final_sim_voltage, history = objective.best_voltage, objective.best_history
+
+    if joint is None:
+        if warm_start is not None:
+            warm_start.update(optimal_params, bo)
 
-    # Generate final simulation with optimal parameters
-    batt.parameters['x0'] = battery_initial_state
-    final_sim_voltage, _ = simulate_battery_discharge(batt, runs, optimal_params)
+        # Save results
+        save_results(batch_name, battery_number, cycle_number, saving_file_path,
+                     optimal_params, history, final_sim_voltage, true_voltage, Mid_SOC, DOD,
+                     save_parameters, result_sink, early_stopping, plot)
 
-    # Save results
-    save_results(batch_name, battery_number, cycle_number, saving_file_path,
-                 optimal_params, batt, runs, final_sim_voltage, true_voltage, Mid_SOC, DOD)
+        return optimal_params['qMax'], optimal_params['Ro'], optimal_params['wr']
 
-    return qMax_opt, Ro_opt, wr_opt
+    # Save every cycle of the window with its own point of the fitted trajectory
+    window_params = objective.cycle_params(optimal_params)
+    if warm_start is not None:
+        warm_start.update(window_params[-1], bo)
+    for window_cycle, params, cycle_history, cycle_voltage, cycle_true_voltage in zip(
+            cycle_numbers, window_params, history, final_sim_voltage, objective.true_voltages):
+        save_results(batch_name, battery_number, window_cycle, saving_file_path,
+                     params, cycle_history, cycle_voltage, cycle_true_voltage, Mid_SOC, DOD,
+                     save_parameters, result_sink, early_stopping, plot)
+
+    return [(params['qMax'], params['Ro'], params['wr']) for params in window_params]
 
 
 def save_results(batch_name: str, battery_number: int, cycle_number: int,
                  saving_file_path: str, optimal_params: Dict[str, float],
-                 batt, runs, simulated_voltage: np.ndarray, true_voltage: List[float],
-                 Mid_SOC: float, DOD: float) -> None:
+                 history: np.ndarray, simulated_voltage: np.ndarray, true_voltage: List[float],
+                 Mid_SOC: float, DOD: float,
+                 save_parameters: bool = True,
+                 result_sink: Optional[ResultSink] = None,
+                 early_stopping: Optional[EarlyStopping] = None,
+                 plot: bool = False) -> None:
     """
-    Save optimization results and generate plots.
+    Save optimization results and the comparison plot data.
 
     Args:
         batch_name: Name of the battery batch
@@ -515,44 +1280,98 @@ def save_results(batch_name: str, battery_number: int, cycle_number: int,
         cycle_number: Cycle number identifier
         saving_file_path: Base path for saving files
         optimal_params: Dictionary of optimal parameters
-        batt: Battery model object
-        runs: Simulation run data
+        history: Output and state history of the optimal simulation, shape (samples, 13)
         simulated_voltage: Simulated voltage data
         true_voltage: True voltage measurements
         Mid_SOC: Middle state of charge
         DOD: Depth of discharge
+        save_parameters: Save the optimal parameters
+        result_sink: Key-parameter sink to buffer the optimal parameters in instead of
+            appending them to key_parameters.xlsx
+        early_stopping: Finished stopping criteria whose reason and evaluation count are
+            saved with the parameters
+        plot: Also render the comparison plot
     """
     # Create directory structure
     battery_path = os.path.join(saving_file_path, batch_name, f'Battery{battery_number}')
     BatteryParameterEstimator.create_folder(battery_path)
 
-    # Save key parameters
-    params_file = os.path.join(battery_path, 'key_parameters.xlsx')
-    BatteryParameterEstimator.write_excel_parameters(
-        params_file, optimal_params['qMax'], optimal_params['Ro'], optimal_params['wr']
-    )
+    with profiling.stage('excel'):
+        # Save key parameters
+        if save_parameters and result_sink is not None:
+            result_sink.append({'batch': batch_name, 'battery': battery_number, 'cycle': cycle_number,
+                                'evaluations': getattr(early_stopping, 'evaluations', -1),
+                                'stop_reason': getattr(early_stopping, 'reason', ''),
+                                **optimal_params})
+        elif save_parameters:
+            params_file = os.path.join(battery_path, 'key_parameters.xlsx')
+            BatteryParameterEstimator.write_excel_parameters(
+                params_file, optimal_params['qMax'], optimal_params['Ro'], optimal_params['wr'],
+                getattr(early_stopping, 'evaluations', -1), getattr(early_stopping, 'reason', '')
+            )
+
+        # Save detailed simulation results
+        results_file = os.path.join(battery_path, f'{cycle_number}.xlsx')
+        BatteryParameterEstimator.write_excel_history(results_file, history)
+
+    with profiling.stage('plot'):
+        # Keep the plot inputs so figures can be rendered outside the estimation loop
+        save_comparison_data(comparison_data_path(saving_file_path, batch_name, battery_number, cycle_number),
+                             simulated_voltage, true_voltage, Mid_SOC, DOD)
+        if plot:
+            create_comparison_plot(simulated_voltage, true_voltage, Mid_SOC, DOD,
+                                   battery_number, cycle_number, batch_name, saving_file_path)
+
+
+def comparison_data_path(saving_file_path: str, batch_name: str, battery_number: int,
+                         cycle_number: int) -> str:
+    """Get the path of a cycle's comparison plot data."""
+    return os.path.join(saving_file_path, batch_name, f'Battery{battery_number}', 'Figure', 'data',
+                        f'{cycle_number}.npz')
+
+
+def save_comparison_data(data_path: str, simulated_voltage: np.ndarray, true_voltage: List[float],
+                         Mid_SOC: float, DOD: float) -> None:
+    """
+    Save the inputs of a comparison plot.
 
-    # Save detailed simulation results
-    results_file = os.path.join(battery_path, f'{cycle_number}.xlsx')
+    Args:
+        data_path: Path of the .npz file
+        simulated_voltage: Simulated voltage data
+        true_voltage: True voltage measurements
+        Mid_SOC: Middle state of charge
+        DOD: Depth of discharge
+    """
+    BatteryParameterEstimator.create_folder(os.path.dirname(data_path))
+    np.savez(data_path, simulated_voltage=simulated_voltage, true_voltage=np.asarray(true_voltage),
+             Mid_SOC=Mid_SOC, DOD=DOD)
 
-    # Re-run simulation to get all state data
-    batt.parameters['x0'] = batt.initialize()  # Reset initial state
-    optimization_params = optimal_params
 
-    # Simulate again for detailed results
-    simulated_voltage_full, _ = simulate_battery_discharge(batt, runs, optimization_params)
+def load_comparison_data(data_path: str) -> Tuple[np.ndarray, np.ndarray, float, float]:
+    """
+    Load the inputs of a comparison plot.
 
-    # Generate and save plot
-    create_comparison_plot(simulated_voltage, true_voltage, Mid_SOC, DOD,
-                           battery_number, cycle_number, batch_name, saving_file_path)
+    Args:
+        data_path: Path of the .npz file
+
+    Returns:
+        Tuple of (simulated_voltage, true_voltage, Mid_SOC, DOD)
+    """
+    with np.load(data_path) as data:
+        return (data['simulated_voltage'], data['true_voltage'],
+                float(data['Mid_SOC']), float(data['DOD']))
 
 
 def create_comparison_plot(simulated_voltage: np.ndarray, true_voltage: List[float],
                            Mid_SOC: float, DOD: float, battery_number: int,
-                           cycle_number: int, batch_name: str, saving_file_path: str) -> None:
+                           cycle_number: int, batch_name: str, saving_file_path: str,
+                           figure: Optional[Figure] = None, dpi: int = 300) -> None:
     """
     Create and save comparison plot between simulated and observed voltage.
 
+    The plot is drawn on a standalone Figure, without pyplot: nothing is shown,
+    no GUI backend is needed and no figure stays registered after saving.
+
     Args:
         simulated_voltage: Simulated voltage data
         true_voltage: True voltage measurements
@@ -562,51 +1381,42 @@ def create_comparison_plot(simulated_voltage: np.ndarray, true_voltage: List[flo
         cycle_number: Cycle number identifier
         batch_name: Name of the battery batch
         saving_file_path: Base path for saving files
+        figure: Figure to clear and reuse (a new one is created if None)
+        dpi: Resolution of the saved JPEG
     """
-    # Calculate SOC ranges for plotting
-    start_SOC = Mid_SOC + DOD / 2
-    end_SOC = Mid_SOC - DOD / 2
-
-    sample_SOC = BatteryParameterEstimator.DEFAULT_SOC_SAMPLES
-    SOC_range = BatteryParameterEstimator.rescale_array(
-        np.arange(sample_SOC) / (sample_SOC - 1), new_min=end_SOC, new_max=start_SOC
-    )
-
-    # Prepare observed data
-    observed_SOC_range = BatteryParameterEstimator.rescale_array(
-        np.arange(len(true_voltage)) / (len(true_voltage) - 1),
-        new_min=end_SOC, new_max=start_SOC
-    )
+    # SOC grid and observed voltage on it
+    loss = LossContext(true_voltage, Mid_SOC, DOD)
 
     # Create plot
-    plt.figure(figsize=(10, 6))
+    if figure is None:
+        figure = Figure(figsize=(10, 6))
+    else:
+        figure.clear()
+    ax = figure.add_subplot()
 
     # Plot simulated data
     simulated_SOC_range = BatteryParameterEstimator.rescale_array(
         np.arange(len(simulated_voltage)) / (len(simulated_voltage) - 1),
         new_min=0, new_max=1
     )
-    plt.plot(simulated_SOC_range[:len(simulated_voltage)], simulated_voltage,
-             'b-', label='Simulated', linewidth=2)
+    ax.plot(simulated_SOC_range[:len(simulated_voltage)], simulated_voltage,
+            'b-', label='Simulated', linewidth=2)
 
     # Plot observed data
-    func_observed = interp1d(np.flipud(observed_SOC_range), true_voltage, kind='cubic')
-    observed_voltage_range = func_observed(SOC_range)
-    plt.plot(SOC_range, observed_voltage_range, 'r--', label='Observed', linewidth=2)
+    ax.plot(loss.SOC_range, loss.observed_voltage_range, 'r--', label='Observed', linewidth=2)
 
     # Formatting
-    plt.gca().invert_xaxis()
-    plt.xlabel('State of Charge (SOC)')
-    plt.ylabel('Voltage (V)')
-    plt.title(f'Battery {battery_number} - Cycle {cycle_number}')
-    plt.legend()
-    plt.grid(True, alpha=0.3)
+    ax.invert_xaxis()
+    ax.set_xlabel('State of Charge (SOC)')
+    ax.set_ylabel('Voltage (V)')
+    ax.set_title(f'Battery {battery_number} - Cycle {cycle_number}')
+    ax.legend()
+    ax.grid(True, alpha=0.3)
 
     # Save plot
     figure_path = os.path.join(saving_file_path, batch_name, f'Battery{battery_number}', 'Figure')
     BatteryParameterEstimator.create_folder(figure_path)
-    plt.savefig(os.path.join(figure_path, f'{cycle_number}.jpg'), dpi=300, bbox_inches='tight')
-    plt.show()
+    figure.savefig(os.path.join(figure_path, f'{cycle_number}.jpg'), dpi=dpi, bbox_inches='tight')
 
 
 # Legacy function aliases for backward compatibility
@@ -620,9 +1430,10 @@ def create_folder(folder_path: str) -> None:
     BatteryParameterEstimator.create_folder(folder_path)
 
 
-def write_excel_important_parameters(excel_path: str, qMax: float, R0: float, wr: float) -> None:
+def write_excel_important_parameters(excel_path: str, qMax: float, R0: float, wr: float,
+                                     evaluations: int = -1, stop_reason: str = '') -> None:
     """Legacy function - use BatteryParameterEstimator.write_excel_parameters instead."""
-    BatteryParameterEstimator.write_excel_parameters(excel_path, qMax, R0, wr)
+    BatteryParameterEstimator.write_excel_parameters(excel_path, qMax, R0, wr, evaluations, stop_reason)
 
 
 def write_excel_results(excel_path: str, values: List[float]) -> None:
@@ -0,0 +1,621 @@
+"""
+Battery Dataset Access
+======================
+
+Load-once handles for the retired battery archives.
+
+``RetiredBatteryData_all.mat`` and ``SimulationData_RetiredBattery.mat`` are
+nested MATLAB structs that used to be re-parsed and indexed by position in
+several places. This module parses each file once per process and exposes
+named, indexed accessors instead of magic indices such as ``[0][0][0][14 - 1]``.
+
+Both archives can also be converted once into a columnar store: one
+contiguous float64 file per archive plus a JSON index of array offsets. The
+columnar readers serve zero-copy ``np.memmap`` views with the same accessors,
+so worker processes start without parsing the archives and share the page
+cache instead of each holding a full copy. Both files are written under
+temporary names and replaced data file first; the data file ends with the
+generation token of its index, and a store whose files do not match is
+refused instead of serving arrays at the wrong offsets.
+
+Conventions:
+    - ``batch`` is a batch name such as ``'batch01'``
+    - ``battery`` is the zero-based battery index within the batch
+    - ``cycle`` is the one-based cycle number
+"""
+
+import argparse
+import json
+import os
+import threading
+import uuid
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.io
+
+# Channels of the measured cycling data, in struct field order
+MEASURED_CHANNELS = (
+    'charge_V', 'charge_I', 'charge_Q', 'charge_T', 'charge_E', 'charge_dQdV', 'charge_t_s',
+    'discharge_V', 'discharge_I', 'discharge_Q', 'discharge_T', 'discharge_E',
+    'discharge_dQdV', 'discharge_t_s',
+)
+
+# Channels of the per-cycle simulation outputs, in struct field order
+SIMULATION_CHANNELS = (
+    't', 'v', 'tb', 'Vo', 'Vsn', 'Vsp', 'qnB', 'qnS', 'qpB', 'qpS', 'qMax', 'Ro', 'D',
+)
+
+# Working condition of each batch: mid state of charge and depth of discharge of its cycling
+BATCH_WORKING_CONDITIONS = {
+    'batch01': {'Mid_SOC': 0.8, 'DOD': 0.2},
+    'batch02': {'Mid_SOC': 0.7, 'DOD': 0.2},
+    'batch03': {'Mid_SOC': 0.5, 'DOD': 0.2},
+    'batch04': {'Mid_SOC': 0.4, 'DOD': 0.2},
+    'batch05': {'Mid_SOC': 0.3, 'DOD': 0.2},
+    'batch06': {'Mid_SOC': 0.2, 'DOD': 0.2},
+    'batch07': {'Mid_SOC': 0.75, 'DOD': 0.3},
+    'batch08': {'Mid_SOC': 0.6, 'DOD': 0.3},
+    'batch09': {'Mid_SOC': 0.5, 'DOD': 0.3},
+    'batch10': {'Mid_SOC': 0.45, 'DOD': 0.3},
+    'batch11': {'Mid_SOC': 0.7, 'DOD': 0.4},
+    'batch12': {'Mid_SOC': 0.55, 'DOD': 0.4},
+    'batch13': {'Mid_SOC': 0.5, 'DOD': 0.4},
+    'batch14': {'Mid_SOC': 0.4, 'DOD': 0.4},
+    'batch15': {'Mid_SOC': 0.3, 'DOD': 0.4},
+    'batch16': {'Mid_SOC': 0.5, 'DOD': 0.5},
+    'batch17': {'Mid_SOC': 0.35, 'DOD': 0.5},
+    'batch18': {'Mid_SOC': 0.5, 'DOD': 0.6},
+    'batch19': {'Mid_SOC': 0.5, 'DOD': 0.7},
+    'batch20': {'Mid_SOC': 0.5, 'DOD': 0.8},
+    'batch21': {'Mid_SOC': 0.5, 'DOD': 1.0}
+}
+
+# Battery providing the reference sample for the simulation initial state
+REFERENCE_BATCH = 'batch21'
+REFERENCE_BATTERY = 1
+
+# Columnar store layout
+STORE_FORMAT_VERSION = 1
+STORE_DTYPE = np.float64
+STORE_ALIGNMENT = 64
+STORE_TOKEN_BYTES = 16
+
+_open_lock = threading.Lock()
+_open_datasets = {}
+
+
+def working_condition(batch: str) -> Tuple[float, float]:
+    """
+    Get the working condition of a batch.
+
+    Args:
+        batch: Batch name
+
+    Returns:
+        Tuple of (Mid_SOC, DOD) values
+
+    Raises:
+        ValueError: If the batch is unknown
+    """
+    if batch not in BATCH_WORKING_CONDITIONS:
+        raise ValueError(f"Unknown batch name: {batch}")
+    condition = BATCH_WORKING_CONDITIONS[batch]
+    return condition['Mid_SOC'], condition['DOD']
+
+
+class RetiredBatteryDataset:
+    """
+    Handle to the measured cycling data in RetiredBatteryData_all.mat.
+    """
+
+    ROOT_KEY = 'RetiredBatteryData_all'
+
+    def __init__(self, data_path: str):
+        """
+        Parse the archive.
+
+        Args:
+            data_path: Path to RetiredBatteryData_all.mat
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            KeyError: If the expected root struct is missing
+        """
+        self.data_path = data_path
+        self._data = scipy.io.loadmat(data_path)[self.ROOT_KEY][0, 0]
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the archive."""
+        return tuple(self._data.dtype.names)
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return self._data[batch].shape[1]
+
+    def num_cycles(self, batch: str, battery: int) -> int:
+        """Number of recorded cycles for a battery."""
+        return len(self.channel(batch, battery, 'discharge_t_s'))
+
+    def channel(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get one measured channel for all cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Channel name from MEASURED_CHANNELS
+
+        Returns:
+            Array of shape (cycles, samples)
+        """
+        return self._data[batch][0, battery][0][0][0][MEASURED_CHANNELS.index(name)]
+
+    def cycle_channel(self, batch: str, battery: int, cycle: int, name: str) -> np.ndarray:
+        """
+        Get one measured channel for a single cycle.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            cycle: One-based cycle number
+            name: Channel name from MEASURED_CHANNELS
+
+        Returns:
+            Array of shape (samples,)
+        """
+        return self.channel(batch, battery, name)[cycle - 1, :]
+
+    def channels(self, batch: str, battery: int, names: Sequence[str],
+                 cycles: Optional[int] = None) -> np.ndarray:
+        """
+        Get several measured channels for the leading cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            names: Channel names from MEASURED_CHANNELS
+            cycles: Number of leading cycles (all if None)
+
+        Returns:
+            Array of shape (cycles, channels, samples)
+        """
+        return np.stack([self.channel(batch, battery, name)[:cycles] for name in names], axis=1)
+
+    def discharge_time(self, batch: str, battery: int, cycle: int) -> np.ndarray:
+        """Discharge time samples (s) of a cycle."""
+        return self.cycle_channel(batch, battery, cycle, 'discharge_t_s')
+
+    def discharge_voltage(self, batch: str, battery: int, cycle: int) -> np.ndarray:
+        """Discharge voltage samples (V) of a cycle."""
+        return self.cycle_channel(batch, battery, cycle, 'discharge_V')
+
+    def discharge_temperature(self, batch: str, battery: int, cycle: int) -> np.ndarray:
+        """Discharge temperature samples (degC) of a cycle."""
+        return self.cycle_channel(batch, battery, cycle, 'discharge_T')
+
+    def reference_sample(self) -> Tuple[float, float, float]:
+        """
+        Get the sample used to initialize the simulation state.
+
+        Returns:
+            Tuple of (time, voltage, temperature) of the first sample of the
+            first cycle of the reference battery
+        """
+        return (self.channel(REFERENCE_BATCH, REFERENCE_BATTERY, 'discharge_t_s')[0, 0],
+                self.channel(REFERENCE_BATCH, REFERENCE_BATTERY, 'discharge_V')[0, 0],
+                self.channel(REFERENCE_BATCH, REFERENCE_BATTERY, 'discharge_T')[0, 0])
+
+
+class SimulationDataset:
+    """
+    Handle to the simulation outputs in SimulationData_RetiredBattery.mat.
+    """
+
+    ROOT_KEY = 'SimulationData_RetiredBattery'
+
+    def __init__(self, data_path: str):
+        """
+        Parse the archive.
+
+        Args:
+            data_path: Path to SimulationData_RetiredBattery.mat
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            KeyError: If the expected root struct is missing
+        """
+        self.data_path = data_path
+        self._data = scipy.io.loadmat(data_path)[self.ROOT_KEY][0, 0]
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the archive."""
+        return tuple(self._data.dtype.names)
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return self._data[batch].shape[1]
+
+    def cycle_life(self, batch: str, battery: int) -> int:
+        """Recorded cycle life of a battery."""
+        return int(self._data[batch][0, battery][0][0][0][3][0, 0])
+
+    def num_cycles(self, batch: str, battery: int) -> int:
+        """Number of simulated cycles for a battery."""
+        return len(self._data[batch][0, battery][2][0])
+
+    def cycle_channel(self, batch: str, battery: int, cycle: int, name: str) -> np.ndarray:
+        """
+        Get one simulated channel for a single cycle.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            cycle: One-based cycle number
+            name: Channel name from SIMULATION_CHANNELS
+
+        Returns:
+            Array of shape (1, samples)
+        """
+        return self._data[batch][0, battery][2][0][cycle - 1][SIMULATION_CHANNELS.index(name)]
+
+    def channel(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get one simulated channel for all cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Channel name from SIMULATION_CHANNELS
+
+        Returns:
+            Array of shape (cycles, 1, samples)
+
+        Raises:
+            ValueError: If the cycles have different numbers of samples
+        """
+        index = SIMULATION_CHANNELS.index(name)
+        cycles = [cycle[index] for cycle in self._data[batch][0, battery][2][0]]
+        shapes = {np.shape(cycle) for cycle in cycles}
+        if len(shapes) > 1:
+            raise ValueError(f"Simulated {name} of {batch}, battery {battery} has ragged cycle lengths: "
+                             f"{sorted(shapes)}")
+        return np.array(cycles)
+
+    def channels(self, batch: str, battery: int, names: Sequence[str],
+                 cycles: Optional[int] = None) -> np.ndarray:
+        """
+        Get several simulated channels for the leading cycles of a battery.
+
+        The per-cycle structs are read in a single pass for all channels.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            names: Channel names from SIMULATION_CHANNELS
+            cycles: Number of leading cycles (all if None)
+
+        Returns:
+            Array of shape (cycles, channels, samples)
+        """
+        indices = [SIMULATION_CHANNELS.index(name) for name in names]
+        return np.array([[cycle[index][0] for index in indices]
+                         for cycle in self._data[batch][0, battery][2][0][:cycles]])
+
+
+class ColumnarStore:
+    """
+    Read-only view of one archive converted to the columnar store.
+    """
+
+    def __init__(self, store_dir: str, kind: str):
+        """
+        Open the index and memory-map the data file.
+
+        Args:
+            store_dir: Directory written by convert_archives
+            kind: 'measured' or 'simulation'
+
+        Raises:
+            FileNotFoundError: If the store files do not exist
+            ValueError: If the store format is not supported or the data file
+                does not belong to the index
+        """
+        with open(os.path.join(store_dir, f'{kind}.json'), 'r') as f:
+            self.index = json.load(f)
+
+        if self.index.get('format') != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported store format: {self.index.get('format')}")
+
+        data_path = os.path.join(store_dir, f'{kind}.bin')
+        self._buffer = np.memmap(data_path, dtype=STORE_DTYPE, mode='r')
+
+        # Stores written before the generation token was added have none
+        generation = self.index.get('generation')
+        token = self._buffer[-(STORE_TOKEN_BYTES // self._buffer.itemsize):].tobytes()
+        if generation is not None and token != bytes.fromhex(generation):
+            raise ValueError(f"{data_path} does not match {kind}.json; the store was interrupted while "
+                             f"being written or is being rewritten")
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the store."""
+        return tuple(self.index['batteries'])
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return self.index['batteries'][batch]
+
+    def array(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get a stored array as a zero-copy view.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Array name
+
+        Returns:
+            Read-only array view into the memory-mapped file
+        """
+        offset, shape = self.index['arrays'][f'{batch}/{battery}/{name}']
+        size = int(np.prod(shape))
+        return self._buffer[offset:offset + size].reshape(shape)
+
+    def scalar(self, batch: str, battery: int, name: str) -> float:
+        """Get a stored scalar value."""
+        return self.index['scalars'][f'{batch}/{battery}/{name}']
+
+
+class ColumnarRetiredBatteryDataset(RetiredBatteryDataset):
+    """
+    Handle to the measured cycling data in a columnar store.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Open the store.
+
+        Args:
+            store_dir: Directory written by convert_archives
+        """
+        self.data_path = store_dir
+        self._store = ColumnarStore(store_dir, 'measured')
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the store."""
+        return self._store.batches
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return self._store.num_batteries(batch)
+
+    def channel(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get one measured channel for all cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Channel name from MEASURED_CHANNELS
+
+        Returns:
+            Array view of shape (cycles, samples)
+        """
+        return self._store.array(batch, battery, name)
+
+
+class ColumnarSimulationDataset(SimulationDataset):
+    """
+    Handle to the simulation outputs in a columnar store.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Open the store.
+
+        Args:
+            store_dir: Directory written by convert_archives
+        """
+        self.data_path = store_dir
+        self._store = ColumnarStore(store_dir, 'simulation')
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the store."""
+        return self._store.batches
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return self._store.num_batteries(batch)
+
+    def cycle_life(self, batch: str, battery: int) -> int:
+        """Recorded cycle life of a battery."""
+        return int(self._store.scalar(batch, battery, 'cycle_life'))
+
+    def num_cycles(self, batch: str, battery: int) -> int:
+        """Number of simulated cycles for a battery."""
+        return len(self.channel(batch, battery, SIMULATION_CHANNELS[0]))
+
+    def cycle_channel(self, batch: str, battery: int, cycle: int, name: str) -> np.ndarray:
+        """
+        Get one simulated channel for a single cycle.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            cycle: One-based cycle number
+            name: Channel name from SIMULATION_CHANNELS
+
+        Returns:
+            Array view of shape (1, samples)
+        """
+        return self.channel(batch, battery, name)[cycle - 1]
+
+    def channel(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get one simulated channel for all cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Channel name from SIMULATION_CHANNELS
+
+        Returns:
+            Array view of shape (cycles, 1, samples)
+        """
+        return self._store.array(batch, battery, name)
+
+    def channels(self, batch: str, battery: int, names: Sequence[str],
+                 cycles: Optional[int] = None) -> np.ndarray:
+        """
+        Get several simulated channels for the leading cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            names: Channel names from SIMULATION_CHANNELS
+            cycles: Number of leading cycles (all if None)
+
+        Returns:
+            Array of shape (cycles, channels, samples)
+        """
+        return np.stack([self.channel(batch, battery, name)[:cycles, 0] for name in names], axis=1)
+
+
+def _iter_archive_arrays(dataset: Union[RetiredBatteryDataset, SimulationDataset]
+                         ) -> Iterator[Tuple[str, int, str, np.ndarray]]:
+    """Yield (batch, battery, name, array) for every channel of an archive."""
+    channels = SIMULATION_CHANNELS if isinstance(dataset, SimulationDataset) else MEASURED_CHANNELS
+    for batch in dataset.batches:
+        for battery in range(dataset.num_batteries(batch)):
+            for name in channels:
+                yield batch, battery, name, dataset.channel(batch, battery, name)
+
+
+def write_store(dataset: Union[RetiredBatteryDataset, SimulationDataset],
+                store_dir: str, kind: str) -> None:
+    """
+    Write one dataset to ``{kind}.bin`` and ``{kind}.json`` in a store directory.
+
+    Any object with the accessors of the dataset classes can be written, e.g.
+    an in-memory dataset of synthetic cycles. Both files are written under
+    temporary names first and then replaced, the data file before the index;
+    the data file ends with the index's generation token.
+
+    Args:
+        dataset: Dataset handle to convert
+        store_dir: Existing output directory
+        kind: 'measured' or 'simulation'
+    """
+    itemsize = np.dtype(STORE_DTYPE).itemsize
+    generation = uuid.uuid4()
+    index = {'format': STORE_FORMAT_VERSION, 'source': os.path.basename(dataset.data_path),
+             'dtype': np.dtype(STORE_DTYPE).name, 'generation': generation.hex,
+             'batteries': {}, 'arrays': {}, 'scalars': {}}
+
+    for batch in dataset.batches:
+        index['batteries'][batch] = dataset.num_batteries(batch)
+        if isinstance(dataset, SimulationDataset):
+            for battery in range(dataset.num_batteries(batch)):
+                index['scalars'][f'{batch}/{battery}/cycle_life'] = dataset.cycle_life(batch, battery)
+
+    data_path = os.path.join(store_dir, f'{kind}.bin')
+    index_path = os.path.join(store_dir, f'{kind}.json')
+    tmp_data_path = f'{data_path}.{generation.hex}.tmp'
+    tmp_index_path = f'{index_path}.{generation.hex}.tmp'
+    offset = 0
+    with open(tmp_data_path, 'wb') as f:
+        for batch, battery, name, values in _iter_archive_arrays(dataset):
+            values = np.ascontiguousarray(values, dtype=STORE_DTYPE)
+
+            # Align every array to a cache-line boundary
+            padding = -offset % (STORE_ALIGNMENT // itemsize)
+            f.write(b'\0' * (padding * itemsize))
+            offset += padding
+
+            f.write(values.tobytes())
+            index['arrays'][f'{batch}/{battery}/{name}'] = [offset, list(values.shape)]
+            offset += values.size
+        f.write(generation.bytes)
+    with open(tmp_index_path, 'w') as f:
+        json.dump(index, f)
+
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_index_path, index_path)
+
+
+def convert_archives(store_dir: str, measured_path: Optional[str] = None,
+                     simulation_path: Optional[str] = None) -> None:
+    """
+    Convert the MATLAB archives to the columnar store.
+
+    Args:
+        store_dir: Output directory
+        measured_path: Path to RetiredBatteryData_all.mat (skipped if None)
+        simulation_path: Path to SimulationData_RetiredBattery.mat (skipped if None)
+
+    Raises:
+        ValueError: If no archive is given or simulated cycles have ragged lengths
+    """
+    if measured_path is None and simulation_path is None:
+        raise ValueError("At least one archive path must be provided")
+
+    os.makedirs(store_dir, exist_ok=True)
+    if measured_path is not None:
+        write_store(RetiredBatteryDataset(measured_path), store_dir, 'measured')
+    if simulation_path is not None:
+        write_store(SimulationDataset(simulation_path), store_dir, 'simulation')
+
+
+def open_dataset(data_path: str, kind: str = 'measured'
+                 ) -> Union[RetiredBatteryDataset, SimulationDataset]:
+    """
+    Open an archive once per process and return the shared handle.
+
+    Args:
+        data_path: Path to the .mat file, or to a columnar store directory
+        kind: 'measured' for RetiredBatteryData_all.mat or 'simulation' for
+            SimulationData_RetiredBattery.mat
+
+    Returns:
+        Shared dataset handle
+
+    Raises:
+        ValueError: If kind is unknown
+    """
+    if os.path.isdir(data_path):
+        dataset_types: Dict[str, type] = {'measured': ColumnarRetiredBatteryDataset,
+                                          'simulation': ColumnarSimulationDataset}
+    else:
+        dataset_types = {'measured': RetiredBatteryDataset,
+                         'simulation': SimulationDataset}
+    if kind not in dataset_types:
+        raise ValueError(f"Unknown dataset kind: {kind}")
+
+    key = (os.path.abspath(data_path), kind)
+    with _open_lock:
+        if key not in _open_datasets:
+            _open_datasets[key] = dataset_types[kind](data_path)
+        return _open_datasets[key]
+
+
+def main():
+    """
+    Command-line entry point for converting the archives to a columnar store
+    """
+    parser = argparse.ArgumentParser(description="Convert battery .mat archives to a columnar store")
+    parser.add_argument('store_dir', help="Output directory of the columnar store")
+    parser.add_argument('--measured', help="Path to RetiredBatteryData_all.mat")
+    parser.add_argument('--simulation', help="Path to SimulationData_RetiredBattery.mat")
+    args = parser.parse_args()
+
+    convert_archives(args.store_dir, args.measured, args.simulation)
+    print(f"Columnar store written to {args.store_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Stepping Benchmark
+==================
+
+Compare the fixed-step and adaptive-step discharge simulations for accuracy
+and speed.
+
+Random (qMax, Ro, wr) points of the estimation box are simulated with both
+modes of DischargeSimulator and with a tight-tolerance reference run. Each
+trace is aligned to the loss's 100-point SOC grid of every batch's working
+condition (Mid_SOC, DOD) from BATCH_WORKING_CONDITIONS, and the maximum
+voltage error against the reference is reported per batch and overall,
+together with the mean wall-clock time per simulation. Model configuration (including the reference UKF) is
+done before timing, so the times cover the simulation alone.
+
+Example:
+    python benchmark_stepping.py --data RetiredBatteryData_all.mat --points 20 --temperature 25
+    python benchmark_stepping.py --batches batch01 batch21
+"""
+
+import argparse
+import json
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from batt_parameter_optimization_function import (BatteryParameterEstimator, DischargeSimulator,
+                                                  LossContext)
+from battery_dataset import BATCH_WORKING_CONDITIONS, working_condition
+from test_parameter_Estimation import PARAMETER_BOUNDS, setup_battery_model
+
+# Solver and tolerance of the reference run
+REFERENCE_METHOD = 'DOP853'
+REFERENCE_RTOL = 1e-10
+
+
+def benchmark(data_path: str, points: int = 10, temperature: float = 25.0,
+              rtols: List[float] = (1e-4, 1e-6, 1e-8), repeats: int = 3,
+              seed: int = 0, batches: Optional[Sequence[str]] = None) -> Dict:
+    """
+    Benchmark fixed and adaptive stepping on random parameter points.
+
+    Args:
+        data_path: Battery data file or columnar store holding the batch21 reference
+        points: Number of random parameter points
+        temperature: Measured initial temperature (Celsius)
+        rtols: Relative tolerances of the adaptive runs
+        repeats: Timed repetitions per point and mode
+        seed: Seed of the parameter sampling
+        batches: Batches whose working conditions the traces are aligned for
+            (all batches if None)
+
+    Returns:
+        Dictionary with one entry per mode: mean and maximum SOC-grid voltage error
+        against the reference (V) over all batches, the maximum error per
+        batch (V), mean in-window trace length and mean time per simulation (s)
+    """
+    rng = np.random.default_rng(seed)
+    battery, initial_state = setup_battery_model(temperature, 2)
+    initial_temperature = temperature + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+
+    # Aligning only needs the SOC grid of each batch's LossContext
+    samples = BatteryParameterEstimator.DEFAULT_SOC_SAMPLES
+    grids = {batch: LossContext(np.zeros(samples), *working_condition(batch))
+             for batch in (batches if batches is not None else BATCH_WORKING_CONDITIONS)}
+
+    simulators = {'fixed': DischargeSimulator(battery, initial_state, data_path)}
+    for rtol in rtols:
+        simulators[f'adaptive (rtol={rtol:g})'] = DischargeSimulator(
+            battery, initial_state, data_path, stepping='adaptive', rtol=rtol)
+    reference = DischargeSimulator(battery, initial_state, data_path, stepping='adaptive',
+                                   method=REFERENCE_METHOD, rtol=REFERENCE_RTOL)
+
+    errors = {mode: {batch: [] for batch in grids} for mode in simulators}
+    lengths = {mode: [] for mode in simulators}
+    times = {mode: [] for mode in simulators}
+    for _ in range(points):
+        params = {key: float(rng.uniform(lower, upper)) for key, (lower, upper) in PARAMETER_BOUNDS.items()}
+        reference_voltage, _ = reference.simulate(params, initial_temperature)
+
+        for mode, simulator in simulators.items():
+            simulator.configure(params, initial_temperature)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                simulated_voltage, _ = simulator.simulate(params, initial_temperature)
+            times[mode].append((time.perf_counter() - start) / repeats)
+            lengths[mode].append(len(simulated_voltage))
+            for batch, grid in grids.items():
+                error = np.abs(grid.align(simulated_voltage) - grid.align(reference_voltage))
+                errors[mode][batch].append(float(np.max(error)))
+
+    return {
+        mode: {
+            'mean_error': float(np.mean(list(errors[mode].values()))),
+            'max_error': float(np.max(list(errors[mode].values()))),
+            'max_error_by_batch': {batch: float(np.max(batch_errors))
+                                   for batch, batch_errors in errors[mode].items()},
+            'mean_samples': float(np.mean(lengths[mode])),
+            'mean_time': float(np.mean(times[mode])),
+        }
+        for mode in simulators
+    }
+
+
+def main():
+    """
+    Command-line entry point for the stepping benchmark
+    """
+    parser = argparse.ArgumentParser(description="Benchmark fixed against adaptive time stepping")
+    parser.add_argument('--data', default='RetiredBatteryData_all.mat',
+                        help="Battery data file or columnar store directory")
+    parser.add_argument('--points', type=int, default=10, help="Number of random parameter points")
+    parser.add_argument('--temperature', type=float, default=25.0, help="Initial temperature (Celsius)")
+    parser.add_argument('--rtol', type=float, nargs='+', default=[1e-4, 1e-6, 1e-8],
+                        help="Relative tolerances of the adaptive runs")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed repetitions per point")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the parameter sampling")
+    parser.add_argument('--batches', nargs='+', default=None,
+                        help="Batches whose working conditions are evaluated (all if omitted)")
+    parser.add_argument('--json', default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = benchmark(args.data, args.points, args.temperature, args.rtol, args.repeats, args.seed,
+                        args.batches)
+
+    fixed_time = results['fixed']['mean_time']
+    print(f"{'mode':<24} {'mean err (mV)':>14} {'max err (mV)':>13} {'samples':>8} "
+          f"{'time (ms)':>10} {'speed-up':>9}")
+    for mode, result in results.items():
+        print(f"{mode:<24} {1e3 * result['mean_error']:>14.3f} {1e3 * result['max_error']:>13.3f} "
+              f"{result['mean_samples']:>8.0f} {1e3 * result['mean_time']:>10.1f} "
+              f"{fixed_time / result['mean_time']:>8.2f}x")
+
+    # Maximum error per working condition; DOD = 1 (batch21) is where fixed stepping errs most
+    print(f"\n{'batch':<8} {'Mid_SOC':>7} {'DOD':>5} " + ' '.join(f"{mode:>24}" for mode in results))
+    for batch in results['fixed']['max_error_by_batch']:
+        mid_soc, dod = working_condition(batch)
+        print(f"{batch:<8} {mid_soc:>7.2f} {dod:>5.2f} "
+              + ' '.join(f"{1e3 * result['max_error_by_batch'][batch]:>21.3f} mV" for result in results.values()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
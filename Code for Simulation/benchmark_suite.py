@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite
+===============
+
+Reproducible benchmarks of the simulation and estimation hot paths that run
+offline on synthetic data.
+
+The synthetic data set is generated with ``BatteryElectroChem``: every
+battery of the benchmark batch discharges at 5.2 A over a number of cycles
+with a fading capacity and a growing internal resistance, and its voltage is
+perturbed with seeded Gaussian noise. The cycles are written to a columnar
+store together with a batch21 reference battery, so the pipeline runs on it
+exactly as on the converted archives and the .mat files are not needed.
+
+The suite times
+
+    - ``resample_cycle`` and ``prepare_cycle`` (the replacement of
+      ``interpolate_discharge_data``),
+    - ``simulate_battery_discharge``,
+    - ``calculate_optimization_error``,
+    - one full ``estimate_params`` cycle at a fixed number of iterations and
+      optimizer seed, and
+    - the end-to-end throughput of ``parallel_estimation.run_parallel`` in
+      cycles per minute at 1, 4 and N workers.
+
+Single-call benchmarks run once untimed (which also fills the reference-state
+cache) and then report statistics over the timed repeats. Results are written
+as JSON together with the versions and machine they were measured with;
+``--baseline`` compares a run against an earlier JSON file and lists the
+benchmarks that got slower.
+
+Example:
+    python benchmark_suite.py --output benchmarks.json --workers 1 4 N
+    python benchmark_suite.py --output new.json --baseline benchmarks.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from importlib import metadata
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from progpy.loading import Piecewise
+
+from batt_parameter_optimization_function import (battery_working_condition_match,
+                                                  calculate_optimization_error, estimate_params,
+                                                  simulate_battery_discharge)
+from battery_dataset import (MEASURED_CHANNELS, REFERENCE_BATCH, REFERENCE_BATTERY,
+                             RetiredBatteryDataset, open_dataset, write_store)
+from cycle_preprocessing import DEFAULT_INTERVAL, DISCHARGE_CURRENT, prepare_cycle, resample_cycle
+from parallel_estimation import run_parallel
+from test_parameter_Estimation import PARAMETER_BOUNDS, PARAMETER_KEYS, setup_battery_model
+
+# Synthetic battery: fresh parameters and their per-cycle aging
+SYNTHETIC_QMAX = 9000.0
+SYNTHETIC_RO = 0.10
+SYNTHETIC_WR = 8e-6
+CAPACITY_FADE = 0.002  # Fraction of qMax lost per cycle
+RESISTANCE_GROWTH = 0.005  # Fraction of Ro gained per cycle
+CELL_SPREAD = 0.05  # Relative cell-to-cell spread of the fresh parameters
+VOLTAGE_NOISE = 1e-3  # Standard deviation of the measurement noise (V)
+SYNTHETIC_TEMPERATURE = 25.0  # Ambient temperature (Celsius)
+
+# Batch the benchmarks estimate on
+BENCHMARK_BATCH = 'batch01'
+
+# Parameters simulated by the single-simulation benchmarks
+BENCHMARK_PARAMS = {'qMax': SYNTHETIC_QMAX, 'Ro': SYNTHETIC_RO, 'wr': SYNTHETIC_WR}
+
+# Format version of the JSON results
+RESULTS_FORMAT_VERSION = 1
+
+
+class SyntheticDataset(RetiredBatteryDataset):
+    """
+    In-memory measured dataset with the accessors of RetiredBatteryDataset.
+    """
+
+    def __init__(self, channels: Dict[str, List[Dict[str, np.ndarray]]]):
+        """
+        Initialize the dataset.
+
+        Args:
+            channels: Per batch, one dictionary per battery mapping every name in
+                MEASURED_CHANNELS to an array of shape (cycles, samples)
+        """
+        self.data_path = 'synthetic'
+        self._channels = channels
+
+    @property
+    def batches(self) -> Tuple[str, ...]:
+        """Names of the batches in the dataset."""
+        return tuple(self._channels)
+
+    def num_batteries(self, batch: str) -> int:
+        """Number of batteries in a batch."""
+        return len(self._channels[batch])
+
+    def channel(self, batch: str, battery: int, name: str) -> np.ndarray:
+        """
+        Get one measured channel for all cycles of a battery.
+
+        Args:
+            batch: Batch name
+            battery: Zero-based battery index
+            name: Channel name from MEASURED_CHANNELS
+
+        Returns:
+            Array of shape (cycles, samples)
+        """
+        return self._channels[batch][battery][name]
+
+
+def synthetic_discharge(qmax: float, ro: float, samples: int,
+                        wr: float = SYNTHETIC_WR) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Simulate one constant-current discharge with BatteryElectroChem.
+
+    The parameters are applied as in DischargeSimulator, starting from the
+    model's default state instead of a UKF estimate.
+
+    Args:
+        qmax: Maximum charge qMax
+        ro: Internal resistance Ro (Ohm)
+        samples: Number of evenly spaced samples from start to end of discharge
+        wr: Warburg resistance parameter
+
+    Returns:
+        Tuple of (time (s), voltage (V), temperature (Celsius)) arrays
+    """
+    battery, initial_state = setup_battery_model(SYNTHETIC_TEMPERATURE, DEFAULT_INTERVAL)
+    battery.parameters.data['wr'] = wr
+    battery.parameters['Ro'] = ro
+    battery.parameters['qMax'] = qmax
+
+    x0 = {key: float(initial_state[key]) for key in battery.states}
+    x0['qMax'] = qmax
+    x0['Ro'] = ro
+    Q_transfer_parameter = qmax / (battery.parameters['qMaxThreshold'] / 0.7)
+    for param in ['qnS', 'qnB', 'qpS', 'qpB']:
+        x0[param] *= Q_transfer_parameter
+    battery.parameters['x0'] = battery.StateContainer(x0)
+
+    future_loading = Piecewise(battery.InputContainer, [float('inf')], {'i': [DISCHARGE_CURRENT]})
+    simulated_results = battery.simulate_to_threshold(future_loading, dt=DEFAULT_INTERVAL,
+                                                      save_freq=DEFAULT_INTERVAL,
+                                                      print=False, progress=False)
+
+    times = np.asarray(simulated_results.times, dtype=float)
+    time_grid = np.linspace(0, times[-1], samples)
+    voltage = np.interp(time_grid, times, [float(z['v']) for z in simulated_results.outputs])
+    temperature = np.interp(time_grid, times, [float(z['t']) for z in simulated_results.outputs])
+    return time_grid, voltage, temperature
+
+
+def synthetic_battery(qmax: float, ro: float, cycles: int, samples: int,
+                      rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    """
+    Simulate the aging discharge cycles of one battery.
+
+    Args:
+        qmax: Fresh maximum charge qMax
+        ro: Fresh internal resistance Ro (Ohm)
+        cycles: Number of cycles
+        samples: Samples per cycle
+        rng: Generator of the measurement noise
+
+    Returns:
+        Dictionary mapping every name in MEASURED_CHANNELS to an array of shape
+        (cycles, samples); channels that are not simulated are zero
+    """
+    discharges = [synthetic_discharge(qmax * (1 - CAPACITY_FADE * cycle),
+                                      ro * (1 + RESISTANCE_GROWTH * cycle), samples)
+                  for cycle in range(cycles)]
+    discharge_time, voltage, temperature = (np.stack(channel) for channel in zip(*discharges))
+    voltage = voltage + rng.normal(0, VOLTAGE_NOISE, voltage.shape)
+
+    channels = {name: np.zeros((cycles, samples)) for name in MEASURED_CHANNELS}
+    channels.update(discharge_t_s=discharge_time, discharge_V=voltage, discharge_T=temperature,
+                    discharge_I=np.full((cycles, samples), DISCHARGE_CURRENT))
+    return channels
+
+
+def make_synthetic_store(store_dir: str, batteries: int = 2, cycles: int = 8,
+                         samples: int = 500, seed: int = 0) -> None:
+    """
+    Generate the synthetic data set and write it as a columnar store.
+
+    Args:
+        store_dir: Output directory
+        batteries: Number of batteries in BENCHMARK_BATCH
+        cycles: Number of cycles per battery
+        samples: Samples per cycle
+        seed: Seed of the cell spread and measurement noise
+    """
+    rng = np.random.default_rng(seed)
+    channels = {BENCHMARK_BATCH: [], REFERENCE_BATCH: []}
+    for _ in range(batteries):
+        qmax, ro = (value * rng.uniform(1 - CELL_SPREAD, 1 + CELL_SPREAD)
+                    for value in (SYNTHETIC_QMAX, SYNTHETIC_RO))
+        channels[BENCHMARK_BATCH].append(synthetic_battery(qmax, ro, cycles, samples, rng))
+
+    # Only the first sample of the reference battery is used
+    for _ in range(REFERENCE_BATTERY + 1):
+        channels[REFERENCE_BATCH].append(synthetic_battery(SYNTHETIC_QMAX, SYNTHETIC_RO, 1, samples, rng))
+
+    os.makedirs(store_dir, exist_ok=True)
+    write_store(SyntheticDataset(channels), store_dir, 'measured')
+
+
+def time_call(function: Callable[[], object], repeats: int, warmup: int = 1) -> Dict[str, float]:
+    """
+    Time repeated calls of a function.
+
+    Args:
+        function: Function to call without arguments
+        repeats: Number of timed calls
+        warmup: Number of untimed calls before the timed ones
+
+    Returns:
+        Dictionary with the number of repeats and the median, mean, minimum,
+        maximum and standard deviation of the call times (s)
+    """
+    for _ in range(warmup):
+        function()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'repeats': repeats,
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'min': min(times),
+        'max': max(times),
+        'stdev': statistics.stdev(times) if repeats > 1 else 0.0,
+    }
+
+
+def benchmark_hot_paths(store_dir: str, work_dir: str, repeats: int = 20,
+                        iterations: int = 10, seed: int = 0, stepping: str = 'fixed'
+                        ) -> Dict[str, Dict]:
+    """
+    Time the preprocessing, simulation, loss and one full estimation cycle.
+
+    Args:
+        store_dir: Synthetic columnar store
+        work_dir: Directory for the estimation results
+        repeats: Timed repeats of the single-call benchmarks
+        iterations: Optimization iterations of the estimation cycle
+        seed: Optimizer seed of the estimation cycle
+        stepping: Time stepping of the estimation cycle ('fixed' or 'adaptive')
+
+    Returns:
+        Dictionary of call-time statistics per benchmark; the estimate_params
+        entry also holds the evaluation count and the estimate
+    """
+    dataset = open_dataset(store_dir)
+    batch, battery, cycle = BENCHMARK_BATCH, 0, 1
+    mid_soc, dod = battery_working_condition_match(batch)
+    results = {}
+
+    time_s = np.array(dataset.discharge_time(batch, battery, cycle))
+    voltage = np.array(dataset.discharge_voltage(batch, battery, cycle))
+    temperature = np.array(dataset.discharge_temperature(batch, battery, cycle))
+    results['resample_cycle'] = time_call(
+        lambda: resample_cycle(time_s, voltage, temperature, DEFAULT_INTERVAL), repeats)
+    results['prepare_cycle'] = time_call(
+        lambda: prepare_cycle(dataset, batch, battery, cycle, DEFAULT_INTERVAL), repeats)
+
+    prepared = prepare_cycle(dataset, batch, battery, cycle, DEFAULT_INTERVAL)
+    runs = [(prepared.time, prepared.current, prepared.outputs)]
+    model, initial_state = setup_battery_model(prepared.temperature[0], DEFAULT_INTERVAL)
+    results['simulate_battery_discharge'] = time_call(
+        lambda: simulate_battery_discharge(model, runs, BENCHMARK_PARAMS, dataset), repeats)
+
+    simulated_voltage, _ = simulate_battery_discharge(model, runs, BENCHMARK_PARAMS, dataset)
+    results['calculate_optimization_error'] = time_call(
+        lambda: calculate_optimization_error(simulated_voltage, prepared.voltage, mid_soc, dod),
+        repeats)
+
+    # One cycle as process_battery_cycle runs it, with a seeded optimizer
+    estimate = {}
+
+    def estimate_cycle() -> None:
+        battery_model, battery_initial_state = setup_battery_model(prepared.temperature[0],
+                                                                   DEFAULT_INTERVAL)
+        with contextlib.redirect_stdout(io.StringIO()):
+            estimate['params'] = estimate_params(
+                battery_model, battery_initial_state, mid_soc, dod,
+                batch, battery, cycle, dataset, work_dir, iterations,
+                times=prepared.time, inputs=prepared.current, outputs=prepared.outputs,
+                keys=PARAMETER_KEYS, bounds=PARAMETER_BOUNDS, dt=DEFAULT_INTERVAL,
+                error_method='MAX_E', save_parameters=False, stepping=stepping,
+                random_state=seed
+            )
+
+    results['estimate_params'] = time_call(estimate_cycle, 1, warmup=0)
+    results['estimate_params'].update(dict(zip(PARAMETER_KEYS, map(float, estimate['params']))),
+                                      iterations=iterations, seed=seed, stepping=stepping)
+    return results
+
+
+def benchmark_throughput(store_dir: str, work_dir: str, worker_counts: Sequence[int],
+                         jobs: int, iterations: int = 10, stepping: str = 'fixed'
+                         ) -> Dict[str, Dict]:
+    """
+    Measure the end-to-end estimation throughput of run_parallel.
+
+    Every run includes starting the worker processes and writing the results.
+
+    Args:
+        store_dir: Synthetic columnar store
+        work_dir: Directory for the estimation results
+        worker_counts: Numbers of worker processes to measure
+        jobs: Number of cycles estimated per run
+        iterations: Optimization iterations per cycle
+        stepping: Time stepping of the simulations ('fixed' or 'adaptive')
+
+    Returns:
+        Dictionary per worker count with the number of cycles completed, the
+        wall time (s) and the cycles per minute
+    """
+    dataset = open_dataset(store_dir)
+    all_jobs = [(BENCHMARK_BATCH, battery, cycle)
+                for battery in range(dataset.num_batteries(BENCHMARK_BATCH))
+                for cycle in range(1, dataset.num_cycles(BENCHMARK_BATCH, battery) + 1)]
+    selected = all_jobs[:jobs]
+
+    results = {}
+    for workers in worker_counts:
+        save_path = os.path.join(work_dir, f'throughput_{workers}')
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            records = run_parallel(selected, store_dir, save_path, iterations, workers,
+                                   stepping=stepping)
+        elapsed = time.perf_counter() - start
+
+        completed = sum(record['status'] == 'done' for record in records)
+        results[str(workers)] = {
+            'cycles': completed,
+            'failed': len(records) - completed,
+            'seconds': elapsed,
+            'cycles_per_minute': 60 * completed / elapsed,
+        }
+        print(f"  {workers:>3} workers: {results[str(workers)]['cycles_per_minute']:.2f} cycles/min")
+    return results
+
+
+def environment() -> Dict[str, Optional[str]]:
+    """
+    Describe the code version and machine a benchmark ran on.
+
+    Returns:
+        Dictionary with the git commit (None outside a checkout), the Python and
+        package versions, the platform and the number of CPUs
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    packages = {}
+    for package in ('numpy', 'scipy', 'progpy', 'bayesian-optimization'):
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'packages': packages,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare_results(results: Dict, baseline: Dict, threshold: float = 0.1) -> List[str]:
+    """
+    Compare benchmark results against a baseline run.
+
+    Args:
+        results: Results of this run
+        baseline: Results of an earlier run
+        threshold: Relative slowdown reported as a regression
+
+    Returns:
+        Names of the benchmarks that are more than threshold slower
+    """
+    rows = []
+    for name, result in results['benchmarks'].items():
+        if name in baseline.get('benchmarks', {}):
+            rows.append((name, baseline['benchmarks'][name]['median'], result['median']))
+    for workers, result in results.get('throughput', {}).items():
+        if workers in baseline.get('throughput', {}):
+            # Minutes per cycle, so that larger is slower as for the call times
+            rows.append((f'throughput ({workers} workers)',
+                         1 / baseline['throughput'][workers]['cycles_per_minute'],
+                         1 / result['cycles_per_minute']))
+
+    regressions = []
+    print(f"\n{'benchmark':<32} {'ratio':>8}")
+    for name, before, after in rows:
+        ratio = after / before
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  slower'
+        print(f"{name:<32} {ratio:>7.2f}x{flag}")
+    return regressions
+
+
+def parse_workers(specs: Sequence[str]) -> List[int]:
+    """
+    Parse worker counts, where 'N' is the number of CPUs.
+
+    Args:
+        specs: Worker counts as strings
+
+    Returns:
+        Distinct worker counts in the given order
+    """
+    counts = []
+    for spec in specs:
+        count = os.cpu_count() if spec.upper() == 'N' else int(spec)
+        if count not in counts:
+            counts.append(count)
+    return counts
+
+
+def main():
+    """
+    Command-line entry point for the benchmark suite
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the simulation and estimation hot paths")
+    parser.add_argument('--output', default='benchmarks.json', help="JSON file for the results")
+    parser.add_argument('--baseline', default=None, help="Earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown against the baseline reported as a regression")
+    parser.add_argument('--work-dir', default=None,
+                        help="Directory for the synthetic data and results (temporary if omitted)")
+    parser.add_argument('--batteries', type=int, default=2, help="Synthetic batteries")
+    parser.add_argument('--cycles', type=int, default=8, help="Synthetic cycles per battery")
+    parser.add_argument('--repeats', type=int, default=20, help="Timed repeats of single-call benchmarks")
+    parser.add_argument('--iterations', type=int, default=10, help="Optimization iterations per cycle")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the data and the optimizer")
+    parser.add_argument('--stepping', choices=('fixed', 'adaptive'), default='fixed',
+                        help="Time stepping of the estimation benchmarks")
+    parser.add_argument('--workers', nargs='+', default=['1', '4', 'N'],
+                        help="Worker counts of the throughput benchmark ('N' for all CPUs)")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Cycles per throughput run (default: all synthetic cycles)")
+    parser.add_argument('--skip-throughput', action='store_true', help="Skip the throughput benchmark")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='battery_benchmarks_')
+    store_dir = os.path.join(work_dir, 'store')
+    try:
+        print(f"Generating {args.batteries} x {args.cycles} synthetic cycles")
+        make_synthetic_store(store_dir, args.batteries, args.cycles, seed=args.seed)
+
+        print("Timing hot paths")
+        benchmarks = benchmark_hot_paths(store_dir, os.path.join(work_dir, 'estimate'), args.repeats,
+                                         args.iterations, args.seed, args.stepping)
+        throughput = {}
+        if not args.skip_throughput:
+            jobs = args.jobs or args.batteries * args.cycles
+            print(f"Measuring throughput on {jobs} cycles")
+            throughput = benchmark_throughput(store_dir, work_dir, parse_workers(args.workers), jobs,
+                                              args.iterations, args.stepping)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'format': RESULTS_FORMAT_VERSION,
+        'environment': environment(),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'threshold', 'work_dir')},
+        'benchmarks': benchmarks,
+        'throughput': throughput,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'benchmark':<32} {'median (ms)':>12} {'min (ms)':>10}")
+    for name, result in benchmarks.items():
+        print(f"{name:<32} {1e3 * result['median']:>12.3f} {1e3 * result['min']:>10.3f}")
+    print(f"Saved {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_results(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Comparison Plots
+================
+
+Post-processing command that renders the simulated-vs-observed voltage plots
+of finished estimation runs.
+
+Estimation saves each cycle's plot inputs to
+``{save_path}/{batch}/Battery{n}/Figure/data/{cycle}.npz``; this command turns
+them into ``Figure/{cycle}.jpg``. Each battery is one task in a process pool,
+and a worker draws all of a battery's cycles on a single reused figure. Plots
+that are newer than their data are skipped unless ``--force`` is given.
+
+Example:
+    python comparison_plots.py Simulation_data_NASA --batches 1-21 --workers 16
+"""
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from matplotlib.figure import Figure
+
+from batt_parameter_optimization_function import create_comparison_plot, load_comparison_data
+from parallel_estimation import parse_range
+
+
+def find_batteries(save_path: str, batch_numbers: Optional[List[int]] = None,
+                   batteries: Optional[List[int]] = None) -> List[Tuple[str, int]]:
+    """
+    Find the batteries with saved comparison plot data.
+
+    Args:
+        save_path: Base path of the estimation results
+        batch_numbers: Batch numbers to include (all if None)
+        batteries: Battery numbers to include (all if None)
+
+    Returns:
+        Sorted list of (batch_name, battery_number) tuples
+    """
+    found = []
+    for data_dir in glob.glob(os.path.join(save_path, 'batch*', 'Battery*', 'Figure', 'data')):
+        battery_dir = os.path.dirname(os.path.dirname(data_dir))
+        batch_name = os.path.basename(os.path.dirname(battery_dir))
+        battery_number = int(os.path.basename(battery_dir)[len('Battery'):])
+        if batch_numbers is not None and int(batch_name[len('batch'):]) not in batch_numbers:
+            continue
+        if batteries is not None and battery_number not in batteries:
+            continue
+        found.append((batch_name, battery_number))
+    return sorted(found)
+
+
+def render_battery(save_path: str, batch_name: str, battery_number: int,
+                   dpi: int = 300, force: bool = False) -> int:
+    """
+    Render the comparison plots of all saved cycles of one battery.
+
+    Args:
+        save_path: Base path of the estimation results
+        batch_name: Name of the battery batch
+        battery_number: Battery number identifier
+        dpi: Resolution of the saved JPEGs
+        force: Re-render plots that are newer than their data
+
+    Returns:
+        Number of plots rendered
+    """
+    figure_dir = os.path.join(save_path, batch_name, f'Battery{battery_number}', 'Figure')
+    figure = Figure(figsize=(10, 6))
+    rendered = 0
+
+    for data_path in glob.glob(os.path.join(figure_dir, 'data', '*.npz')):
+        cycle_number = int(os.path.splitext(os.path.basename(data_path))[0])
+        plot_path = os.path.join(figure_dir, f'{cycle_number}.jpg')
+        if not force and os.path.exists(plot_path) and os.path.getmtime(plot_path) >= os.path.getmtime(data_path):
+            continue
+
+        simulated_voltage, true_voltage, Mid_SOC, DOD = load_comparison_data(data_path)
+        create_comparison_plot(simulated_voltage, true_voltage, Mid_SOC, DOD, battery_number,
+                               cycle_number, batch_name, save_path, figure=figure, dpi=dpi)
+        rendered += 1
+
+    return rendered
+
+
+def main():
+    """
+    Command-line entry point for rendering comparison plots
+    """
+    parser = argparse.ArgumentParser(description="Render comparison plots from saved estimation results")
+    parser.add_argument('save_path', help="Base path of the estimation results")
+    parser.add_argument('--batches', default=None, help="Batch numbers, e.g. '1-3,5' (default: all)")
+    parser.add_argument('--batteries', default=None, help="Battery numbers, e.g. '0,2' (default: all)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument('--dpi', type=int, default=300, help="Resolution of the saved JPEGs")
+    parser.add_argument('--force', action='store_true', help="Re-render plots that are up to date")
+    args = parser.parse_args()
+
+    batch_numbers = parse_range(args.batches) if args.batches else None
+    batteries = parse_range(args.batteries) if args.batteries else None
+    tasks = find_batteries(args.save_path, batch_numbers, batteries)
+    print(f"Rendering plots of {len(tasks)} batteries on {args.workers} workers")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(render_battery, args.save_path, batch_name, battery_number,
+                                   args.dpi, args.force)
+                   for batch_name, battery_number in tasks]
+        total = 0
+        for (batch_name, battery_number), future in zip(tasks, futures):
+            rendered = future.result()
+            total += rendered
+            print(f"{batch_name}, Battery {battery_number}: {rendered} plots")
+
+    print(f"\nRendered {total} plots in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
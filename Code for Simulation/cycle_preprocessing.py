@@ -0,0 +1,183 @@
+"""
+Cycle Preprocessing
+===================
+
+Resample measured discharge cycles onto the regular time grid used for
+parameter estimation, keeping the data as NumPy arrays.
+
+Each cycle's voltage and temperature are interpolated with one not-a-knot
+cubic spline over both channels, which gives the same values as the two
+``interp1d(kind='cubic')`` objects used before. Cycles whose durations round
+to the same length share one read-only time grid and current array. A cycle
+is handed to ``estimate_params`` as
+
+    - ``time``: the time grid (s),
+    - ``current``: the constant discharge current on the grid (A), and
+    - ``outputs``: an array of shape (samples, 2) with columns t and v, in
+      the order of the model's outputs,
+
+instead of lists of per-sample dictionaries and containers.
+``prepare_battery_cycles`` yields the cycles of a battery one at a time, so
+only the cycle being estimated is held in memory.
+"""
+
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+import numpy as np
+from scipy.interpolate import make_interp_spline
+
+from battery_dataset import RetiredBatteryDataset
+import profiling
+
+# Constant discharge current of the measured cycles (A)
+DISCHARGE_CURRENT = 5.2
+
+# Spacing of the resampled time grid (s)
+DEFAULT_INTERVAL = 2
+
+# Shared read-only grids, keyed by (duration, samples)
+_TIME_GRIDS: Dict[Tuple[int, int], np.ndarray] = {}
+_CURRENTS: Dict[int, np.ndarray] = {}
+
+
+class PreparedCycle(NamedTuple):
+    """One discharge cycle resampled onto a regular time grid."""
+    cycle: int
+    time: np.ndarray
+    current: np.ndarray
+    outputs: np.ndarray
+
+    @property
+    def temperature(self) -> np.ndarray:
+        """Resampled temperature (Celsius)."""
+        return self.outputs[:, 0]
+
+    @property
+    def voltage(self) -> np.ndarray:
+        """Resampled voltage (V)."""
+        return self.outputs[:, 1]
+
+
+def time_grid(max_time: float, interval: float = DEFAULT_INTERVAL) -> np.ndarray:
+    """
+    Get the shared time grid for a cycle of the given duration.
+
+    The grid runs from 0 to the whole seconds of max_time in
+    floor(max_time / interval) + 1 evenly spaced points.
+
+    Args:
+        max_time: Last measured time of the cycle (s)
+        interval: Nominal grid spacing (s)
+
+    Returns:
+        Read-only time grid
+    """
+    key = (int(np.floor(max_time)), int(np.floor(max_time / interval)) + 1)
+    if key not in _TIME_GRIDS:
+        grid = np.linspace(0, *key)
+        grid.flags.writeable = False
+        _TIME_GRIDS[key] = grid
+    return _TIME_GRIDS[key]
+
+
+def constant_current(samples: int) -> np.ndarray:
+    """
+    Get the shared constant discharge current array.
+
+    Args:
+        samples: Number of samples
+
+    Returns:
+        Read-only array of DISCHARGE_CURRENT
+    """
+    if samples not in _CURRENTS:
+        current = np.full(samples, DISCHARGE_CURRENT)
+        current.flags.writeable = False
+        _CURRENTS[samples] = current
+    return _CURRENTS[samples]
+
+
+def resample_cycle(time: np.ndarray, voltage: np.ndarray, temperature: np.ndarray,
+                   interval: float = DEFAULT_INTERVAL) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Resample one cycle's voltage and temperature onto its time grid.
+
+    Args:
+        time: Measured time (s)
+        voltage: Measured voltage (V)
+        temperature: Measured temperature (Celsius)
+        interval: Nominal grid spacing (s)
+
+    Returns:
+        Tuple of (time grid, outputs array of shape (samples, 2) with columns t and v)
+
+    Raises:
+        ValueError: If the grid leaves the measured time range or the samples
+            cannot be interpolated (fewer than 4, or repeated times)
+    """
+    time = np.asarray(time, dtype=float).ravel()
+    channels = np.column_stack([np.ravel(temperature), np.ravel(voltage)]).astype(float)
+    if np.any(np.diff(time) < 0):
+        order = np.argsort(time, kind='stable')
+        time, channels = time[order], channels[order]
+
+    grid = time_grid(time[-1], interval)
+    if grid[0] < time[0] or grid[-1] > time[-1]:
+        raise ValueError(f"Time grid [{grid[0]}, {grid[-1]}] leaves the measured range "
+                         f"[{time[0]}, {time[-1]}]")
+
+    spline = make_interp_spline(time, channels, k=3)
+    return grid, spline(grid)
+
+
+def prepare_cycle(dataset: RetiredBatteryDataset, batch: str, battery: int, cycle: int,
+                  interval: float = DEFAULT_INTERVAL) -> PreparedCycle:
+    """
+    Load and resample one discharge cycle.
+
+    Args:
+        dataset: Battery dataset handle
+        batch: Batch name
+        battery: Zero-based battery index
+        cycle: One-based cycle number
+        interval: Nominal grid spacing (s)
+
+    Returns:
+        Resampled cycle
+    """
+    with profiling.stage('preprocess'):
+        grid, outputs = resample_cycle(dataset.discharge_time(batch, battery, cycle),
+                                       dataset.discharge_voltage(batch, battery, cycle),
+                                       dataset.discharge_temperature(batch, battery, cycle),
+                                       interval)
+    return PreparedCycle(cycle, grid, constant_current(len(grid)), outputs)
+
+
+def prepare_battery_cycles(dataset: RetiredBatteryDataset, batch: str, battery: int,
+                           cycles: Optional[Iterable[int]] = None,
+                           interval: float = DEFAULT_INTERVAL) -> Iterator[PreparedCycle]:
+    """
+    Lazily load and resample the discharge cycles of one battery.
+
+    Cycles that cannot be resampled are reported and skipped.
+
+    Args:
+        dataset: Battery dataset handle
+        batch: Batch name
+        battery: Zero-based battery index
+        cycles: One-based cycle numbers, in order (all cycles if None)
+        interval: Nominal grid spacing (s)
+
+    Yields:
+        Resampled cycles
+    """
+    if cycles is None:
+        cycles = range(1, dataset.num_cycles(batch, battery) + 1)
+
+    for cycle in cycles:
+        try:
+            prepared = prepare_cycle(dataset, batch, battery, cycle, interval)
+        except (ValueError, IndexError) as e:
+            print(f"Error preprocessing {batch}, Battery {battery}, Cycle {cycle}: {e}")
+            continue
+        yield prepared
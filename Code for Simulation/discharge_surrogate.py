@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Discharge Surrogate
+===================
+
+Lookup-table emulator of the simulated discharge voltage curve.
+
+The table holds full-model traces on a regular grid over the (qMax, Ro, wr)
+box searched by ``process_battery_cycle`` and over the initial temperature.
+Each trace is the in-window simulated voltage resampled to a fixed number of
+points, so the per-cycle loss can align it exactly like a full simulation.
+Queries interpolate multilinearly between grid points and take tens of
+microseconds instead of a full ``simulate_to_threshold`` run.
+
+The temperature axis is in Celsius and holds the value the objective
+simulates at, ``runs[0][0][0]`` (see CycleObjective). That is the first
+sample of the run's time column, so a single value of 0 covers every cycle
+prepared by ``process_battery_cycle``.
+
+The table is built offline, in a process pool, and saved as ``.npz``:
+
+    python discharge_surrogate.py surrogate.npz --data RetiredBatteryData_all.mat \
+        --qmax 5500:15000:20 --ro 0.04:0.2:17 --wr 4e-6:12e-6:9 --temperature 0 --workers 32
+
+``estimate_params(surrogate=...)`` then runs the Bayesian optimization on the
+surrogate and checks only the best candidates with the full model.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+# Grid axes, in table order; temperature is the objective's initial temperature (Celsius)
+SURROGATE_AXES = ('qMax', 'Ro', 'wr', 'temperature')
+
+# Points per stored voltage trace
+DEFAULT_TRACE_SAMPLES = 200
+
+# Per-process simulators of the table builder, keyed by temperature
+_SIMULATORS = {}
+
+
+def resample_trace(simulated_voltage: np.ndarray, samples: int = DEFAULT_TRACE_SAMPLES) -> np.ndarray:
+    """
+    Resample a simulated voltage trace to a fixed number of evenly spaced points.
+
+    Args:
+        simulated_voltage: In-window simulated voltage
+        samples: Number of output points
+
+    Returns:
+        Array of shape (samples,)
+    """
+    n = len(simulated_voltage)
+    return np.interp(np.linspace(0, 1, samples), np.arange(n) / (n - 1), simulated_voltage)
+
+
+class DischargeSurrogate:
+    """
+    Multilinear lookup table of resampled discharge voltage traces.
+    """
+
+    def __init__(self, axes: Dict[str, np.ndarray], traces: np.ndarray):
+        """
+        Initialize the surrogate from a table.
+
+        Args:
+            axes: Grid values of every axis in SURROGATE_AXES
+            traces: Array of shape (*grid shape, samples); rows of failed
+                simulations are NaN
+        """
+        self.axes = {name: np.asarray(axes[name], dtype=float) for name in SURROGATE_AXES}
+        self.traces = traces
+
+        # Axes with a single value are held fixed
+        self._free = [name for name in SURROGATE_AXES if len(self.axes[name]) > 1]
+        fixed = tuple(slice(None) if len(self.axes[name]) > 1 else 0 for name in SURROGATE_AXES)
+        self._interpolator = RegularGridInterpolator([self.axes[name] for name in self._free],
+                                                     traces[fixed])
+
+    @property
+    def bounds(self) -> Dict[str, Tuple[float, float]]:
+        """Range covered by each axis."""
+        return {name: (values[0], values[-1]) for name, values in self.axes.items()}
+
+    def predict(self, optimization_params: Dict[str, float], temperature: float) -> np.ndarray:
+        """
+        Predict the in-window voltage trace; inputs are clipped to the table.
+
+        Args:
+            optimization_params: Dictionary of optimization parameters (qMax, Ro, wr)
+            temperature: Initial temperature the objective simulates at (Celsius)
+
+        Returns:
+            Resampled voltage trace (NaN if a neighbouring grid simulation failed)
+        """
+        query = dict(optimization_params, temperature=temperature)
+        point = [np.clip(query[name], *self.bounds[name]) for name in self._free]
+        return self._interpolator(point)[0]
+
+    def save(self, path: str) -> None:
+        """Save the table to an .npz file."""
+        np.savez(path, traces=self.traces, **self.axes)
+
+    @classmethod
+    def load(cls, path: str) -> 'DischargeSurrogate':
+        """Load a table saved with save()."""
+        with np.load(path) as data:
+            return cls({name: data[name] for name in SURROGATE_AXES}, data['traces'])
+
+
+def _simulate_grid_point(task: Tuple[str, float, Dict[str, float], int]) -> np.ndarray:
+    """Full-model trace of one grid point (runs in a worker process)."""
+    # Imported here: the estimation module imports this one
+    from batt_parameter_optimization_function import BatteryParameterEstimator, DischargeSimulator
+    from test_parameter_Estimation import setup_battery_model
+
+    data_path, temperature, optimization_params, samples = task
+    if temperature not in _SIMULATORS:
+        battery, initial_state = setup_battery_model(temperature, 2)
+        _SIMULATORS[temperature] = DischargeSimulator(battery, initial_state, data_path)
+
+    try:
+        simulated_voltage, _ = _SIMULATORS[temperature].simulate(
+            optimization_params, temperature + BatteryParameterEstimator.DEFAULT_TEMP_OFFSET
+        )
+        return resample_trace(simulated_voltage, samples)
+    except Exception as e:
+        print(f"Grid point {optimization_params} at {temperature} failed: {e}")
+        return np.full(samples, np.nan)
+
+
+def build_surrogate(data_path: str, axes: Dict[str, Sequence[float]],
+                    samples: int = DEFAULT_TRACE_SAMPLES, workers: Optional[int] = None
+                    ) -> DischargeSurrogate:
+    """
+    Build a surrogate table by running the full model on every grid point.
+
+    Args:
+        data_path: Battery data file or columnar store holding the batch21 reference
+        axes: Grid values of every axis in SURROGATE_AXES
+        samples: Points per stored voltage trace
+        workers: Number of worker processes (number of CPUs if None)
+
+    Returns:
+        Surrogate over the grid
+    """
+    grid = [np.asarray(axes[name], dtype=float) for name in SURROGATE_AXES]
+    tasks = [(data_path, float(temperature), {'qMax': float(qmax), 'Ro': float(ro), 'wr': float(wr)}, samples)
+             for qmax, ro, wr, temperature in product(*grid)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        traces = list(executor.map(_simulate_grid_point, tasks, chunksize=max(1, len(tasks) // 256)))
+
+    shape = tuple(len(values) for values in grid) + (samples,)
+    return DischargeSurrogate(dict(zip(SURROGATE_AXES, grid)), np.array(traces).reshape(shape))
+
+
+def parse_axis(spec: str) -> List[float]:
+    """
+    Parse an axis specification "start:stop:count" (or a single value).
+
+    Args:
+        spec: Axis specification
+
+    Returns:
+        List of evenly spaced values
+    """
+    parts = [float(part) for part in spec.split(':')]
+    if len(parts) == 1:
+        return parts
+    start, stop, count = parts
+    return np.linspace(start, stop, int(count)).tolist()
+
+
+def main():
+    """
+    Command-line entry point for building a surrogate table
+    """
+    parser = argparse.ArgumentParser(description="Build a discharge surrogate lookup table")
+    parser.add_argument('output', help="Output .npz file")
+    parser.add_argument('--data', default='RetiredBatteryData_all.mat',
+                        help="Battery data file or columnar store directory")
+    parser.add_argument('--qmax', default='5500:15000:20', help="qMax axis, start:stop:count")
+    parser.add_argument('--ro', default='0.04:0.2:17', help="Ro axis, start:stop:count")
+    parser.add_argument('--wr', default='4e-6:12e-6:9', help="wr axis, start:stop:count")
+    parser.add_argument('--temperature', default='0',
+                        help="Initial temperature axis, start:stop:count or a single value")
+    parser.add_argument('--samples', type=int, default=DEFAULT_TRACE_SAMPLES, help="Points per trace")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes")
+    args = parser.parse_args()
+
+    axes = {'qMax': parse_axis(args.qmax), 'Ro': parse_axis(args.ro), 'wr': parse_axis(args.wr),
+            'temperature': parse_axis(args.temperature)}
+    size = int(np.prod([len(values) for values in axes.values()]))
+    print(f"Simulating {size} grid points on {args.workers} workers")
+
+    start = time.perf_counter()
+    surrogate = build_surrogate(args.data, axes, args.samples, args.workers)
+    surrogate.save(args.output)
+
+    failed = int(np.isnan(surrogate.traces[..., 0]).sum())
+    print(f"Saved {args.output} in {time.perf_counter() - start:.1f} s ({failed} failed grid points)")
+
+
+if __name__ == "__main__":
+    main()
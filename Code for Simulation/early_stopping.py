@@ -0,0 +1,114 @@
+"""
+Early Stopping
+==============
+
+Convergence-based termination for the optimizer loop in ``estimate_params``.
+
+A cycle's fit stops before its evaluation budget is used up when
+
+    - the best target has not improved by more than ``tol`` over the last
+      ``patience`` evaluations,
+    - the acquisition maximum of the next proposal falls below
+      ``acquisition_threshold``, or
+    - the wall-clock ``time_budget`` of the cycle has run out.
+
+Each criterion is disabled when its setting is None. After a run, ``reason``
+holds one of the STOP_* values and ``evaluations`` the number of objective
+evaluations made.
+"""
+
+import math
+import time
+from typing import Optional
+
+# Stop reasons
+STOP_MAX_ITERATIONS = 'max_iterations'
+STOP_NO_IMPROVEMENT = 'no_improvement'
+STOP_ACQUISITION = 'acquisition_threshold'
+STOP_TIME_BUDGET = 'time_budget'
+
+
+class EarlyStopping:
+    """
+    Stopping criteria and bookkeeping for one optimization run.
+    """
+
+    def __init__(self, tol: float = 1e-6, patience: Optional[int] = None,
+                 acquisition_threshold: Optional[float] = None,
+                 time_budget: Optional[float] = None):
+        """
+        Initialize the criteria.
+
+        Args:
+            tol: Minimum increase of the best target that counts as an improvement
+            patience: Number of evaluations without improvement before stopping
+            acquisition_threshold: Stop when the acquisition maximum falls below this value
+            time_budget: Wall-clock budget of a run in seconds
+        """
+        self.tol = tol
+        self.patience = patience
+        self.acquisition_threshold = acquisition_threshold
+        self.time_budget = time_budget
+        self.start()
+
+    @property
+    def active(self) -> bool:
+        """Whether any stopping criterion is enabled."""
+        return any(setting is not None for setting in
+                   (self.patience, self.acquisition_threshold, self.time_budget))
+
+    def start(self) -> None:
+        """Reset the bookkeeping and start the clock for a new run."""
+        self.reason = None
+        self.evaluations = 0
+        self.best = -math.inf
+        self._since_improvement = 0
+        self._start_time = time.perf_counter()
+
+    def observe(self, target: float) -> None:
+        """
+        Record one objective evaluation.
+
+        Args:
+            target: Objective value
+        """
+        self.evaluations += 1
+        if target > self.best + self.tol:
+            self.best = target
+            self._since_improvement = 0
+        else:
+            self._since_improvement += 1
+
+    def check(self, acquisition_max: Optional[float] = None, guided: bool = True) -> Optional[str]:
+        """
+        Check the criteria, recording the reason if one is met.
+
+        Args:
+            acquisition_max: Acquisition value of the next proposal, if known
+            guided: Whether the initial points have been evaluated; only the time
+                budget applies before that
+
+        Returns:
+            Stop reason, or None to continue
+        """
+        if self.time_budget is not None and time.perf_counter() - self._start_time >= self.time_budget:
+            self.reason = STOP_TIME_BUDGET
+        elif not guided:
+            pass
+        elif self.patience is not None and self._since_improvement >= self.patience:
+            self.reason = STOP_NO_IMPROVEMENT
+        elif (self.acquisition_threshold is not None and acquisition_max is not None
+              and acquisition_max < self.acquisition_threshold):
+            self.reason = STOP_ACQUISITION
+        return self.reason
+
+    def finish(self) -> str:
+        """
+        Mark the run as finished.
+
+        Returns:
+            Stop reason (STOP_MAX_ITERATIONS if no criterion was met)
+        """
+        if self.reason is None:
+            self.reason = STOP_MAX_ITERATIONS
+        return self.reason
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+Parallel Battery Parameter Estimation
+=====================================
+
+Process-pool driver for running ``process_battery_cycle`` over many
+(batch, battery, cycle) jobs.
+
+Each worker is a long-lived process with its own dataset handle and builds a
+fresh ``BatteryElectroChem`` model per job, so no model state is shared
+between jobs. Jobs are handed to workers over dedicated pipes; a job that
+exceeds the per-job timeout is abandoned by terminating its worker, which is
+then replaced. Results stream back to the parent process, which is the only
+writer of the run's key-parameter result sink; ``--excel`` additionally exports
+the per-battery ``key_parameters.xlsx`` files at the end of the run. Workers
+do not render plots; run ``comparison_plots.py`` on the output afterwards.
+
+With ``--manifest DIR`` the run is checkpointed: every job's status, result and
+optimizer observations are saved as they happen, and re-running the same
+command skips finished jobs and resumes unfinished ones from their saved
+observations.
+
+With ``--warm-start`` all cycles of a battery run on the same worker in cycle
+order, and each cycle's optimization is warm-started from the previous cycle's
+optimum (see ``warm_start.WarmStart``). A resumed or respawned worker seeds
+the warm start from the previous cycle's result in the manifest.
+
+With ``--profile`` every job writes its per-stage timings to
+``{save_path}/{batch}/Battery{n}/timing/{cycle}.json`` (see ``profiling``);
+``--profile-job`` additionally dumps a cProfile (or pyinstrument) profile of
+one job next to them.
+
+Example:
+    python parallel_estimation.py --batches 1-21 --batteries 0-3 --workers 32 --timeout 1800 \
+        --manifest Simulation_data_NASA/manifest
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from collections import deque
+from contextlib import nullcontext
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from batt_parameter_optimization_function import battery_working_condition_match
+from run_manifest import (RunManifest, STATUS_DONE, STATUS_FAILED, STATUS_RUNNING, STATUS_TIMEOUT,
+                          open_manifest)
+from result_sink import export_key_parameters_excel, open_key_parameter_sink
+from discharge_surrogate import DischargeSurrogate
+from early_stopping import EarlyStopping
+import profiling
+from warm_start import WarmStart
+from test_parameter_Estimation import load_battery_data, process_battery_cycle
+
+
+def parse_range(spec: str) -> List[int]:
+    """
+    Parse a range specification such as "1-3,5,8-9".
+
+    Args:
+        spec: Comma-separated list of integers or inclusive ranges
+
+    Returns:
+        Sorted list of unique integers
+
+    Raises:
+        ValueError: If the specification is malformed
+    """
+    values = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = (int(x) for x in part.split('-', 1))
+            if end < start:
+                raise ValueError(f"Invalid range: {part}")
+            values.update(range(start, end + 1))
+        else:
+            values.add(int(part))
+    return sorted(values)
+
+
+def build_jobs(dataset, batch_numbers: Iterable[int], batteries: Iterable[int],
+               cycles: Optional[Iterable[int]] = None) -> List[Tuple[str, int, int]]:
+    """
+    Build the list of (batch, battery, cycle) jobs.
+
+    Args:
+        dataset: Battery dataset handle
+        batch_numbers: Batch numbers (1 for batch01, ...)
+        batteries: Zero-based battery indices
+        cycles: One-based cycle numbers (all available cycles if None)
+
+    Returns:
+        List of (batch_name, battery_number, cycle_number) tuples
+    """
+    jobs = []
+    for batch_number in batch_numbers:
+        batch_name = f'batch{batch_number:02d}'
+        for battery_number in batteries:
+            num_cycles = dataset.num_cycles(batch_name, battery_number)
+            battery_cycles = range(1, num_cycles + 1) if cycles is None else cycles
+            jobs.extend((batch_name, battery_number, cycle_number)
+                        for cycle_number in battery_cycles if 1 <= cycle_number <= num_cycles)
+    return jobs
+
+
+class ParameterSinkWriter:
+    """
+    Single writer collecting job results into the run's key-parameter sink.
+
+    Rows are keyed by (batch, battery, cycle), so they can arrive in any order;
+    the Excel export sorts them by cycle.
+    """
+
+    def __init__(self, save_path: str, manifest: Optional[RunManifest] = None,
+                 flush_every: int = 64):
+        """
+        Open the sink.
+
+        Args:
+            save_path: Base path for saving results
+            manifest: Run manifest in which rows are flagged once flushed to disk
+            flush_every: Number of buffered rows that triggers a flush
+        """
+        self.manifest = manifest
+        self.sink = open_key_parameter_sink(save_path, flush_every, on_flush=self._mark_written)
+
+    def __call__(self, record: Dict) -> None:
+        """
+        Accept one job result.
+
+        Args:
+            record: Job result record produced by run_parallel
+        """
+        if record['status'] == STATUS_DONE:
+            self.sink.append(record)
+
+    def close(self) -> None:
+        """Flush buffered rows."""
+        self.sink.close()
+
+    def _mark_written(self, rows: List[Dict]) -> None:
+        """Flag flushed rows in the manifest."""
+        if self.manifest is not None:
+            for row in rows:
+                self.manifest.update((row['batch'], row['battery'], row['cycle']), written=True)
+
+
+def _new_warm_start(job: Tuple[str, int, int], options: Dict,
+                    manifest: Optional[RunManifest]) -> WarmStart:
+    """
+    Create the warm-start state for a battery, seeded from the previous cycle's
+    result in the manifest if that cycle is done.
+    """
+    warm_start = WarmStart(**options)
+    if manifest is not None:
+        batch_name, battery_number, cycle_number = job
+        previous = manifest.load((batch_name, battery_number, cycle_number - 1))
+        if previous['status'] == STATUS_DONE:
+            warm_start.update({key: previous[key] for key in ('qMax', 'Ro', 'wr')})
+    return warm_start
+
+
+def _worker_main(conn, data_path: str, save_path: str, optimization_iter: int,
+                 manifest_dir: Optional[str], warm_start_options: Optional[Dict] = None,
+                 early_stopping_options: Optional[Dict] = None,
+                 surrogate_path: Optional[str] = None, stepping: str = 'fixed',
+                 profile_options: Optional[Dict] = None) -> None:
+    """
+    Worker loop: receive jobs over the pipe and send back result records.
+
+    Args:
+        conn: Worker end of the pipe
+        data_path: Path to the battery data file or columnar store
+        save_path: Base path for saving results
+        optimization_iter: Number of optimization iterations
+        manifest_dir: Run manifest directory (no checkpointing if None)
+        warm_start_options: WarmStart keyword arguments (no warm start if None)
+        early_stopping_options: EarlyStopping keyword arguments (full budget if None)
+        surrogate_path: Surrogate table to search on (full model if None)
+        stepping: Time stepping mode of the simulations ('fixed' or 'adaptive')
+        profile_options: Dictionary with the 'job' to profile and the 'profiler' to use
+            (no profile dump if None)
+    """
+    dataset = load_battery_data(data_path)
+    manifest = open_manifest(manifest_dir)
+    warm_starts = {}
+    early_stopping = EarlyStopping(**(early_stopping_options or {}))
+    surrogate = DischargeSurrogate.load(surrogate_path) if surrogate_path else None
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+
+        batch_name, battery_number, cycle_number = job
+        mid_soc, dod = battery_working_condition_match(batch_name)
+        record = {'batch': batch_name, 'battery': battery_number, 'cycle': cycle_number}
+
+        initial_observations = None
+        on_observation = None
+        if manifest is not None:
+            manifest.update(job, status=STATUS_RUNNING)
+            initial_observations = manifest.observations(job)
+            on_observation = lambda params, target, job=job: manifest.record_observation(job, params, target)
+
+        warm_start = None
+        if warm_start_options is not None:
+            battery_key = (batch_name, battery_number)
+            if battery_key not in warm_starts:
+                warm_starts[battery_key] = _new_warm_start(job, warm_start_options, manifest)
+            warm_start = warm_starts[battery_key]
+
+        profile_dump = nullcontext()
+        if profile_options is not None and tuple(profile_options['job']) == job:
+            profiler = profile_options['profiler']
+            profile_dump = profiling.profile_to(
+                profiling.timing_path(save_path, *job, profiling.profile_extension(profiler)), profiler
+            )
+
+        start = time.perf_counter()
+        try:
+            with profile_dump:
+                qmax_est, ro_est, wr_est = process_battery_cycle(
+                    dataset, batch_name, battery_number, cycle_number,
+                    mid_soc, dod, save_path, optimization_iter, save_parameters=False,
+                    initial_observations=initial_observations, on_observation=on_observation,
+                    warm_start=warm_start, early_stopping=early_stopping, surrogate=surrogate,
+                    stepping=stepping
+                )
+            record.update(status=STATUS_DONE, qMax=float(qmax_est), Ro=float(ro_est), wr=float(wr_est),
+                          evaluations=early_stopping.evaluations, stop_reason=early_stopping.reason)
+        except Exception as e:
+            record.update(status=STATUS_FAILED, error=str(e))
+        record['elapsed'] = time.perf_counter() - start
+
+        if manifest is not None:
+            manifest.update(job, **{k: v for k, v in record.items() if k not in ('batch', 'battery', 'cycle')})
+        conn.send(record)
+
+
+class _Worker:
+    """Parent-side handle of one worker process."""
+
+    def __init__(self, ctx, worker_args: Tuple):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,) + worker_args, daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.started_at = None
+        self.queue = deque()  # Remaining jobs of the group this worker owns
+
+    def assign(self, job: Tuple[str, int, int]) -> None:
+        self.job = job
+        self.started_at = time.perf_counter()
+        self.conn.send(job)
+
+    def release(self) -> Tuple[str, int, int]:
+        job, self.job, self.started_at = self.job, None, None
+        return job
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def kill(self) -> None:
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+def run_parallel(jobs: List[Tuple[str, int, int]], data_path: str, save_path: str,
+                 optimization_iter: int, workers: int = 1, timeout: Optional[float] = None,
+                 on_result: Optional[Callable[[Dict], None]] = None,
+                 manifest_dir: Optional[str] = None,
+                 warm_start_options: Optional[Dict] = None,
+                 early_stopping_options: Optional[Dict] = None,
+                 surrogate_path: Optional[str] = None, stepping: str = 'fixed',
+                 profile_options: Optional[Dict] = None) -> List[Dict]:
+    """
+    Run estimation jobs on a pool of worker processes.
+
+    Args:
+        jobs: List of (batch_name, battery_number, cycle_number) tuples
+        data_path: Path to the battery data file or columnar store
+        save_path: Base path for saving results
+        optimization_iter: Number of optimization iterations per job
+        workers: Number of worker processes
+        timeout: Per-job wall-clock limit in seconds (no limit if None)
+        on_result: Callback receiving each result record in the parent process
+        manifest_dir: Run manifest directory for checkpointing (disabled if None)
+        warm_start_options: WarmStart keyword arguments. If given, all jobs of a
+            battery are run by one worker in the given order, warm-starting each
+            cycle from the previous one (disabled if None)
+        early_stopping_options: EarlyStopping keyword arguments (full budget if None)
+        surrogate_path: Surrogate table to search on (full model if None)
+        stepping: Time stepping mode of the simulations ('fixed' or 'adaptive')
+        profile_options: Dictionary with the 'job' to profile and the 'profiler' to use
+            (no profile dump if None)
+
+    Returns:
+        List of result records in completion order. Each record holds batch,
+        battery, cycle, status, elapsed and either qMax/Ro/wr/evaluations/stop_reason
+        or error.
+    """
+    ctx = multiprocessing.get_context()
+    worker_args = (data_path, save_path, optimization_iter, manifest_dir, warm_start_options,
+                   early_stopping_options, surrogate_path, stepping, profile_options)
+    manifest = open_manifest(manifest_dir)
+
+    # A group of jobs is owned by a single worker and run in order
+    if warm_start_options is None:
+        groups = [[job] for job in jobs]
+    else:
+        batteries = {}
+        for job in jobs:
+            batteries.setdefault(job[:2], []).append(job)
+        groups = list(batteries.values())
+    pending = deque(deque(group) for group in groups)
+    if not pending:
+        return []
+    pool = [_Worker(ctx, worker_args) for _ in range(max(1, min(workers, len(groups))))]
+    results = []
+
+    def finish(record: Dict) -> None:
+        results.append(record)
+        if on_result is not None:
+            on_result(record)
+
+    def abandon(worker: _Worker, status: str, error: str, elapsed: Optional[float]) -> None:
+        # Workers checkpoint their own results; timeouts and crashes are recorded here
+        job = worker.release()
+        worker.kill()
+        replacement = _Worker(ctx, worker_args)
+        replacement.queue = worker.queue
+        pool[pool.index(worker)] = replacement
+        if manifest is not None:
+            manifest.update(job, status=status, error=error)
+        batch_name, battery_number, cycle_number = job
+        finish({'batch': batch_name, 'battery': battery_number, 'cycle': cycle_number,
+                'status': status, 'error': error, 'elapsed': elapsed})
+
+    try:
+        while pending or any(w.job is not None or w.queue for w in pool):
+            for worker in pool:
+                if worker.job is None:
+                    if not worker.queue and pending:
+                        worker.queue = pending.popleft()
+                    if worker.queue:
+                        worker.assign(worker.queue.popleft())
+
+            busy = [w for w in pool if w.job is not None]
+            wait_time = None
+            if timeout is not None:
+                now = time.perf_counter()
+                wait_time = max(0.0, min(w.started_at + timeout - now for w in busy))
+
+            ready = wait([w.conn for w in busy], timeout=wait_time)
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        record = worker.conn.recv()
+                    except EOFError:
+                        # Worker died without reporting (e.g. killed by the OS)
+                        abandon(worker, STATUS_FAILED, 'worker exited unexpectedly', None)
+                        continue
+                    worker.release()
+                    finish(record)
+                elif timeout is not None and time.perf_counter() - worker.started_at >= timeout:
+                    abandon(worker, STATUS_TIMEOUT, f'exceeded {timeout} s', timeout)
+    finally:
+        for worker in pool:
+            if worker.job is None:
+                worker.stop()
+            else:
+                worker.kill()
+
+    return results
+
+
+def report_result(record: Dict) -> None:
+    """Print a one-line summary of a job result."""
+    label = f"{record['batch']}, Battery {record['battery']}, Cycle {record['cycle']}"
+    if record['status'] == STATUS_DONE:
+        print(f"{label} completed in {record['elapsed']:.1f} s "
+              f"({record['evaluations']} evaluations, {record['stop_reason']}): "
+              f"qMax={record['qMax']:.2f}, Ro={record['Ro']:.6f}, wr={record['wr']:.2e}")
+    else:
+        print(f"{label} {record['status']}: {record.get('error')}")
+
+
+def main():
+    """
+    Command-line entry point for parallel parameter estimation
+    """
+    parser = argparse.ArgumentParser(description="Parallel battery parameter estimation")
+    parser.add_argument('--data', default='RetiredBatteryData_all.mat',
+                        help="Battery data file or columnar store directory")
+    parser.add_argument('--save-path', default='Simulation_data_NASA', help="Output directory")
+    parser.add_argument('--batches', default='1-21', help="Batch numbers, e.g. '1-3,5'")
+    parser.add_argument('--batteries', default='0-3', help="Zero-based battery indices, e.g. '0,2'")
+    parser.add_argument('--cycles', default=None, help="One-based cycle numbers (default: all)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument('--timeout', type=float, default=None, help="Per-job timeout in seconds")
+    parser.add_argument('--iterations', type=int, default=80, help="Optimization iterations per cycle")
+    parser.add_argument('--manifest', default=None,
+                        help="Checkpoint directory; re-running with the same directory resumes the run")
+    parser.add_argument('--warm-start', action='store_true',
+                        help="Warm-start each cycle from the previous cycle of the same battery")
+    parser.add_argument('--warm-iterations', type=int, default=None,
+                        help="Optimization iterations for warm-started cycles (default: --iterations)")
+    parser.add_argument('--patience', type=int, default=None,
+                        help="Stop a cycle after this many evaluations without improvement")
+    parser.add_argument('--tol', type=float, default=1e-6, help="Minimum improvement counted by --patience")
+    parser.add_argument('--acquisition-threshold', type=float, default=None,
+                        help="Stop a cycle when the acquisition maximum falls below this value")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="Wall-clock optimization budget per cycle in seconds")
+    parser.add_argument('--surrogate', default=None,
+                        help="Surrogate table from discharge_surrogate.py to search on")
+    parser.add_argument('--stepping', choices=('fixed', 'adaptive'), default='fixed',
+                        help="Time stepping of the simulations: fixed 2 s steps or adaptive steps "
+                             "with exact threshold crossing")
+    parser.add_argument('--profile', action='store_true',
+                        help="Write per-cycle stage timings next to the results")
+    parser.add_argument('--profile-job', default=None,
+                        help="Dump a profile of one job, given as BATCH:BATTERY:CYCLE (e.g. 1:0:5)")
+    parser.add_argument('--profiler', choices=profiling.PROFILERS, default='cprofile',
+                        help="Profiler used for --profile-job")
+    parser.add_argument('--flush-every', type=int, default=64, help="Result rows buffered per flush")
+    parser.add_argument('--excel', action='store_true',
+                        help="Export per-battery key_parameters.xlsx files at the end of the run")
+    args = parser.parse_args()
+
+    # Set before the workers start so they inherit it
+    if args.profile:
+        profiling.enable()
+    profile_options = None
+    if args.profile_job:
+        batch_number, battery_number, cycle_number = (int(part) for part in args.profile_job.split(':'))
+        profile_options = {'job': (f'batch{batch_number:02d}', battery_number, cycle_number),
+                           'profiler': args.profiler}
+
+    dataset = load_battery_data(args.data)
+    cycles = parse_range(args.cycles) if args.cycles else None
+    jobs = build_jobs(dataset, parse_range(args.batches), parse_range(args.batteries), cycles)
+
+    manifest = open_manifest(args.manifest)
+    if manifest is None:
+        to_run, to_write = jobs, jobs
+    else:
+        print(f"Manifest status: {manifest.summary(jobs)}")
+        to_run = manifest.unfinished(jobs)
+        to_write = [job for job in jobs if not manifest.load(job).get('written')]
+    print(f"Scheduling {len(to_run)} of {len(jobs)} jobs on {args.workers} workers")
+
+    writer = ParameterSinkWriter(args.save_path, manifest, args.flush_every)
+
+    # Replay results that finished in an earlier run but were not written yet
+    if manifest is not None:
+        scheduled = set(to_run)
+        for job in to_write:
+            if job not in scheduled:
+                writer(manifest.load(job))
+
+    def on_result(record: Dict) -> None:
+        report_result(record)
+        writer(record)
+
+    warm_start_options = {'iterations': args.warm_iterations} if args.warm_start else None
+    early_stopping_options = {'tol': args.tol, 'patience': args.patience,
+                              'acquisition_threshold': args.acquisition_threshold,
+                              'time_budget': args.time_budget}
+
+    start = time.perf_counter()
+    try:
+        results = run_parallel(to_run, args.data, args.save_path, args.iterations,
+                               args.workers, args.timeout, on_result, args.manifest,
+                               warm_start_options, early_stopping_options, args.surrogate,
+                               args.stepping, profile_options)
+    finally:
+        writer.close()
+
+    if args.excel:
+        export_key_parameters_excel(writer.sink, args.save_path)
+
+    counts = {}
+    for record in results:
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+    print(f"\nFinished {len(results)} jobs in {time.perf_counter() - start:.1f} s: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Profiling
+=========
+
+Per-stage timing instrumentation for the estimation pipeline.
+
+Code marks its stages with ``stage``::
+
+    with profiling.stage('simulate'):
+        ...
+
+and counts events with ``count``. Instrumentation is off by default: then
+``stage`` returns a shared no-op context manager and ``count`` returns
+immediately, so the hooks cost a function call each. It is switched on with
+``enable()`` or by setting the ``BATTERY_PROFILE`` environment variable to a
+non-empty value.
+
+When on, every stage accumulates its wall time and number of calls, both for
+the process and for the current record. ``record`` brackets the work of one
+cycle (or joint window) and writes its timings to
+``{save_path}/{batch}/Battery{n}/timing/{cycle}.json`` next to the results.
+Stages nest, so a record lists inclusive times. The stages used are
+
+    - ``load_data``: opening the battery archives (process-wide only)
+    - ``preprocess``: loading and resampling a cycle
+    - ``configure``: building a configured model (includes ``ukf``)
+    - ``ukf``: batch21 reference state estimation
+    - ``simulate``: discharge simulations
+    - ``loss``: scoring simulated traces
+    - ``gp_suggest``: GP fitting and acquisition maximization in bayes_opt
+    - ``evaluate_batch``: batched evaluation on worker processes
+    - ``excel``: writing result workbooks
+    - ``plot``: comparison plots and their data
+
+Simulations run by an EvaluationPool are timed in the worker processes and
+appear only as ``evaluate_batch`` in the record.
+
+``profile_to`` runs a block under cProfile (or pyinstrument, if installed)
+and dumps the profile, e.g. for a single job.
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterator, Sequence
+
+# Environment variable that enables instrumentation (inherited by worker processes)
+PROFILE_ENV = 'BATTERY_PROFILE'
+
+# Profilers supported by profile_to
+PROFILERS = ('cprofile', 'pyinstrument')
+
+_enabled = bool(os.environ.get(PROFILE_ENV))
+_lock = threading.Lock()
+_NULL_CONTEXT = nullcontext()
+
+# Accumulated {stage: [seconds, calls]} and {counter: value}
+_process_stages: Dict[str, list] = {}
+_process_counters: Dict[str, int] = {}
+_record_stages: Dict[str, list] = {}
+_record_counters: Dict[str, int] = {}
+
+
+def enable(on: bool = True) -> None:
+    """
+    Switch instrumentation on or off for this process and its child processes.
+
+    Args:
+        on: Whether to record timings
+    """
+    global _enabled
+    _enabled = on
+    if on:
+        os.environ[PROFILE_ENV] = '1'
+    else:
+        os.environ.pop(PROFILE_ENV, None)
+
+
+def is_enabled() -> bool:
+    """Whether instrumentation is on."""
+    return _enabled
+
+
+class _Stage:
+    """Context manager timing one stage."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            for stages in (_process_stages, _record_stages):
+                totals = stages.setdefault(self.name, [0.0, 0])
+                totals[0] += elapsed
+                totals[1] += 1
+
+
+def stage(name: str):
+    """
+    Time a stage of the pipeline.
+
+    Args:
+        name: Stage name
+
+    Returns:
+        Context manager (a no-op if instrumentation is off)
+    """
+    if not _enabled:
+        return _NULL_CONTEXT
+    return _Stage(name)
+
+
+def timed(name: str, function: Callable, *args, **kwargs) -> Any:
+    """
+    Call a function as a stage.
+
+    Args:
+        name: Stage name
+        function: Function to call
+        *args: Positional arguments of the function
+        **kwargs: Keyword arguments of the function
+
+    Returns:
+        The function's return value
+    """
+    with stage(name):
+        return function(*args, **kwargs)
+
+
+def count(name: str, n: int = 1) -> None:
+    """
+    Increment a counter.
+
+    Args:
+        name: Counter name
+        n: Increment
+    """
+    if not _enabled:
+        return
+    with _lock:
+        for counters in (_process_counters, _record_counters):
+            counters[name] = counters.get(name, 0) + n
+
+
+def _snapshot(stages: Dict[str, list], counters: Dict[str, int]) -> Dict:
+    """Copy accumulated timings into a JSON-serializable dictionary."""
+    return {
+        'stages': {name: {'seconds': seconds, 'calls': calls}
+                   for name, (seconds, calls) in sorted(stages.items())},
+        'counters': dict(sorted(counters.items())),
+    }
+
+
+def summary() -> Dict:
+    """
+    Timings accumulated by this process since it started.
+
+    Returns:
+        Dictionary with 'stages' ({name: {'seconds', 'calls'}}) and 'counters'
+    """
+    with _lock:
+        return _snapshot(_process_stages, _process_counters)
+
+
+def print_summary() -> None:
+    """Print the process-wide stage timings, longest first."""
+    stages = summary()['stages']
+    if not stages:
+        return
+    print(f"\n{'stage':<16} {'seconds':>10} {'calls':>8}")
+    for name, totals in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<16} {totals['seconds']:>10.3f} {totals['calls']:>8}")
+
+
+def timing_path(save_path: str, batch_name: str, battery_number: int, cycle_number: int,
+                extension: str = '.json') -> str:
+    """
+    Path of a cycle's timing record or profile dump.
+
+    Args:
+        save_path: Base path for saving results
+        batch_name: Name of the battery batch
+        battery_number: Battery number identifier
+        cycle_number: Cycle number identifier (first cycle of a joint window)
+        extension: File extension
+
+    Returns:
+        File path under the battery's timing directory
+    """
+    return os.path.join(save_path, batch_name, f'Battery{battery_number}', 'timing',
+                        f'{cycle_number}{extension}')
+
+
+@contextmanager
+def record(save_path: str, batch_name: str, battery_number: int,
+           cycle_numbers: Sequence[int]) -> Iterator[None]:
+    """
+    Record the stage timings of one cycle (or joint window) and save them as JSON.
+
+    Nothing is recorded or written if instrumentation is off. The record is
+    written even if the block raises.
+
+    Args:
+        save_path: Base path for saving results
+        batch_name: Name of the battery batch
+        battery_number: Battery number identifier
+        cycle_numbers: Cycle numbers covered by the block
+    """
+    if not _enabled:
+        yield
+        return
+
+    with _lock:
+        _record_stages.clear()
+        _record_counters.clear()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            timing = _snapshot(_record_stages, _record_counters)
+        timing.update(batch=batch_name, battery=battery_number, cycles=list(cycle_numbers),
+                      wall_time=time.perf_counter() - start, pid=os.getpid())
+
+        path = timing_path(save_path, batch_name, battery_number, cycle_numbers[0])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(timing, f, indent=2)
+
+
+@contextmanager
+def profile_to(path: str, profiler: str = 'cprofile') -> Iterator[None]:
+    """
+    Profile a block and dump the result.
+
+    cProfile writes a .prof file for pstats or snakeviz; pyinstrument writes an
+    HTML report.
+
+    Args:
+        path: Output file
+        profiler: One of PROFILERS
+
+    Raises:
+        ValueError: If the profiler is unknown
+        ImportError: If pyinstrument is requested but not installed
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler: {profiler}. Expected one of {PROFILERS}")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        session = Profiler()
+        session.start()
+        try:
+            yield
+        finally:
+            session.stop()
+            with open(path, 'w') as f:
+                f.write(session.output_html())
+    else:
+        session = cProfile.Profile()
+        session.enable()
+        try:
+            yield
+        finally:
+            session.disable()
+            session.dump_stats(path)
+
+
+def profile_extension(profiler: str) -> str:
+    """File extension of a profiler's dump."""
+    return '.html' if profiler == 'pyinstrument' else '.prof'
+
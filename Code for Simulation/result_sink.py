@@ -0,0 +1,221 @@
+"""
+Result Sink
+===========
+
+Buffered, bulk result writer for parameter-estimation runs.
+
+Rows are collected in memory and flushed in bulk as numbered ``.npz`` part
+files (one array per column) instead of re-opening and re-saving an Excel
+workbook for every row. Parts are written atomically and never modified, so a
+sink can be reopened after a crash and appended to. Exactly one process should
+write to a sink; in parallel runs that is the scheduling process.
+
+Excel output is an optional final step: ``export_key_parameters_excel`` writes
+the classic per-battery ``key_parameters.xlsx`` files from the collected rows
+in a single pass.
+"""
+
+import os
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from openpyxl import Workbook
+
+# Names of completed part files
+PART_FILE_PATTERN = re.compile(r'part-\d{5}\.npz')
+
+# Columns of the key-parameter table
+KEY_PARAMETER_COLUMNS = ('batch', 'battery', 'cycle', 'qMax', 'Ro', 'wr', 'evaluations', 'stop_reason')
+
+# Values of key-parameter columns missing from parts written by older versions
+KEY_PARAMETER_DEFAULTS = {'evaluations': -1, 'stop_reason': ''}
+
+# Header of the key_parameters.xlsx files
+KEY_PARAMETER_HEADER = ['qMax', 'R0', 'wr', 'evaluations', 'stop_reason']
+
+
+class ResultSink:
+    """
+    Append-only columnar table stored as .npz part files.
+    """
+
+    def __init__(self, output_dir: str, columns: Sequence[str], flush_every: int = 256,
+                 on_flush: Optional[Callable[[List[Dict]], None]] = None,
+                 defaults: Optional[Dict] = None):
+        """
+        Open or create a sink.
+
+        Args:
+            output_dir: Directory holding the part files
+            columns: Column names; every row must provide all of them
+            flush_every: Number of buffered rows that triggers a flush
+            on_flush: Callback receiving the rows of each flushed part once it is on disk
+            defaults: Values of columns that parts written before they were added lack
+        """
+        self.output_dir = output_dir
+        self.columns = tuple(columns)
+        self.defaults = dict(defaults or {})
+        self.flush_every = flush_every
+        self.on_flush = on_flush
+        self._buffer = []
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._next_part = len(self._part_paths())
+
+    def append(self, row: Dict) -> None:
+        """
+        Buffer one row, flushing if the buffer is full.
+
+        Args:
+            row: Dictionary with a value for every column
+
+        Raises:
+            KeyError: If a column is missing from the row
+        """
+        self._buffer.append({column: row[column] for column in self.columns})
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def extend(self, rows: Iterable[Dict]) -> None:
+        """Buffer several rows."""
+        for row in rows:
+            self.append(row)
+
+    def flush(self) -> None:
+        """Write the buffered rows as a new part file."""
+        if not self._buffer:
+            return
+
+        rows, self._buffer = self._buffer, []
+        arrays = {column: np.array([row[column] for row in rows]) for column in self.columns}
+
+        name = f'part-{self._next_part:05d}.npz'
+        path = os.path.join(self.output_dir, name)
+        # Hidden temp name that _part_paths never matches, even if a flush is interrupted
+        tmp_path = os.path.join(self.output_dir, f'.{name[:-len(".npz")]}.tmp.npz')
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self._next_part += 1
+
+        if self.on_flush is not None:
+            self.on_flush(rows)
+
+    def close(self) -> None:
+        """Flush any buffered rows."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self) -> Dict[str, np.ndarray]:
+        """
+        Read all flushed rows.
+
+        Columns missing from a part, e.g. one written before the column was
+        added, are filled with their default.
+
+        Returns:
+            Dictionary mapping column name to array
+
+        Raises:
+            KeyError: If a part lacks a column that has no default
+        """
+        parts = []
+        for path in self._part_paths():
+            with np.load(path) as part:
+                rows = len(part[part.files[0]])
+                columns = {}
+                for column in self.columns:
+                    if column in part.files:
+                        columns[column] = part[column]
+                    elif column in self.defaults:
+                        columns[column] = np.full(rows, self.defaults[column])
+                    else:
+                        raise KeyError(f"{path} has no column '{column}' and it has no default")
+                parts.append(columns)
+
+        if not parts:
+            return {column: np.array([]) for column in self.columns}
+        return {column: np.concatenate([part[column] for part in parts]) for column in self.columns}
+
+    def _part_paths(self) -> List[str]:
+        """Get the part files in write order."""
+        return sorted(os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)
+                      if PART_FILE_PATTERN.fullmatch(name))
+
+
+def open_key_parameter_sink(saving_file_path: str, flush_every: int = 256,
+                            on_flush: Optional[Callable[[List[Dict]], None]] = None) -> ResultSink:
+    """
+    Open the key-parameter sink of a run.
+
+    Args:
+        saving_file_path: Base path for saving files
+        flush_every: Number of buffered rows that triggers a flush
+        on_flush: Callback receiving the rows of each flushed part
+
+    Returns:
+        Sink stored under ``{saving_file_path}/key_parameters``
+    """
+    return ResultSink(os.path.join(saving_file_path, 'key_parameters'), KEY_PARAMETER_COLUMNS,
+                      flush_every, on_flush, KEY_PARAMETER_DEFAULTS)
+
+
+def latest_rows(table: Dict[str, np.ndarray], key_columns: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Drop duplicate rows, keeping the last one written for each key.
+
+    Args:
+        table: Dictionary mapping column name to array
+        key_columns: Columns identifying a row
+
+    Returns:
+        Table sorted by the key columns with one row per key
+    """
+    rows = {}
+    for i, key in enumerate(zip(*(table[column] for column in key_columns))):
+        rows[tuple(k.item() for k in key)] = i
+    order = np.array([rows[key] for key in sorted(rows)], dtype=int)
+    return {column: values[order] for column, values in table.items()}
+
+
+def export_key_parameters_excel(sink: ResultSink, saving_file_path: str) -> List[str]:
+    """
+    Write per-battery key_parameters.xlsx files from a key-parameter sink.
+
+    Rows are written in cycle order, one workbook save per battery.
+
+    Args:
+        sink: Sink with KEY_PARAMETER_COLUMNS
+        saving_file_path: Base path for saving files
+
+    Returns:
+        List of written file paths
+    """
+    table = latest_rows(sink.read(), ('batch', 'battery', 'cycle'))
+
+    groups: Dict[Tuple[str, int], List[int]] = {}
+    for i, (batch_name, battery_number) in enumerate(zip(table['batch'], table['battery'])):
+        groups.setdefault((str(batch_name), int(battery_number)), []).append(i)
+
+    written = []
+    for (batch_name, battery_number), indices in groups.items():
+        battery_path = os.path.join(saving_file_path, batch_name, f'Battery{battery_number}')
+        os.makedirs(battery_path, exist_ok=True)
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(KEY_PARAMETER_HEADER)  # Header row
+        for i in indices:
+            sheet.append([float(table['qMax'][i]), float(table['Ro'][i]), float(table['wr'][i]),
+                          int(table['evaluations'][i]), str(table['stop_reason'][i])])
+
+        excel_path = os.path.join(battery_path, 'key_parameters.xlsx')
+        workbook.save(excel_path)
+        written.append(excel_path)
+
+    return written
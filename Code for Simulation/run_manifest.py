@@ -0,0 +1,156 @@
+"""
+Run Manifest
+============
+
+Checkpoint store for long parameter-estimation runs.
+
+Every (batch, battery, cycle) job has its own JSON record holding its status,
+the optimal parameters once finished, and the full optimizer history as a
+list of (params, target) observations. Records are rewritten atomically after
+every objective evaluation, so a crashed run can be restarted: finished jobs
+are skipped and unfinished ones resume from their saved observations.
+
+Each record is written by one process at a time: the worker running the job
+while it is running, and the scheduling process otherwise.
+"""
+
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Job status values
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_TIMEOUT = 'timeout'
+
+
+class RunManifest:
+    """
+    Directory of per-job checkpoint records.
+    """
+
+    def __init__(self, manifest_dir: str):
+        """
+        Open or create a manifest.
+
+        Args:
+            manifest_dir: Directory holding the job records
+        """
+        self.manifest_dir = manifest_dir
+        os.makedirs(os.path.join(manifest_dir, 'jobs'), exist_ok=True)
+
+    def job_path(self, job: Tuple[str, int, int]) -> str:
+        """Get the path of a job record."""
+        batch_name, battery_number, cycle_number = job
+        return os.path.join(self.manifest_dir, 'jobs',
+                            f'{batch_name}_Battery{battery_number}_{cycle_number:05d}.json')
+
+    def load(self, job: Tuple[str, int, int]) -> Dict:
+        """
+        Load a job record.
+
+        Args:
+            job: (batch_name, battery_number, cycle_number) tuple
+
+        Returns:
+            Job record (a fresh pending record if none was saved)
+        """
+        try:
+            with open(self.job_path(job), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            batch_name, battery_number, cycle_number = job
+            return {'batch': batch_name, 'battery': battery_number, 'cycle': cycle_number,
+                    'status': STATUS_PENDING, 'observations': []}
+
+    def update(self, job: Tuple[str, int, int], **fields) -> Dict:
+        """
+        Update fields of a job record and save it.
+
+        Args:
+            job: (batch_name, battery_number, cycle_number) tuple
+            **fields: Fields to set, e.g. status, qMax, Ro, wr, error
+
+        Returns:
+            Updated job record
+        """
+        record = self.load(job)
+        record.update(fields)
+        self._save(job, record)
+        return record
+
+    def record_observation(self, job: Tuple[str, int, int], params: Dict[str, float],
+                           target: float) -> None:
+        """
+        Append one optimizer observation to a job record.
+
+        Args:
+            job: (batch_name, battery_number, cycle_number) tuple
+            params: Evaluated parameters
+            target: Objective value
+        """
+        record = self.load(job)
+        record['observations'].append({'params': {k: float(v) for k, v in params.items()},
+                                       'target': float(target)})
+        self._save(job, record)
+
+    def observations(self, job: Tuple[str, int, int]) -> List[Tuple[Dict[str, float], float]]:
+        """
+        Get the saved optimizer observations of a job.
+
+        Args:
+            job: (batch_name, battery_number, cycle_number) tuple
+
+        Returns:
+            List of (params, target) pairs
+        """
+        return [(obs['params'], obs['target']) for obs in self.load(job)['observations']]
+
+    def status(self, job: Tuple[str, int, int]) -> str:
+        """Get the status of a job."""
+        return self.load(job)['status']
+
+    def unfinished(self, jobs: Iterable[Tuple[str, int, int]]) -> List[Tuple[str, int, int]]:
+        """
+        Filter out jobs that already finished.
+
+        Args:
+            jobs: Iterable of job tuples
+
+        Returns:
+            Jobs whose status is not done
+        """
+        return [job for job in jobs if self.status(job) != STATUS_DONE]
+
+    def summary(self, jobs: Iterable[Tuple[str, int, int]]) -> Dict[str, int]:
+        """
+        Count jobs by status.
+
+        Args:
+            jobs: Iterable of job tuples
+
+        Returns:
+            Dictionary mapping status to number of jobs
+        """
+        counts = {}
+        for job in jobs:
+            status = self.status(job)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def _save(self, job: Tuple[str, int, int], record: Dict) -> None:
+        """Write a job record atomically."""
+        record['updated'] = time.time()
+        path = self.job_path(job)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+
+def open_manifest(manifest_dir: Optional[str]) -> Optional[RunManifest]:
+    """Open a manifest, or return None if checkpointing is disabled."""
+    return None if manifest_dir is None else RunManifest(manifest_dir)
@@ -11,26 +11,42 @@ Author: Battery Research Team
 Date: 2025
 """
 
-import numpy as np
-import scipy.io
 from progpy.loading import Piecewise
 from progpy.models import BatteryElectroChem
-from scipy.interpolate import interp1d
 
+from batch_evaluation import EvaluationPool
 from batt_parameter_optimization_function import estimate_params, battery_working_condition_match
+from battery_dataset import open_dataset
+from cycle_preprocessing import DEFAULT_INTERVAL, prepare_battery_cycles, prepare_cycle
+from discharge_surrogate import DischargeSurrogate
+from early_stopping import EarlyStopping
+import profiling
+from result_sink import export_key_parameters_excel, open_key_parameter_sink
+from warm_start import WarmStart
+
+# Parameters to estimate and their bounds
+PARAMETER_KEYS = ['qMax', 'Ro', 'wr']
+PARAMETER_BOUNDS = {
+    'qMax': (5500, 15000),  # Maximum capacity (mAh)
+    'Ro': (0.04, 0.2),  # Internal resistance (Ohm)
+    'wr': (4e-6, 12e-6)  # Warburg resistance parameter
+}
 
 def load_battery_data(data_path):
     """
     Load retired battery data from .mat file
 
+    The file is parsed once per process; later calls return the same handle.
+
     Args:
         data_path (str): Path to the battery data file
 
     Returns:
-        dict: Loaded battery data structure
+        RetiredBatteryDataset: Shared battery dataset handle
     """
     try:
-        return scipy.io.loadmat(data_path)['RetiredBatteryData_all'][0, 0]
+        with profiling.stage('load_data'):
+            return open_dataset(data_path)
     except FileNotFoundError:
         print(f"Error: Battery data file not found at {data_path}")
         raise
@@ -39,55 +55,6 @@ def load_battery_data(data_path):
         raise
 
 
-def interpolate_discharge_data(time, voltage, temperature, interval=2):
-    """
-    Interpolate discharge data to regular time intervals
-
-    Args:
-        time (array): Original time data
-        voltage (array): Original voltage data
-        temperature (array): Original temperature data
-        interval (int): Time interval for interpolation (seconds)
-
-    Returns:
-        tuple: Interpolated time, voltage, and temperature arrays
-    """
-    max_time = max(time)
-    time_new = np.linspace(0, int(np.floor(max_time)),
-                           int(np.floor(max_time / interval)) + 1)
-
-    # Create interpolation functions
-    voltage_interp = interp1d(time, voltage, kind='cubic')
-    temperature_interp = interp1d(time, temperature, kind='cubic')
-
-    # Interpolate data
-    voltage_new = voltage_interp(time_new)
-    temperature_new = temperature_interp(time_new)
-
-    return time_new, voltage_new, temperature_new
-
-
-def prepare_data_containers(time, current, voltage, temperature):
-    """
-    Prepare data containers for battery simulation
-
-    Args:
-        time (array): Time data
-        current (array): Current data
-        voltage (array): Voltage data
-        temperature (array): Temperature data
-
-    Returns:
-        tuple: Dictionary containers for time, current, and voltage data
-    """
-    time_dict = [{'time': num} for num in time.tolist()]
-    current_dict = [{'i': num} for num in current.tolist()]
-    voltage_dict = [{'t': temp, 'v': volt} for temp, volt in
-                    zip(temperature.tolist(), voltage.tolist())]
-
-    return time_dict, current_dict, voltage_dict
-
-
 def setup_battery_model(initial_temperature, interval):
     """
     Initialize and configure battery model
@@ -129,76 +96,142 @@ def setup_battery_model(initial_temperature, interval):
     return battery, initial_state
 
 
-def process_battery_cycle(data_all, batch_name, battery_number, cycle_number,
-                          mid_soc, dod, data_path, save_path, optimization_iter):
+def process_battery_cycle(dataset, batch_name, battery_number, cycle_number,
+                          mid_soc, dod, save_path, optimization_iter, save_parameters=True,
+                          result_sink=None, initial_observations=None, on_observation=None,
+                          warm_start=None, batch_size=1, evaluation_pool=None,
+                          early_stopping=None, plot=False, surrogate=None, stepping='fixed',
+                          prepared_cycle=None):
     """
     Process a single battery discharge cycle and estimate parameters
 
     Args:
-        data_all (dict): All battery data
+        dataset (RetiredBatteryDataset): Battery dataset handle
         batch_name (str): Batch identifier
         battery_number (int): Battery number in batch
         cycle_number (int): Cycle number to process
         mid_soc (float): Mid-point state of charge
         dod (float): Depth of discharge
-        data_path (str): Path to battery data file
         save_path (str): Path to save simulation results
         optimization_iter (int): Number of optimization iterations
+        save_parameters (bool): Save the estimate
+        result_sink (ResultSink): Key-parameter sink to buffer the estimate in
+            (appended to key_parameters.xlsx if None)
+        initial_observations (list): (params, target) pairs to resume the optimizer from
+        on_observation (callable): Callback receiving (params, target) after each evaluation
+        warm_start (WarmStart): Warm-start state shared by the battery's cycles, in order
+        batch_size (int): Number of optimizer points evaluated concurrently per round
+        evaluation_pool (EvaluationPool): Worker pool for batched evaluation
+        early_stopping (EarlyStopping): Convergence criteria; holds the stop reason and
+            evaluation count afterwards
+        plot (bool): Render the comparison plot now instead of with comparison_plots.py
+        surrogate (DischargeSurrogate): Surrogate to search on; the best candidates are
+            checked with the full model
+        stepping (str): Time stepping of the simulations, 'fixed' (2 s steps) or 'adaptive'
+        prepared_cycle (PreparedCycle): The cycle already resampled by
+            prepare_battery_cycles (loaded and resampled here if None)
 
     Returns:
         tuple: Estimated parameters (qMax, Ro, wr)
     """
     print(f"Processing {batch_name}, Battery {battery_number}, Cycle {cycle_number}")
 
-    # Extract discharge data for the specific cycle
-    discharge_time = data_all[batch_name][0, battery_number][0][0][0][14 - 1][cycle_number - 1, :]
-    discharge_voltage = data_all[batch_name][0, battery_number][0][0][0][8 - 1][cycle_number - 1, :]
-    discharge_temperature = data_all[batch_name][0, battery_number][0][0][0][11 - 1][cycle_number - 1, :]
-
-    # Create constant current array (5.2A discharge)
-    discharge_current = 5.2 * np.ones_like(discharge_voltage)
-
-    # Interpolate data to regular intervals
-    interval = 2  # seconds
-    time_interp, voltage_interp, temp_interp = interpolate_discharge_data(
-        discharge_time, discharge_voltage, discharge_temperature, interval
-    )
-
-    # Update current array for interpolated data
-    current_interp = 5.2 * np.ones_like(time_interp)
-
-    # Prepare data containers for simulation
-    time_dict, current_dict, voltage_dict = prepare_data_containers(
-        time_interp, current_interp, voltage_interp, temp_interp
-    )
+    with profiling.record(save_path, batch_name, battery_number, [cycle_number]):
+        # Discharge data resampled to regular intervals (constant 5.2A discharge)
+        interval = DEFAULT_INTERVAL  # seconds
+        if prepared_cycle is None:
+            prepared_cycle = prepare_cycle(dataset, batch_name, battery_number, cycle_number, interval)
+
+        # Setup battery model
+        battery, initial_state = setup_battery_model(prepared_cycle.temperature[0], interval)
+
+        # Estimate battery parameters using optimization
+        qmax_est, ro_est, wr_est = estimate_params(
+            battery, initial_state, mid_soc, dod,
+            batch_name, battery_number, cycle_number,
+            dataset, save_path, optimization_iter,
+            times=prepared_cycle.time,
+            inputs=prepared_cycle.current,
+            outputs=prepared_cycle.outputs,
+            keys=PARAMETER_KEYS,
+            bounds=PARAMETER_BOUNDS,
+            method='L-BFGS-B',
+            dt=interval,
+            error_method='MAX_E',
+            save_parameters=save_parameters,
+            result_sink=result_sink,
+            initial_observations=initial_observations,
+            on_observation=on_observation,
+            warm_start=warm_start,
+            batch_size=batch_size,
+            evaluation_pool=evaluation_pool,
+            early_stopping=early_stopping,
+            plot=plot,
+            surrogate=surrogate,
+            stepping=stepping
+        )
+
+        return qmax_est, ro_est, wr_est
+
+
+def process_battery_window(dataset, batch_name, battery_number, prepared_cycles,
+                           mid_soc, dod, save_path, optimization_iter, joint='shared',
+                           save_parameters=True, result_sink=None, warm_start=None,
+                           batch_size=1, evaluation_pool=None, early_stopping=None,
+                           plot=False, stepping='fixed'):
+    """
+    Fit a window of consecutive discharge cycles jointly in one optimization
 
-    # Setup battery model
-    battery, initial_state = setup_battery_model(temp_interp[0], interval)
-
-    # Define parameters to estimate and their bounds
-    parameter_keys = ['qMax', 'Ro', 'wr']
-    parameter_bounds = {
-        'qMax': (5500, 15000),  # Maximum capacity (mAh)
-        'Ro': (0.04, 0.2),  # Internal resistance (Ohm)
-        'wr': (4e-6, 12e-6)  # Warburg resistance parameter
-    }
-
-    # Estimate battery parameters using optimization
-    qmax_est, ro_est, wr_est = estimate_params(
-        battery, initial_state, mid_soc, dod,
-        batch_name, battery_number, cycle_number,
-        data_path, save_path, optimization_iter,
-        times=time_interp.tolist(),
-        inputs=current_dict,
-        outputs=voltage_dict,
-        keys=parameter_keys,
-        bounds=parameter_bounds,
-        method='L-BFGS-B',
-        dt=interval,
-        error_method='MAX_E'
-    )
+    Args:
+        dataset (RetiredBatteryDataset): Battery dataset handle
+        batch_name (str): Batch identifier
+        battery_number (int): Battery number in batch
+        prepared_cycles (list): PreparedCycle objects of the window, in cycle order
+        mid_soc (float): Mid-point state of charge
+        dod (float): Depth of discharge
+        save_path (str): Path to save simulation results
+        optimization_iter (int): Number of optimization iterations for the whole window
+        joint (str): 'shared' for one parameter set, 'linear' for a linear trajectory
+        save_parameters (bool): Save the estimates
+        result_sink (ResultSink): Key-parameter sink to buffer the estimates in
+            (appended to key_parameters.xlsx if None)
+        warm_start (WarmStart): Warm-start state shared by the battery's windows, in order
+        batch_size (int): Number of optimizer points evaluated concurrently per round
+        evaluation_pool (EvaluationPool): Worker pool for batched evaluation
+        early_stopping (EarlyStopping): Convergence criteria; holds the stop reason and
+            evaluation count afterwards
+        plot (bool): Render the comparison plots now instead of with comparison_plots.py
+        stepping (str): Time stepping of the simulations, 'fixed' (2 s steps) or 'adaptive'
 
-    return qmax_est, ro_est, wr_est
+    Returns:
+        list: Estimated parameters (qMax, Ro, wr) of every cycle in the window
+    """
+    cycle_numbers = [prepared_cycle.cycle for prepared_cycle in prepared_cycles]
+    print(f"Processing {batch_name}, Battery {battery_number}, Cycles {cycle_numbers} ({joint} fit)")
+
+    with profiling.record(save_path, batch_name, battery_number, cycle_numbers):
+        # Setup battery model
+        interval = DEFAULT_INTERVAL  # seconds
+        battery, initial_state = setup_battery_model(prepared_cycles[0].temperature[0], interval)
+
+        return estimate_params(
+            battery, initial_state, mid_soc, dod,
+            batch_name, battery_number, cycle_numbers[0],
+            dataset, save_path, optimization_iter,
+            runs=[(c.time, c.current, c.outputs) for c in prepared_cycles],
+            keys=PARAMETER_KEYS,
+            bounds=PARAMETER_BOUNDS,
+            save_parameters=save_parameters,
+            result_sink=result_sink,
+            warm_start=warm_start,
+            batch_size=batch_size,
+            evaluation_pool=evaluation_pool,
+            early_stopping=early_stopping,
+            plot=plot,
+            stepping=stepping,
+            joint=joint,
+            cycle_numbers=cycle_numbers
+        )
 
 
 def main():
@@ -209,56 +242,117 @@ def main():
     BATTERY_DATA_PATH = r'RetiredBatteryData_all.mat'
     SAVING_FILE_PATH = r'Simulation_data_NASA'
     OPTIMIZATION_ITERATIONS = 80
+    WARM_START = False  # Seed each cycle from the previous cycle's optimum
+    BATCH_SIZE = 1  # Points evaluated in parallel per optimizer round (e.g. os.cpu_count())
+    PATIENCE = None  # Stop a cycle after this many evaluations without improvement (e.g. 15)
+    TIME_BUDGET = None  # Wall-clock budget per cycle in seconds
+    PLOT = False  # Render comparison plots per cycle (otherwise run comparison_plots.py afterwards)
+    STEPPING = 'fixed'  # Simulation time stepping: 'fixed' (2 s steps) or 'adaptive'
+    JOINT_WINDOW = None  # Fit this many consecutive cycles jointly (e.g. 5; per cycle if None)
+    JOINT_MODE = 'shared'  # Joint fit: 'shared' parameters or a 'linear' trajectory
+    PROFILE = False  # Write per-cycle stage timings to {SAVING_FILE_PATH}/.../timing/
+    SURROGATE_PATH = None  # Surrogate table built with discharge_surrogate.py (full model if None)
+
+    if PROFILE:
+        profiling.enable()
 
     print("Loading battery data...")
-    data_all = load_battery_data(BATTERY_DATA_PATH)
+    dataset = load_battery_data(BATTERY_DATA_PATH)
+
+    # Buffer estimated parameters and write them in bulk
+    result_sink = open_key_parameter_sink(SAVING_FILE_PATH)
+
+    # Worker processes for batched objective evaluation, shared by all cycles
+    evaluation_pool = EvaluationPool(BATCH_SIZE) if BATCH_SIZE > 1 else None
+    early_stopping = EarlyStopping(patience=PATIENCE, time_budget=TIME_BUDGET)
+    surrogate = DischargeSurrogate.load(SURROGATE_PATH) if SURROGATE_PATH else None
+
+    try:
+        # Define all available batches
+        all_batches = [f'batch{i:02d}' for i in range(1, 22)]  # batch01 to batch21
+
 
-    # Define all available batches
-    all_batches = [f'batch{i:02d}' for i in range(1, 22)]  # batch01 to batch21
+        # Currently processing only batch01 (modify as needed)
+        batches_to_process = ['batch01']
 
+        # Process each batch
+        for batch_name in batches_to_process:
+            print(f"\nProcessing batch: {batch_name}")
 
-    # Currently processing only batch01 (modify as needed)
-    batches_to_process = ['batch01']
+            # Get battery working conditions for this batch
+            mid_soc, dod = battery_working_condition_match(batch_name)
+            print(f"Working conditions - Mid SOC: {mid_soc}, DOD: {dod}")
 
-    # Process each batch
-    for batch_name in batches_to_process:
-        print(f"\nProcessing batch: {batch_name}")
+            # Define batteries to process (currently only battery #2)
+            batteries_to_process = [2]
 
-        # Get battery working conditions for this batch
-        mid_soc, dod = battery_working_condition_match(batch_name)
-        print(f"Working conditions - Mid SOC: {mid_soc}, DOD: {dod}")
+            for battery_number in batteries_to_process:
+                print(f"\nProcessing battery number: {battery_number}")
 
-        # Define batteries to process (currently only battery #2)
-        batteries_to_process = [2]
+                # Get number of cycles for this battery
+                num_cycles = dataset.num_cycles(batch_name, battery_number)
+                print(f"Total cycles available: {num_cycles}")
 
-        for battery_number in batteries_to_process:
-            print(f"\nProcessing battery number: {battery_number}")
+                warm_start = WarmStart() if WARM_START else None
 
-            # Get number of cycles for this battery
-            num_cycles = len(data_all[batch_name][0, battery_number][0][0][0][14 - 1])
-            print(f"Total cycles available: {num_cycles}")
+                # Fit windows of consecutive cycles jointly
+                if JOINT_WINDOW:
+                    for first_cycle in range(1, num_cycles + 1, JOINT_WINDOW):
+                        cycle_numbers = list(range(first_cycle, min(first_cycle + JOINT_WINDOW, num_cycles + 1)))
 
-            # Process each cycle
-            for cycle_idx in range(num_cycles):
-                cycle_number = cycle_idx + 1
+                        try:
+                            # Cycles that cannot be resampled are reported and left out of the window
+                            window = list(prepare_battery_cycles(dataset, batch_name, battery_number, cycle_numbers))
+                            if not window:
+                                continue
+                            cycle_numbers = [prepared_cycle.cycle for prepared_cycle in window]
 
-                try:
-                    # Process the cycle and estimate parameters
-                    qmax_est, ro_est, wr_est = process_battery_cycle(
-                        data_all, batch_name, battery_number, cycle_number,
-                        mid_soc, dod, BATTERY_DATA_PATH, SAVING_FILE_PATH,
-                        OPTIMIZATION_ITERATIONS
-                    )
+                            estimates = process_battery_window(
+                                dataset, batch_name, battery_number, window,
+                                mid_soc, dod, SAVING_FILE_PATH, OPTIMIZATION_ITERATIONS, joint=JOINT_MODE,
+                                result_sink=result_sink, warm_start=warm_start,
+                                batch_size=BATCH_SIZE, evaluation_pool=evaluation_pool,
+                                early_stopping=early_stopping, plot=PLOT, stepping=STEPPING
+                            )
 
-                    print(f"Cycle {cycle_number} completed successfully")
-                    print(f"  Estimated qMax: {qmax_est:.2f}")
-                    print(f"  Estimated Ro: {ro_est:.6f}")
-                    print(f"  Estimated wr: {wr_est:.2e}")
+                            for cycle_number, (qmax_est, ro_est, wr_est) in zip(cycle_numbers, estimates):
+                                print(f"Cycle {cycle_number}: qMax={qmax_est:.2f}, Ro={ro_est:.6f}, wr={wr_est:.2e}")
 
-                except Exception as e:
-                    print(f"Error processing cycle {cycle_number}: {str(e)}")
+                        except Exception as e:
+                            print(f"Error processing cycles {cycle_numbers}: {str(e)}")
+                            continue
                     continue
 
+                # Process each cycle; it is loaded and resampled inside the try, so a failing
+                # cycle is reported and skipped
+                for cycle_number in range(1, num_cycles + 1):
+                    try:
+                        # Process the cycle and estimate parameters
+                        qmax_est, ro_est, wr_est = process_battery_cycle(
+                            dataset, batch_name, battery_number, cycle_number,
+                            mid_soc, dod, SAVING_FILE_PATH, OPTIMIZATION_ITERATIONS,
+                            result_sink=result_sink, warm_start=warm_start,
+                            batch_size=BATCH_SIZE, evaluation_pool=evaluation_pool,
+                            early_stopping=early_stopping, plot=PLOT, surrogate=surrogate,
+                            stepping=STEPPING
+                        )
+
+                        print(f"Cycle {cycle_number} completed successfully")
+                        print(f"  Estimated qMax: {qmax_est:.2f}")
+                        print(f"  Estimated Ro: {ro_est:.6f}")
+                        print(f"  Estimated wr: {wr_est:.2e}")
+
+                    except Exception as e:
+                        print(f"Error processing cycle {cycle_number}: {str(e)}")
+                        continue
+    finally:
+        # Keep the buffered estimates and stop the workers even if the run is interrupted
+        if evaluation_pool is not None:
+            evaluation_pool.close()
+        result_sink.close()
+        export_key_parameters_excel(result_sink, SAVING_FILE_PATH)
+
+    profiling.print_summary()
     print("\nBattery parameter estimation completed!")
 
 
@@ -0,0 +1,133 @@
+"""
+Warm Start
+==========
+
+Carry Bayesian-optimization state from one cycle of a battery to the next.
+
+qMax, Ro and wr drift slowly with cycling, so the optimum of cycle N is a good
+starting point for cycle N+1. A ``WarmStart`` object is passed to
+``estimate_params`` for every cycle of one battery, in cycle order, and is
+updated in place with each cycle's optimum. When it holds a prior optimum:
+
+    - the previous best point and a small neighbourhood around it replace the
+      random initial points,
+    - ``pbounds`` are narrowed around the recent trajectory of optima,
+    - the GP kernel starts from the hyperparameters learned on the previous
+      cycle (optionally frozen to skip refitting them).
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class WarmStart:
+    """
+    Per-battery warm-start state for estimate_params.
+    """
+
+    def __init__(self, neighbours: int = 4, neighbourhood: float = 0.02, window: int = 5,
+                 margin: float = 0.1, iterations: Optional[int] = None,
+                 reuse_kernel: bool = True, freeze_kernel: bool = False,
+                 random_state: Optional[int] = None):
+        """
+        Initialize an empty warm-start state.
+
+        Args:
+            neighbours: Number of random points seeded around the previous optimum
+            neighbourhood: Half-width of the seeding neighbourhood, as a fraction of
+                each parameter's original bound width
+            window: Number of recent optima the narrowed bounds must contain
+            margin: Padding added on each side of the trajectory, as a fraction of
+                each parameter's original bound width
+            iterations: Optimization iterations for warm cycles (the caller's
+                optimization_iter if None)
+            reuse_kernel: Start the GP from the previous cycle's fitted kernel
+            freeze_kernel: Keep the reused kernel hyperparameters fixed instead of
+                refitting them
+            random_state: Seed for the neighbourhood sampling
+        """
+        self.neighbours = neighbours
+        self.neighbourhood = neighbourhood
+        self.window = window
+        self.margin = margin
+        self.iterations = iterations
+        self.reuse_kernel = reuse_kernel
+        self.freeze_kernel = freeze_kernel
+
+        self.trajectory: List[Dict[str, float]] = []
+        self.kernel = None
+        self._rng = np.random.default_rng(random_state)
+
+    @property
+    def is_warm(self) -> bool:
+        """Whether a previous optimum is available."""
+        return bool(self.trajectory)
+
+    def narrow_bounds(self, pbounds: Dict[str, Tuple[float, float]]) -> Dict[str, Tuple[float, float]]:
+        """
+        Narrow the search box around the recent trajectory of optima.
+
+        Args:
+            pbounds: Original parameter bounds
+
+        Returns:
+            Narrowed bounds, clipped to the original ones
+        """
+        recent = self.trajectory[-self.window:]
+        bounds = {}
+        for key, (lower, upper) in pbounds.items():
+            values = [params[key] for params in recent]
+            pad = self.margin * (upper - lower)
+            bounds[key] = (max(lower, min(values) - pad), min(upper, max(values) + pad))
+        return bounds
+
+    def seed_points(self, pbounds: Dict[str, Tuple[float, float]],
+                    search_bounds: Optional[Dict[str, Tuple[float, float]]] = None) -> List[Dict[str, float]]:
+        """
+        Build the initial points: the previous optimum and its neighbourhood.
+
+        Args:
+            pbounds: Original parameter bounds, which scale the neighbourhood
+            search_bounds: Bounds the points must lie in, e.g. from narrow_bounds
+                (pbounds if None)
+
+        Returns:
+            List of parameter dictionaries
+        """
+        if search_bounds is None:
+            search_bounds = pbounds
+        best = self.trajectory[-1]
+        points = [{key: float(np.clip(best[key], *search_bounds[key])) for key in pbounds}]
+        for _ in range(self.neighbours):
+            point = {}
+            for key, (lower, upper) in pbounds.items():
+                step = self.neighbourhood * (upper - lower) * self._rng.uniform(-1, 1)
+                point[key] = float(np.clip(best[key] + step, *search_bounds[key]))
+            points.append(point)
+        return points
+
+    def configure(self, bo) -> None:
+        """
+        Apply the learned kernel to a BayesianOptimization instance.
+
+        Args:
+            bo: Optimizer for the new cycle
+        """
+        if self.reuse_kernel and self.kernel is not None:
+            bo.set_gp_params(kernel=self.kernel)
+            if self.freeze_kernel:
+                bo.set_gp_params(optimizer=None)
+
+    def update(self, best_params: Dict[str, float], bo=None) -> None:
+        """
+        Record a cycle's optimum and, if available, its fitted GP kernel.
+
+        Args:
+            best_params: Optimal parameters of the finished cycle
+            bo: Optimizer of the finished cycle
+        """
+        self.trajectory.append({key: float(value) for key, value in best_params.items()})
+        gp = getattr(bo, '_gp', None)
+        if gp is not None and hasattr(gp, 'kernel_'):
+            self.kernel = gp.kernel_